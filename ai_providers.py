@@ -1,9 +1,8 @@
 import asyncio
 from typing import Any, Dict, List, Optional, Tuple
 
-import httpx
-
 from config import settings
+from http_client import UPSTREAM_AI, shared_client
 
 
 class AIProviderError(Exception):
@@ -39,8 +38,8 @@ async def _http_post_json(
     body: Dict[str, Any],
     timeout_sec: float,
 ) -> Dict[str, Any]:
-    async with httpx.AsyncClient(timeout=timeout_sec) as client:
-        r = await client.post(url, json=body, headers=headers)
+    async with shared_client(UPSTREAM_AI) as client:
+        r = await client.post(url, json=body, headers=headers, timeout=timeout_sec)
         if r.status_code >= 500:
             raise AIProviderError(f"Provider 5xx: {r.status_code}", retryable=True, status_code=r.status_code)
         if r.status_code >= 400:
@@ -95,9 +94,11 @@ async def _replicate_poll(
     timeout_sec: float = 300,
 ) -> Dict[str, Any]:
     headers = {"Authorization": f"Token {token}"}
-    async with httpx.AsyncClient(timeout=timeout_sec) as client:
+    async with shared_client(UPSTREAM_AI) as client:
         for _ in range(120):
-            r = await client.get(f"https://api.replicate.com/v1/predictions/{prediction_id}", headers=headers)
+            r = await client.get(
+                f"https://api.replicate.com/v1/predictions/{prediction_id}", headers=headers, timeout=timeout_sec
+            )
             if r.status_code >= 500:
                 raise AIProviderError(f"Replicate 5xx: {r.status_code}", retryable=True, status_code=r.status_code)
             if r.status_code >= 400:
@@ -1,8 +1,8 @@
 import asyncio
-from pathlib import Path
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import httpx
+from fastapi import HTTPException
 
 from ai_providers import (
     AIProviderError,
@@ -11,34 +11,51 @@ from ai_providers import (
     replicate_t2i,
     replicate_i2i,
 )
-from cloudinary_utils import cloudinary_unsigned_upload_file
+from cloudinary_utils import cloudinary_unsigned_upload_stream, cloudinary_unsigned_upload_url
 from config import settings
-from file_utils import download_to, uuid_name
-from jobs import update_job_status, DONE, ERROR, RUNNING
-from services.ai_subscription import use_credits
-
-
-async def _download_and_upload(urls: List[str]) -> List[str]:
-    tmp_dir = Path(settings.MEDIA_TMP_DIR)
-    tmp_dir.mkdir(parents=True, exist_ok=True)
-    out_urls: List[str] = []
-    for url in urls:
-        ext = ".jpg"
-        if url.lower().endswith(".png"):
-            ext = ".png"
-        dst = tmp_dir / uuid_name("ai_out", ext)
-        try:
-            await download_to(url, dst, timeout_sec=120)
-            cld = await cloudinary_unsigned_upload_file(dst, resource_type="image", timeout_sec=120)
-            secure_url = cld.get("secure_url")
-            if secure_url:
-                out_urls.append(secure_url)
-        finally:
-            try:
-                dst.unlink(missing_ok=True)
-            except Exception:
-                pass
-    return out_urls
+from jobs import get_job_partials, update_job_status, DONE, ERROR, RUNNING
+from services.ai_subscription import use_credits, commit_credits, refund_credits
+
+
+async def _rehost_one(url: str) -> Optional[str]:
+    """
+    Сначала отдаём Cloudinary сам URL провайдера (fetch на их стороне);
+    если Cloudinary не смог его забрать — потоковая перекачка через нас, без диска.
+    """
+    try:
+        cld = await cloudinary_unsigned_upload_url(url, resource_type="image", timeout_sec=120)
+    except HTTPException as exc:
+        if exc.status_code != 502 or url.startswith("data:"):
+            raise
+        print(f"[ai] rehost by url failed, streaming instead: {exc.detail}")
+        cld = await cloudinary_unsigned_upload_stream(url, resource_type="image", timeout_sec=120)
+    return cld.get("secure_url")
+
+
+async def _rehost(urls: List[str]) -> List[str]:
+    """Переносит результаты провайдера в Cloudinary, все URL параллельно; порядок сохраняется."""
+    uploaded = await asyncio.gather(*(_rehost_one(u) for u in urls))
+    return [u for u in uploaded if u]
+
+
+_provider_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+def _provider_semaphore(provider: str) -> asyncio.Semaphore:
+    sem = _provider_semaphores.get(provider)
+    if sem is None:
+        limit = settings.AI_REPLICATE_CONCURRENCY if provider == "replicate" else settings.AI_FAL_CONCURRENCY
+        sem = asyncio.Semaphore(max(1, limit))
+        _provider_semaphores[provider] = sem
+    return sem
+
+
+def _limited(provider: str, func):
+    """Вызов провайдера под его семафором (слот держится только на время запроса, не на паузу ретрая)."""
+    async def call():
+        async with _provider_semaphore(provider):
+            return await func()
+    return call
 
 
 def _is_retryable_error(exc: Exception) -> bool:
@@ -72,12 +89,12 @@ async def _run_t2i(payload: Dict[str, Any]) -> Tuple[str, List[str], Dict[str, A
         fallback_name, fallback_fn = "replicate", lambda: replicate_t2i(payload, timeout_sec=300)
 
     try:
-        urls, meta = await _with_retries(primary_fn, retries=2)
+        urls, meta = await _with_retries(_limited(primary_name, primary_fn), retries=2)
         return primary_name, urls, meta
     except Exception as exc:
         if _is_retryable_error(exc):
             try:
-                urls, meta = await _with_retries(fallback_fn, retries=2)
+                urls, meta = await _with_retries(_limited(fallback_name, fallback_fn), retries=2)
                 return fallback_name, urls, meta
             except Exception:
                 raise exc
@@ -94,18 +111,45 @@ async def _run_i2i(payload: Dict[str, Any]) -> Tuple[str, List[str], Dict[str, A
         fallback_name, fallback_fn = "replicate", lambda: replicate_i2i(payload, timeout_sec=300)
 
     try:
-        urls, meta = await _with_retries(primary_fn, retries=2)
+        urls, meta = await _with_retries(_limited(primary_name, primary_fn), retries=2)
         return primary_name, urls, meta
     except Exception as exc:
         if _is_retryable_error(exc):
             try:
-                urls, meta = await _with_retries(fallback_fn, retries=2)
+                urls, meta = await _with_retries(_limited(fallback_name, fallback_fn), retries=2)
                 return fallback_name, urls, meta
             except Exception:
                 raise exc
         raise exc
 
 
+async def _settle_credits(job_id: str, payload: Dict[str, Any], success: bool) -> None:
+    """
+    Закрывает резерв кредитов задачи: commit при успехе, refund при ошибке.
+    Задачи без резерва (поставлены до резервирования) списываются по-старому после DONE.
+    """
+    hold_id = payload.get("credit_hold")
+    try:
+        if hold_id:
+            if success:
+                await commit_credits(hold_id)
+            else:
+                refunded = await refund_credits(hold_id)
+                if refunded:
+                    print(f"[ai] job_id={job_id} credits refunded: {refunded}")
+            return
+        user_id = payload.get("user_id")
+        operation_type = payload.get("operation_type")
+        if success and user_id and operation_type and not payload.get("credits_deducted"):
+            credits_result = await use_credits(user_id, operation_type)
+            if credits_result["success"]:
+                print(f"[ai] job_id={job_id} credits deducted: {credits_result['credits_used']}, remaining: {credits_result['credits_remaining']}")
+            else:
+                print(f"[ai] job_id={job_id} WARNING: Failed to deduct credits: {credits_result.get('error')}")
+    except Exception as exc:
+        print(f"[ai] job_id={job_id} ERROR: Exception while settling credits: {exc}")
+
+
 async def process_ai_job(job_id: str, job: Dict[str, Any]) -> None:
     kind = (job.get("kind") or "").lower()
     payload = job.get("payload") or {}
@@ -116,24 +160,13 @@ async def process_ai_job(job_id: str, job: Dict[str, Any]) -> None:
             provider, urls, meta = await _run_t2i(payload)
             print(f"[ai] job_id={job_id} kind={kind} provider={provider} stage=uploading")
             await update_job_status(job_id, RUNNING, stage="uploading")
-            uploaded = await _download_and_upload(urls)
+            uploaded = await _rehost(urls)
             if not uploaded:
                 raise RuntimeError("No images uploaded to Cloudinary")
             result = {"provider": provider, "images": uploaded, "meta": meta}
             await update_job_status(job_id, DONE, result=result, stage="done")
             
-            # Списываем кредиты после успешной генерации
-            user_id = payload.get("user_id")
-            operation_type = payload.get("operation_type")
-            if user_id and operation_type and not payload.get("credits_deducted"):
-                try:
-                    credits_result = await use_credits(user_id, operation_type)
-                    if credits_result["success"]:
-                        print(f"[ai] job_id={job_id} credits deducted: {credits_result['credits_used']}, remaining: {credits_result['credits_remaining']}")
-                    else:
-                        print(f"[ai] job_id={job_id} WARNING: Failed to deduct credits: {credits_result.get('error')}")
-                except Exception as exc:
-                    print(f"[ai] job_id={job_id} ERROR: Exception while deducting credits: {exc}")
+            await _settle_credits(job_id, payload, success=True)
             
             print(f"[ai] job_id={job_id} kind={kind} provider={provider} stage=done")
             return
@@ -142,24 +175,13 @@ async def process_ai_job(job_id: str, job: Dict[str, Any]) -> None:
             provider, urls, meta = await _run_i2i(payload)
             print(f"[ai] job_id={job_id} kind={kind} provider={provider} stage=uploading")
             await update_job_status(job_id, RUNNING, stage="uploading")
-            uploaded = await _download_and_upload(urls)
+            uploaded = await _rehost(urls)
             if not uploaded:
                 raise RuntimeError("No images uploaded to Cloudinary")
             result = {"provider": provider, "images": uploaded, "meta": meta}
             await update_job_status(job_id, DONE, result=result, stage="done")
             
-            # Списываем кредиты после успешной генерации
-            user_id = payload.get("user_id")
-            operation_type = payload.get("operation_type")
-            if user_id and operation_type and not payload.get("credits_deducted"):
-                try:
-                    credits_result = await use_credits(user_id, operation_type)
-                    if credits_result["success"]:
-                        print(f"[ai] job_id={job_id} credits deducted: {credits_result['credits_used']}, remaining: {credits_result['credits_remaining']}")
-                    else:
-                        print(f"[ai] job_id={job_id} WARNING: Failed to deduct credits: {credits_result.get('error')}")
-                except Exception as exc:
-                    print(f"[ai] job_id={job_id} ERROR: Exception while deducting credits: {exc}")
+            await _settle_credits(job_id, payload, success=True)
             
             print(f"[ai] job_id={job_id} kind={kind} provider={provider} stage=done")
             return
@@ -167,34 +189,68 @@ async def process_ai_job(job_id: str, job: Dict[str, Any]) -> None:
         if kind == "avatar_batch":
             image_urls = payload.get("image_urls") or []
             variants = int(payload.get("variants_per_image") or 1)
-            items: List[Dict[str, Any]] = []
-            success_count = 0
-            for src_url in image_urls:
-                item: Dict[str, Any] = {"source_image_url": src_url, "generated_images": [], "meta": {}}
-                try:
-                    generated: List[str] = []
-                    provider = None
-                    meta: Dict[str, Any] = {}
-                    for _ in range(variants):
+            units = [(i, v) for i in range(len(image_urls)) for v in range(variants)]
+            total = len(units)
+
+            # при повторной доставке (падение воркера) готовые генерации не повторяем
+            partials = await get_job_partials(job_id)
+            done_keys = {k for k, p in partials.items() if p.get("images")}
+            completed = len(done_keys)
+            if completed:
+                print(f"[ai] job_id={job_id} kind={kind} resuming {completed}/{total}")
+            await update_job_status(
+                job_id, RUNNING, stage="generating", progress={"completed": completed, "total": total}
+            )
+
+            sem = asyncio.Semaphore(max(1, settings.AI_BATCH_CONCURRENCY))
+
+            async def run_unit(idx: int, variant: int) -> None:
+                nonlocal completed
+                key = f"{idx}:{variant}"
+                async with sem:
+                    try:
                         provider, urls, meta = await _run_i2i(
                             {
                                 **payload,
-                                "image_url": src_url,
+                                "image_url": image_urls[idx],
                             }
                         )
-                        uploaded = await _download_and_upload(urls)
-                        generated.extend(uploaded)
-                    item["generated_images"] = generated
-                    item["meta"] = {**meta, "provider": provider}
-                    if generated:
-                        success_count += 1
-                except Exception as exc:
-                    item["error"] = str(exc)
+                        uploaded = await _rehost(urls)
+                        part: Dict[str, Any] = {"images": uploaded, "meta": meta, "provider": provider}
+                    except Exception as exc:
+                        part = {"images": [], "error": str(exc)}
+                partials[key] = part
+                completed += 1
+                await update_job_status(
+                    job_id,
+                    RUNNING,
+                    stage="generating",
+                    progress={"completed": completed, "total": total},
+                    partial={key: part},
+                )
+
+            await asyncio.gather(
+                *(run_unit(idx, v) for idx, v in units if f"{idx}:{v}" not in done_keys)
+            )
+
+            items: List[Dict[str, Any]] = []
+            success_count = 0
+            for idx, src_url in enumerate(image_urls):
+                item: Dict[str, Any] = {"source_image_url": src_url, "generated_images": [], "meta": {}}
+                for v in range(variants):
+                    part = partials.get(f"{idx}:{v}") or {}
+                    item["generated_images"].extend(part.get("images") or [])
+                    if part.get("meta") is not None:
+                        item["meta"] = {**part["meta"], "provider": part.get("provider")}
+                    if part.get("error") and "error" not in item:
+                        item["error"] = part["error"]
+                if item["generated_images"]:
+                    success_count += 1
                 items.append(item)
-                await asyncio.sleep(0)  # yield
 
             if success_count == 0:
                 await update_job_status(job_id, ERROR, error="All batch items failed", stage="error")
+                await _settle_credits(job_id, payload, success=False)
                 print(f"[ai] job_id={job_id} kind={kind} stage=error error=All batch items failed")
                 return
 
@@ -209,23 +265,14 @@ async def process_ai_job(job_id: str, job: Dict[str, Any]) -> None:
             }
             await update_job_status(job_id, DONE, result=result, stage="done")
             
-            # Списываем кредиты после успешной генерации avatar batch
-            user_id = payload.get("user_id")
-            operation_type = payload.get("operation_type")
-            if user_id and operation_type and not payload.get("credits_deducted"):
-                try:
-                    credits_result = await use_credits(user_id, operation_type)
-                    if credits_result["success"]:
-                        print(f"[ai] job_id={job_id} credits deducted: {credits_result['credits_used']}, remaining: {credits_result['credits_remaining']}")
-                    else:
-                        print(f"[ai] job_id={job_id} WARNING: Failed to deduct credits: {credits_result.get('error')}")
-                except Exception as exc:
-                    print(f"[ai] job_id={job_id} ERROR: Exception while deducting credits: {exc}")
+            await _settle_credits(job_id, payload, success=True)
             
             print(f"[ai] job_id={job_id} kind={kind} stage=done")
             return
 
         await update_job_status(job_id, ERROR, error=f"Unknown AI job kind: {kind}", stage="error")
+        await _settle_credits(job_id, payload, success=False)
     except Exception as exc:
         await update_job_status(job_id, ERROR, error=str(exc), stage="error")
+        await _settle_credits(job_id, payload, success=False)
         print(f"[ai] job_id={job_id} kind={kind} stage=error error={exc}")
@@ -1,11 +1,19 @@
 # cloudinary_utils.py
+import asyncio
+import hashlib
 import os
+import time
+import uuid
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Sequence, Tuple
 
 import httpx
 from fastapi import HTTPException
 
+from config import settings
+from http_client import UPSTREAM_CLOUDINARY, UPSTREAM_DOWNLOAD, get_client, shared_client
+from jobs import set_job_progress
+
 # Cloudinary env
 CLOUDINARY_CLOUD = os.getenv("CLOUDINARY_CLOUD", "").strip()
 CLOUDINARY_UNSIGNED_PRESET = os.getenv("CLOUDINARY_UNSIGNED_PRESET", "").strip()
@@ -30,6 +38,150 @@ CLOUD_REELS_TRANSFORM = (
 )
 
 
+ProgressCallback = Callable[[int, int], Awaitable[None]]
+
+_MIN_CHUNK_BYTES = 5 * 1024 * 1024  # меньше Cloudinary не принимает (кроме последней части)
+_READ_BLOCK_BYTES = 1024 * 1024
+
+
+def _multipart_envelope(
+    form: Dict[str, Any], filename: str, content_type: str, boundary: str
+) -> Tuple[bytes, bytes]:
+    """Начало multipart-тела (поля формы + заголовок file-части) и его конец."""
+    head = "".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'
+        for k, v in form.items()
+    )
+    head += (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    )
+    return head.encode(), f"\r\n--{boundary}--\r\n".encode()
+
+
+async def _read_range(path: Path, offset: int, length: int) -> AsyncIterator[bytes]:
+    # чтение с диска — в потоке, event loop не ждёт медленный диск / NFS
+    f = await asyncio.to_thread(path.open, "rb")
+    try:
+        await asyncio.to_thread(f.seek, offset)
+        left = length
+        while left > 0:
+            block = await asyncio.to_thread(f.read, min(_READ_BLOCK_BYTES, left))
+            if not block:
+                raise RuntimeError(f"File truncated during upload: {path}")
+            left -= len(block)
+            yield block
+    finally:
+        f.close()
+
+
+PartBody = Callable[[], AsyncIterator[bytes]]
+
+
+async def _send_part(
+    client: httpx.AsyncClient,
+    endpoint: str,
+    form: Dict[str, Any],
+    filename: str,
+    part: PartBody,
+    offset: int,
+    length: int,
+    *,
+    content_type: str,
+    headers: Dict[str, str],
+    timeout: httpx.Timeout,
+) -> httpx.Response:
+    """
+    Одна часть (offset, length). Тело — генератор, поэтому повтор
+    собирается заново из part(), а не ретраями клиента.
+    """
+    attempts = max(0, settings.CLOUDINARY_CHUNK_RETRIES) + 1
+    for attempt in range(attempts):
+        boundary = uuid.uuid4().hex
+        head, tail = _multipart_envelope(form, filename, content_type, boundary)
+
+        async def body() -> AsyncIterator[bytes]:
+            yield head
+            async for block in part():
+                yield block
+            yield tail
+
+        request = client.build_request(
+            "POST",
+            endpoint,
+            content=body(),
+            headers={
+                **headers,
+                "Content-Type": f"multipart/form-data; boundary={boundary}",
+                "Content-Length": str(len(head) + length + len(tail)),
+            },
+            timeout=timeout,
+        )
+        last = attempt + 1 >= attempts
+        try:
+            r = await client.send(request)
+        except httpx.TransportError as e:
+            if last:
+                raise HTTPException(502, f"Cloudinary upload failed: {e!r}") from None
+            print(f"[cloudinary] part {offset}+{length} failed ({e!r}), retry {attempt + 1}")
+        else:
+            if last or (r.status_code < 500 and r.status_code != 429):
+                return r
+            print(f"[cloudinary] part {offset}+{length} got {r.status_code}, retry {attempt + 1}")
+        await asyncio.sleep(min(30, 2 ** attempt))
+    raise AssertionError("unreachable")
+
+
+def _chunk_size() -> int:
+    return max(_MIN_CHUNK_BYTES, settings.CLOUDINARY_CHUNK_SIZE)
+
+
+async def _upload_in_parts(
+    total: int,
+    take_part: Callable[[int, int], Awaitable[PartBody]],
+    *,
+    filename: str,
+    content_type: str,
+    resource_type: str,
+    folder: Optional[str],
+    public_id: Optional[str],
+    timeout_sec: int,
+    progress: Optional[ProgressCallback],
+) -> Dict[str, Any]:
+    """
+    Общий цикл загрузки: total байт частями по CLOUDINARY_CHUNK_SIZE
+    (X-Unique-Upload-Id + Content-Range), если не влезают в одну.
+    take_part(offset, length) отдаёт фабрику тела части.
+    """
+    endpoint, form = _unsigned_form(resource_type, folder, public_id)
+    chunk_size = _chunk_size()
+    chunked = total > chunk_size
+    upload_id = uuid.uuid4().hex
+    timeout = httpx.Timeout(connect=10, read=timeout_sec, write=timeout_sec, pool=timeout_sec)
+    client = get_client(UPSTREAM_CLOUDINARY)
+
+    offset = 0
+    while True:
+        length = min(chunk_size, total - offset)
+        part = await take_part(offset, length)
+        headers: Dict[str, str] = {}
+        if chunked:
+            headers = {
+                "X-Unique-Upload-Id": upload_id,
+                "Content-Range": f"bytes {offset}-{offset + length - 1}/{total}",
+            }
+        r = await _send_part(
+            client, endpoint, form, filename, part, offset, length,
+            content_type=content_type, headers=headers, timeout=timeout,
+        )
+        _raise_for_upload(r)
+        offset += length
+        if progress is not None:
+            await progress(offset, total)
+        if offset >= total:
+            return r.json()
+
+
 async def cloudinary_unsigned_upload_file(
     path: Path,
     *,
@@ -37,44 +189,112 @@ async def cloudinary_unsigned_upload_file(
     folder: Optional[str] = None,
     public_id: Optional[str] = None,
     timeout_sec: int = 300,
+    progress: Optional[ProgressCallback] = None,
 ) -> Dict[str, Any]:
     """
-    Загрузка локального файла в Cloudinary (unsigned).
+    Загрузка локального файла в Cloudinary (unsigned) потоком с диска:
+    в памяти не больше блока чтения, независимо от размера файла.
+    Файл больше CLOUDINARY_CHUNK_SIZE уходит chunked upload'ом
+    (X-Unique-Upload-Id + Content-Range); при сетевой ошибке / 5xx
+    повторяется только неподтверждённая часть, а не весь файл.
+    progress(sent, total) вызывается после каждой подтверждённой части.
     Требуются ENV: CLOUDINARY_CLOUD и CLOUDINARY_UNSIGNED_PRESET.
     """
-    cloud = (os.getenv("CLOUDINARY_CLOUD", CLOUDINARY_CLOUD) or "").strip()
-    preset = (os.getenv("CLOUDINARY_UNSIGNED_PRESET", CLOUDINARY_UNSIGNED_PRESET) or "").strip()
+    content_type = (
+        "video/mp4" if resource_type in ("video", "auto") else "image/jpeg"
+    )
 
-    if not cloud or not preset:
-        raise HTTPException(
-            400,
-            "Cloudinary not configured: set CLOUDINARY_CLOUD and CLOUDINARY_UNSIGNED_PRESET",
-        )
+    async def take_part(offset: int, length: int) -> PartBody:
+        return lambda: _read_range(path, offset, length)
 
-    endpoint = f"https://api.cloudinary.com/v1_1/{cloud}/{resource_type}/upload"
-    data: Dict[str, Any] = {"upload_preset": preset}
-    if folder:
-        data["folder"] = folder
-    if public_id:
-        data["public_id"] = public_id
+    return await _upload_in_parts(
+        path.stat().st_size,
+        take_part,
+        filename=path.name,
+        content_type=content_type,
+        resource_type=resource_type,
+        folder=folder,
+        public_id=public_id,
+        timeout_sec=timeout_sec,
+        progress=progress,
+    )
 
-    # mime/content-type
-    content_type = (
-        "video/mp4" if resource_type in ("video", "auto") else "image/jpeg"
+
+async def cloudinary_unsigned_upload_iter(
+    source: AsyncIterator[bytes],
+    total: int,
+    *,
+    filename: str,
+    content_type: str,
+    resource_type: str = "video",
+    folder: Optional[str] = None,
+    public_id: Optional[str] = None,
+    timeout_sec: int = 300,
+    progress: Optional[ProgressCallback] = None,
+) -> Dict[str, Any]:
+    """
+    Загрузка из потока (тело входящего запроса) без диска: в памяти одна
+    часть CLOUDINARY_CHUNK_SIZE — её и повторяем при ошибке.
+    total — заявленный размер (Content-Length): Content-Range требует его
+    заранее. Поток короче или длиннее total — HTTPException 400 / 413.
+    """
+    pending = bytearray()
+    it = source.__aiter__()
+
+    async def take_part(offset: int, length: int) -> PartBody:
+        while len(pending) < length:
+            try:
+                pending.extend(await it.__anext__())
+            except StopAsyncIteration:
+                raise HTTPException(
+                    400, f"Upload body is shorter than declared size ({total} bytes)"
+                ) from None
+        if offset + length >= total:
+            async for extra in it:
+                pending.extend(extra)
+                if len(pending) > length:
+                    raise HTTPException(413, f"Upload body is larger than declared size ({total} bytes)")
+            if len(pending) > length:
+                raise HTTPException(413, f"Upload body is larger than declared size ({total} bytes)")
+        with memoryview(pending) as view:
+            data = bytes(view[:length])
+        del pending[:length]
+
+        async def body() -> AsyncIterator[bytes]:
+            yield data
+
+        return body
+
+    return await _upload_in_parts(
+        total,
+        take_part,
+        filename=filename,
+        content_type=content_type,
+        resource_type=resource_type,
+        folder=folder,
+        public_id=public_id,
+        timeout_sec=timeout_sec,
+        progress=progress,
     )
-    files = {"file": (path.name, path.read_bytes(), content_type)}
 
-    async with httpx.AsyncClient(timeout=timeout_sec) as client:
-        r = await client.post(endpoint, data=data, files=files)
+
+def job_upload_progress(job_id: str, stage: str = "cloudinary") -> ProgressCallback:
+    """
+    progress-колбэк для cloudinary_unsigned_upload_file: байты → поле
+    progress задачи. status/stage задачи не меняются — задача может быть
+    уже завершена (flow грузит результат video_filter).
+    """
+
+    async def report(sent: int, total: int) -> None:
         try:
-            r.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            try:
-                err = e.response.json()
-            except Exception:
-                err = {"status": e.response.status_code, "text": e.response.text[:500]}
-            raise HTTPException(502, f"Cloudinary upload failed: {err}") from None
-        return r.json()
+            await set_job_progress(
+                job_id, {"stage": stage, "completed": sent, "total": total, "unit": "bytes"}
+            )
+        except Exception as e:
+            # прогресс — не повод ронять загрузку
+            print(f"[cloudinary] progress update failed job={job_id}: {e}")
+
+    return report
 
 
 async def cloudinary_unsigned_upload_bytes(
@@ -86,7 +306,27 @@ async def cloudinary_unsigned_upload_bytes(
     public_id: Optional[str] = None,
     timeout_sec: int = 300,
 ) -> Dict[str, Any]:
-    cloud = (os.getenv("CLOUDINARY_CLOUD", CLOUDINARY_CLOUD) or "").strip()
+    endpoint, form = _unsigned_form(resource_type, folder, public_id)
+    content_type = (
+        "image/jpeg" if resource_type in ("image", "auto") else "application/octet-stream"
+    )
+    files = {"file": (filename, data_bytes, content_type)}
+
+    async with shared_client(UPSTREAM_CLOUDINARY) as client:
+        r = await client.post(endpoint, data=form, files=files, timeout=timeout_sec)
+        _raise_for_upload(r)
+        return r.json()
+
+
+# --- Rehost: перенос чужих URL (AI-провайдеры) в Cloudinary без локального диска
+
+
+def _cloud_name() -> str:
+    return (os.getenv("CLOUDINARY_CLOUD", CLOUDINARY_CLOUD) or "").strip()
+
+
+def _unsigned_form(resource_type: str, folder: Optional[str], public_id: Optional[str]):
+    cloud = _cloud_name()
     preset = (os.getenv("CLOUDINARY_UNSIGNED_PRESET", CLOUDINARY_UNSIGNED_PRESET) or "").strip()
 
     if not cloud or not preset:
@@ -101,20 +341,144 @@ async def cloudinary_unsigned_upload_bytes(
         form["folder"] = folder
     if public_id:
         form["public_id"] = public_id
+    return endpoint, form
 
-    content_type = (
-        "image/jpeg" if resource_type in ("image", "auto") else "application/octet-stream"
-    )
-    files = {"file": (filename, data_bytes, content_type)}
 
-    async with httpx.AsyncClient(timeout=timeout_sec) as client:
-        r = await client.post(endpoint, data=form, files=files)
+def _raise_for_upload(r: httpx.Response) -> None:
+    try:
+        r.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        try:
+            err = e.response.json()
+        except Exception:
+            err = {"status": e.response.status_code, "text": e.response.text[:500]}
+        raise HTTPException(502, f"Cloudinary upload failed: {err}") from None
+
+
+async def cloudinary_unsigned_upload_url(
+    url: str,
+    *,
+    resource_type: str = "image",
+    folder: Optional[str] = None,
+    public_id: Optional[str] = None,
+    timeout_sec: int = 120,
+) -> Dict[str, Any]:
+    """
+    Cloudinary сам скачивает файл по URL (http(s) или data:) — байты
+    не проходят через наш процесс. Не сработает, если URL не публичный.
+    """
+    endpoint, form = _unsigned_form(resource_type, folder, public_id)
+    form["file"] = url
+    async with shared_client(UPSTREAM_CLOUDINARY) as client:
+        r = await client.post(endpoint, data=form, timeout=timeout_sec)
+        _raise_for_upload(r)
+        return r.json()
+
+
+async def cloudinary_unsigned_upload_stream(
+    url: str,
+    *,
+    resource_type: str = "image",
+    folder: Optional[str] = None,
+    public_id: Optional[str] = None,
+    timeout_sec: int = 120,
+    max_bytes: int = 200 * 1024 * 1024,
+) -> Dict[str, Any]:
+    """
+    Скачивание и загрузка одним потоком: чанки ответа источника сразу
+    уходят в multipart-тело запроса к Cloudinary (без диска и без
+    буфера на весь файл). Content-Length выставляется, если его знает источник.
+    """
+    endpoint, form = _unsigned_form(resource_type, folder, public_id)
+    boundary = uuid.uuid4().hex
+    filename = (url.split("?")[0].rsplit("/", 1)[-1] or "file")[:100]
+
+    timeout = httpx.Timeout(connect=10, read=timeout_sec, write=timeout_sec, pool=timeout_sec)
+    source = get_client(UPSTREAM_DOWNLOAD)
+    upload = get_client(UPSTREAM_CLOUDINARY)
+    async with source.stream("GET", url, timeout=timeout) as src:
         try:
-            r.raise_for_status()
+            src.raise_for_status()
         except httpx.HTTPStatusError as e:
-            try:
-                err = e.response.json()
-            except Exception:
-                err = {"status": e.response.status_code, "text": e.response.text[:500]}
-            raise HTTPException(502, f"Cloudinary upload failed: {err}") from None
+            raise RuntimeError(f"Download failed ({e.response.status_code}) {url}") from None
+
+        content_type = src.headers.get("Content-Type") or "application/octet-stream"
+        head_bytes, tail_bytes = _multipart_envelope(form, filename, content_type, boundary)
+
+        headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+        cl = src.headers.get("Content-Length")
+        if cl and cl.isdigit() and "Content-Encoding" not in src.headers:
+            if int(cl) > max_bytes:
+                raise RuntimeError(f"Download too large: {cl} bytes > {max_bytes}")
+            headers["Content-Length"] = str(len(head_bytes) + int(cl) + len(tail_bytes))
+
+        async def body() -> AsyncIterator[bytes]:
+            yield head_bytes
+            written = 0
+            async for chunk in src.aiter_bytes():
+                written += len(chunk)
+                if written > max_bytes:
+                    raise RuntimeError(f"Download too large: exceeded {max_bytes} bytes")
+                yield chunk
+            yield tail_bytes
+
+        r = await upload.post(endpoint, content=body(), headers=headers, timeout=timeout)
+        _raise_for_upload(r)
         return r.json()
+
+
+# --- Signed direct upload: клиент грузит в Cloudinary сам, минуя наш сервер
+
+SIGNED_UPLOAD_TTL_SEC = 3600  # Cloudinary принимает подпись в течение часа от timestamp
+
+
+def cloudinary_signed_upload_ticket(
+    *,
+    resource_type: str = "video",
+    upload_preset: Optional[str] = None,
+    allowed_formats: Optional[Sequence[str]] = None,
+    folder: Optional[str] = None,
+    tags: Optional[Sequence[str]] = None,
+) -> Dict[str, Any]:
+    """
+    Параметры подписанной загрузки для клиента: POST на upload_url с
+    fields + file (большие файлы — тем же chunked-протоколом, chunk_size).
+    Подпись: sha1("k=v&..." по алфавиту + API secret). public_id выдаём
+    сами, чтобы клиент не мог перезаписать чужой ресурс.
+    Наш сервер такие загрузки не видит, поэтому ограничения входят в подпись:
+    upload_preset (signed preset в Cloudinary с max_file_size и
+    resource_type) обязателен, allowed_formats — список расширений.
+    Клиент не может ни убрать их, ни подменить: подпись не сойдётся.
+    """
+    cloud = _cloud_name()
+    api_key = settings.CLOUDINARY_API_KEY
+    api_secret = settings.CLOUDINARY_API_SECRET
+    if not cloud or not api_key or not api_secret:
+        raise HTTPException(
+            400,
+            "Cloudinary signed uploads not configured: set CLOUDINARY_CLOUD, CLOUDINARY_API_KEY and CLOUDINARY_API_SECRET",
+        )
+    if not upload_preset:
+        # без пресета лимит размера не действует — тикет не выдаём
+        raise HTTPException(400, "Cloudinary signed uploads not configured: set CLOUDINARY_SIGNED_UPLOAD_PRESET")
+
+    timestamp = int(time.time())
+    params: Dict[str, Any] = {
+        "timestamp": timestamp,
+        "public_id": f"upl_{uuid.uuid4().hex}",
+        "upload_preset": upload_preset,
+    }
+    if allowed_formats:
+        params["allowed_formats"] = ",".join(allowed_formats)
+    if folder:
+        params["folder"] = folder
+    if tags:
+        params["tags"] = ",".join(tags)
+    to_sign = "&".join(f"{k}={params[k]}" for k in sorted(params))
+    signature = hashlib.sha1(f"{to_sign}{api_secret}".encode()).hexdigest()
+    return {
+        "upload_url": f"https://api.cloudinary.com/v1_1/{cloud}/{resource_type}/upload",
+        "fields": {**params, "api_key": api_key, "signature": signature},
+        "chunk_size": _chunk_size(),
+        "expires_at": timestamp + SIGNED_UPLOAD_TTL_SEC,
+    }
@@ -26,11 +26,58 @@ class Settings(BaseSettings):
     CLOUDINARY_API_KEY: Optional[str] = None
     CLOUDINARY_API_SECRET: Optional[str] = None
     CLOUDINARY_UNSIGNED_PRESET: Optional[str] = None
+    CLOUDINARY_CHUNK_SIZE: int = 8 * 1024 * 1024  # файлы больше — chunked upload частями такого размера (мин. 5MB)
+    CLOUDINARY_UPLOAD_FOLDER: Optional[str] = None  # папка для прямых загрузок по /uploads/video/ticket
+    CLOUDINARY_SIGNED_UPLOAD_PRESET: Optional[str] = None  # signed preset для тикетов (video, max_file_size = лимит видео)
+    CLOUDINARY_CHUNK_RETRIES: int = 3  # повторов одной части при сетевой ошибке / 5xx
 
     # Media / FFmpeg
     FFMPEG_BIN: str = "ffmpeg"
     FFPROBE_BIN: str = "ffprobe"
     MEDIA_TMP_DIR: str = "/tmp/ig_planner"
+    FFMPEG_MAX_CONCURRENCY: int = 2  # одновременных ffmpeg-процессов задач воркера на инстанс
+    FFMPEG_INTERACTIVE_CONCURRENCY: int = 2  # отдельная квота для ffmpeg внутри HTTP-запросов
+    FFMPEG_QUEUE_WAIT_SEC: int = 30  # сколько запрос ждёт свободный слот, дальше — ошибка ffmpeg busy
+    FFMPEG_TIMEOUT_SEC: int = 15 * 60  # wall-clock лимит на один запуск ffmpeg
+    IMAGE_POOL_PROCESSES: int = 0  # >0 — Pillow-операции в процессах (image_ops.py), 0 — в потоках
+    IMAGE_POOL_THREADS: int = 0  # размер пула потоков; 0 — по числу ядер
+    IMAGE_POOL_MAX_PENDING: int = 32  # сверх этого /media/* отвечают 429
+    DOWNLOAD_CACHE_ENABLED: bool = True  # общий кеш скачанных медиа (download_cache.py)
+    DOWNLOAD_CACHE_DIR: str = ""  # пусто — <backend>/cache/downloads
+    DOWNLOAD_CACHE_MAX_BYTES: int = 2 * 1024 * 1024 * 1024  # LRU-вытеснение сверх этого
+    DOWNLOAD_CACHE_FRESH_SEC: int = 300  # столько не перепроверяем ETag/Last-Modified
+    MEDIA_PROBE_CACHE_TTL_SEC: int = 7 * 24 * 60 * 60  # кеш нормализованного ffprobe (media_probe.py)
+    TRANSFORM_CACHE_ENABLED: bool = True  # кеш результатов resize/filter/watermark/transcode (transform_cache.py)
+    TRANSFORM_CACHE_TTL_SEC: int = 7 * 24 * 60 * 60
+    TRANSFORM_CACHE_MAX_ENTRIES: int = 5000  # сверх — вытесняем давно не запрошенные
+
+    # HTTP-клиенты (общие пулы на upstream, см. http_client.py)
+    HTTP_MAX_CONNECTIONS: int = 100  # на один upstream
+    HTTP_MAX_KEEPALIVE: int = 20  # сколько простаивающих соединений держим открытыми
+    HTTP_KEEPALIVE_EXPIRY_SEC: float = 60
+    HTTP2_ENABLED: bool = True  # действует, только если установлен h2 (pip install "httpx[http2]")
+
+    # Graph API: лимиты Meta (X-App-Usage / X-Business-Use-Case-Usage)
+    GRAPH_USAGE_SLOWDOWN_PCT: int = 75  # с этой загрузки квоты начинаем притормаживать
+    GRAPH_USAGE_MAX_DELAY_SEC: float = 5  # пауза перед запросом при 100%
+    GRAPH_USAGE_SYNC_SEC: float = 2  # как часто перечитывать общий бюджет из Redis
+    GRAPH_USAGE_TTL_SEC: int = 10 * 60
+    GRAPH_THROTTLE_BASE_SEC: float = 5  # пауза после троттлинга, если Meta не назвала срок
+    GRAPH_THROTTLE_MAX_WAIT_SEC: int = 60  # дольше не ждём — отдаём 429 сразу
+    GRAPH_THROTTLE_RETRIES: int = 2
+    GRAPH_CACHE_ENABLED: bool = True  # read-through кеш GET-ов Graph (services/graph_cache.py)
+    GRAPH_CACHE_STALE_SEC: int = 600  # сколько после TTL ещё отдаём старое и обновляем в фоне
+
+    # Кеш load_state (services/ig_state.py)
+    IG_STATE_CACHE_TTL_SEC: int = 30  # локальный LRU в процессе
+    IG_STATE_CACHE_SIZE: int = 256
+    IG_STATE_ENV_TTL_SEC: int = 24 * 60 * 60  # resolved page/ig_id для IG_ACCESS_TOKEN из env
+    ACCOUNT_REFRESH_CONCURRENCY: int = 5  # одновременных запросов в Graph при batch refresh аккаунтов
+
+    # Rate limit (rate_limit.py)
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMITS: str = ""  # переопределение квот: "ai_generate:10/60,ai_batch:3/60" (запросов/сек окна)
+    RATE_LIMIT_LOCAL_MAX_KEYS: int = 10_000  # LRU локального окна, когда Redis недоступен
 
     # AI / Generation
     AI_PROVIDER: str = "fal"
@@ -40,15 +87,32 @@ class Settings(BaseSettings):
     FAL_I2I_ENDPOINT: str = "https://fal.run/fal-ai/flux/image-to-image"
     REPLICATE_T2I_MODEL: Optional[str] = None
     REPLICATE_I2I_MODEL: Optional[str] = None
+    AI_FAL_CONCURRENCY: int = 8  # одновременных запросов к fal на процесс
+    AI_REPLICATE_CONCURRENCY: int = 4  # одновременных запросов к replicate на процесс
+    AI_BATCH_CONCURRENCY: int = 6  # параллельных генераций внутри одного avatar_batch
 
     # Jobs
-    VIDEO_WORKERS: int = 2
+    VIDEO_WORKERS: int = 2  # число in-process циклов воркера в API-процессе
+    INPROCESS_WORKERS: bool = True  # false → задачи обрабатывает только `python -m worker`
+    WORKER_VIDEO_CONCURRENCY: int = 1  # одновременных video-задач на процесс
+    WORKER_AI_CONCURRENCY: int = 8  # одновременных AI-задач на процесс
+    WORKER_BATCH_CONCURRENCY: int = 2  # одновременных avatar_batch на процесс
+    WORKER_LANES: str = ""  # какие lane обслуживает `python -m worker` (через запятую; пусто — все)
+    WORKER_DRAIN_TIMEOUT_SEC: int = 120  # сколько ждём текущие задачи на SIGTERM
     JOB_TTL_SECONDS: int = 60 * 60  # 1 час
 
     # Redis
     REDIS_URL: Optional[str] = None
     REDIS_PREFIX: str = "jobs"
     REDIS_QUEUE: str = "jobs:queue"
+    JOB_RELIABLE_QUEUE: bool = True  # LMOVE в processing + ack + redelivery (нужен Redis >= 6.2)
+    JOB_VISIBILITY_TIMEOUT_SEC: int = 60  # TTL heartbeat воркера; без него задачи переотдаются
+    JOB_MAX_ATTEMPTS: int = 3  # после стольких попыток задача уходит в dead-letter
+    JOB_REAPER_INTERVAL_SEC: int = 30
+    JOB_LANE_WEIGHTS: str = "ai:4,video:2,batch:1"  # доли lane при выборе следующей задачи
+    JOB_HIGH_PRIORITY_WEIGHT: int = 4  # во сколько раз чаще high берётся раньше normal
+    JOB_USER_MAX_INFLIGHT: int = 2  # задач одного пользователя одновременно (0 — без лимита)
+    JOB_EVENTS_RECHECK_SEC: int = 15  # страховочное перечитывание статуса при ожидании pub/sub
 
     # Analytics & Attribution
     APPHUD_API_KEY: Optional[str] = None
@@ -0,0 +1,192 @@
+# download_cache.py
+"""
+Общий дисковый кеш скачанных медиа (validate → cover → filter → watermark
+одного и того же видео скачивают его один раз).
+
+- ключ — sha256(URL); рядом с файлом лежит .json с ETag / Last-Modified;
+- моложе DOWNLOAD_CACHE_FRESH_SEC — отдаём без запроса, старше — условный
+  GET (If-None-Match / If-Modified-Since): 304 → тот же файл;
+- одновременные запросы одного URL в процессе ждут одну загрузку;
+  между процессами файл меняется атомарно (replace), так что в худшем
+  случае будет две загрузки, но не битый файл;
+- вызывающему отдаётся hardlink в его dst_path (copy, если другой диск) —
+  cleanup и os.unlink копии кеш не трогают;
+- сверх DOWNLOAD_CACHE_MAX_BYTES удаляются давно не использованные (LRU по mtime);
+- в .json хранится sha256 содержимого — ключ для transform_cache.py.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from config import settings
+from file_utils import fetch_to
+from paths import DOWNLOAD_CACHE_DIR
+
+_inflight: Dict[str, "asyncio.Task[Path]"] = {}
+
+
+def _cache_dir() -> Path:
+    return Path(settings.DOWNLOAD_CACHE_DIR) if settings.DOWNLOAD_CACHE_DIR else DOWNLOAD_CACHE_DIR
+
+
+def _paths(url: str) -> "tuple[Path, Path]":
+    digest = hashlib.sha256(url.encode()).hexdigest()
+    base = _cache_dir() / digest[:2] / digest
+    return base.with_suffix(".bin"), base.with_suffix(".json")
+
+
+def _read_meta(meta_path: Path) -> Optional[Dict[str, Any]]:
+    try:
+        return json.loads(meta_path.read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(meta_path: Path, meta: Dict[str, Any]) -> None:
+    tmp = meta_path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(meta))
+    tmp.replace(meta_path)
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _evict() -> None:
+    """Удаляет самые давно использованные файлы, пока кеш больше лимита."""
+    limit = settings.DOWNLOAD_CACHE_MAX_BYTES
+    entries = []
+    total = 0
+    for blob in _cache_dir().glob("*/*.bin"):
+        try:
+            st = blob.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, blob))
+        total += st.st_size
+    if total <= limit:
+        return
+    entries.sort()
+    target = int(limit * 0.9)  # с запасом, чтобы не вычищать на каждой загрузке
+    for _mtime, size, blob in entries:
+        if total <= target:
+            break
+        blob.unlink(missing_ok=True)
+        blob.with_suffix(".json").unlink(missing_ok=True)
+        total -= size
+        print(f"[download_cache] evicted {blob.name} ({size} bytes)")
+
+
+async def _ensure(url: str, max_bytes: int, timeout_sec: float) -> Path:
+    blob, meta_path = _paths(url)
+    meta = _read_meta(meta_path) if blob.exists() else None
+
+    if meta and time.time() - meta.get("checked_at", 0) < settings.DOWNLOAD_CACHE_FRESH_SEC:
+        return blob
+
+    conditional: Dict[str, str] = {}
+    if meta and meta.get("etag"):
+        conditional["If-None-Match"] = meta["etag"]
+    if meta and meta.get("last_modified"):
+        conditional["If-Modified-Since"] = meta["last_modified"]
+
+    headers = await fetch_to(
+        url, blob, timeout_sec=timeout_sec, max_bytes=max_bytes, headers=conditional or None
+    )
+    if headers is None and meta:
+        meta["checked_at"] = time.time()
+        print(f"[download_cache] revalidated (304) {url}")
+    else:
+        meta = {
+            "url": url,
+            "etag": headers.get("ETag") if headers else None,
+            "last_modified": headers.get("Last-Modified") if headers else None,
+            "size": blob.stat().st_size,
+            "sha256": await asyncio.to_thread(file_sha256, blob),
+            "checked_at": time.time(),
+        }
+        await asyncio.to_thread(_evict)
+    _write_meta(meta_path, meta)
+    return blob
+
+
+def _link_or_copy(blob: Path, dst_path: Path) -> None:
+    dst_path.parent.mkdir(parents=True, exist_ok=True)
+    dst_path.unlink(missing_ok=True)
+    try:
+        os.link(blob, dst_path)
+    except OSError:
+        shutil.copyfile(blob, dst_path)
+    os.utime(blob)  # отметка использования для LRU
+
+
+async def download_cached(
+    url: str,
+    dst_path: Path,
+    *,
+    timeout_sec: float = 120,
+    max_bytes: int = 200 * 1024 * 1024,
+) -> Path:
+    """
+    download_to через кеш: файл оказывается в dst_path (hardlink/копия
+    закешированного), повторные скачивания того же URL не ходят в сеть.
+    """
+    if not settings.DOWNLOAD_CACHE_ENABLED:
+        await fetch_to(url, dst_path, timeout_sec=timeout_sec, max_bytes=max_bytes)
+        return dst_path
+
+    for attempt in range(2):
+        key = _paths(url)[0].name
+        task = _inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(_ensure(url, max_bytes, timeout_sec))
+            _inflight[key] = task
+            task.add_done_callback(lambda _t, k=key: _inflight.pop(k, None))
+        # shield: отмена одного ожидающего не отменяет общую загрузку
+        blob = await asyncio.shield(task)
+        try:
+            size = blob.stat().st_size
+            if size > max_bytes:
+                raise RuntimeError(f"Download too large: {size} bytes > {max_bytes}")
+            await asyncio.to_thread(_link_or_copy, blob, dst_path)
+            return dst_path
+        except FileNotFoundError:
+            # вытеснили между загрузкой и ссылкой — ещё раз
+            if attempt:
+                raise
+            _paths(url)[1].unlink(missing_ok=True)
+    return dst_path
+
+
+async def content_sha256(url: str, path: Path) -> str:
+    """
+    sha256 содержимого, уже скачанного download_cached(url, path): из
+    метаданных кеша, если они про тот же файл, иначе считается по path.
+    """
+    blob, meta_path = _paths(url)
+    meta = _read_meta(meta_path) if settings.DOWNLOAD_CACHE_ENABLED else None
+    if meta and meta.get("sha256") and meta.get("size") == path.stat().st_size:
+        return meta["sha256"]
+    return await asyncio.to_thread(file_sha256, path)
+
+
+def fresh_content_sha256(url: str) -> Optional[str]:
+    """sha256 закешированного URL, если запись свежая (без запроса в сеть); иначе None."""
+    if not settings.DOWNLOAD_CACHE_ENABLED:
+        return None
+    blob, meta_path = _paths(url)
+    meta = _read_meta(meta_path)
+    if not meta or not blob.exists():
+        return None
+    if time.time() - meta.get("checked_at", 0) >= settings.DOWNLOAD_CACHE_FRESH_SEC:
+        return None
+    return meta.get("sha256")
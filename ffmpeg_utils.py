@@ -2,9 +2,13 @@
 import os
 import json
 import shutil
+import asyncio
 import subprocess
+import time
 from pathlib import Path
-from typing import Any, Dict, Optional, Set
+from typing import Any, Dict, List, Optional, Set
+
+from config import settings
 
 
 # ---- resolve ffmpeg/ffprobe binaries (Homebrew, /usr/local, PATH)
@@ -35,91 +39,242 @@ FFPROBE = _pick_bin(
 )
 
 
-# ── availability ───────────────────────────────────────────────────────
-def has_ffmpeg() -> bool:
+# ── capabilities (один раз на процесс) ────────────────────────────────
+# Пробы (-version / -filters / -encoders / -hwaccels) запускаются при старте
+# (probe_capabilities в main._startup / worker) и кешируются до
+# refresh_capabilities(); has_ffmpeg() и прочие проверки на горячем пути
+# читают кеш и процессы не порождают.
+KEY_FILTERS = ["scale", "fps", "crop", "eq", "overlay", "colorchannelmixer", "loudnorm", "boxblur", "gblur", "vignette"]
+KEY_ENCODERS = ["libx264", "libx265", "h264_vaapi", "h264_nvenc", "h264_qsv", "h264_videotoolbox", "aac", "libopus"]
+
+_PROBE_TIMEOUT_SEC = 10
+_CAPS: Optional[Dict[str, Any]] = None
+
+
+def _run_probe(*args: str) -> Optional[str]:
+    """stdout команды или None, если бинаря нет / код возврата не 0."""
     try:
-        p1 = subprocess.run(
-            [FFMPEG, "-version"],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            check=False,
-        )
-        p2 = subprocess.run(
-            [FFPROBE, "-version"],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
+        p = subprocess.run(
+            list(args),
+            capture_output=True,
+            text=True,
             check=False,
+            timeout=_PROBE_TIMEOUT_SEC,
         )
-        return p1.returncode == 0 and p2.returncode == 0
     except Exception:
-        return False
+        return None
+    return p.stdout if p.returncode == 0 else None
 
 
-# ── versions ───────────────────────────────────────────────────────────
-def ffmpeg_version() -> Optional[str]:
-    try:
-        p = subprocess.run([FFMPEG, "-version"], capture_output=True, text=True, check=False)
-        if p.returncode != 0:
-            return None
-        first = (p.stdout or "").splitlines()[:1]
-        return first[0].strip() if first else None
-    except Exception:
-        return None
+def _first_line(text: Optional[str]) -> Optional[str]:
+    first = (text or "").splitlines()[:1]
+    return first[0].strip() if first else None
 
 
-def ffprobe_version() -> Optional[str]:
-    try:
-        p = subprocess.run([FFPROBE, "-version"], capture_output=True, text=True, check=False)
-        if p.returncode != 0:
-            return None
-        first = (p.stdout or "").splitlines()[:1]
-        return first[0].strip() if first else None
-    except Exception:
-        return None
+def _parse_filters(text: Optional[str]) -> Set[str]:
+    names: Set[str] = set()
+    for line in (text or "").splitlines():
+        line = line.strip()
+        if not line or line.startswith(("#", "-", "Filters:")):
+            continue
+        parts = line.split()
+        if len(parts) >= 2:
+            cand = parts[1].strip()
+            if cand and all(ch.isalnum() or ch in "._-" for ch in cand):
+                names.add(cand)
+    return names
 
 
-# ── ffmpeg: filters (cached) ───────────────────────────────────────────
-_FFMPEG_FILTERS_CACHE: Optional[Set[str]] = None
+def _parse_encoders(text: Optional[str]) -> Set[str]:
+    # " V....D libx264   libx264 H.264 ..." — после строки "------"
+    names: Set[str] = set()
+    started = False
+    for line in (text or "").splitlines():
+        if not started:
+            started = line.strip().startswith("---")
+            continue
+        parts = line.split()
+        if len(parts) >= 2:
+            names.add(parts[1])
+    return names
 
 
-def ffmpeg_available_filters() -> Set[str]:
+def _parse_hwaccels(text: Optional[str]) -> List[str]:
+    lines = [ln.strip() for ln in (text or "").splitlines() if ln.strip()]
+    return [ln for ln in lines if not ln.endswith(":")]
+
+
+def _probe() -> Dict[str, Any]:
+    ffmpeg_out = _run_probe(FFMPEG, "-version")
+    ffprobe_out = _run_probe(FFPROBE, "-version")
+    ok = ffmpeg_out is not None and ffprobe_out is not None
+    return {
+        "ok": ok,
+        "ffmpeg_bin": FFMPEG,
+        "ffprobe_bin": FFPROBE,
+        "ffmpeg_version": _first_line(ffmpeg_out),
+        "ffprobe_version": _first_line(ffprobe_out),
+        "filters": _parse_filters(_run_probe(FFMPEG, "-hide_banner", "-filters")) if ok else set(),
+        "encoders": _parse_encoders(_run_probe(FFMPEG, "-hide_banner", "-encoders")) if ok else set(),
+        "hwaccels": _parse_hwaccels(_run_probe(FFMPEG, "-hide_banner", "-hwaccels")) if ok else [],
+        "probed_at": time.time(),
+    }
+
+
+def capabilities() -> Dict[str, Any]:
     """
-    Возвращает множество имён доступных видеофильтров ffmpeg.
-    Кешируется на время жизни процесса.
+    Закешированные возможности ffmpeg. Если probe_capabilities ещё не
+    вызывался (скрипты, тесты) — синхронная проба один раз.
     """
-    global _FFMPEG_FILTERS_CACHE
-    if _FFMPEG_FILTERS_CACHE is not None:
-        return _FFMPEG_FILTERS_CACHE
+    global _CAPS
+    if _CAPS is None:
+        _CAPS = _probe()
+    return _CAPS
 
-    try:
-        p = subprocess.run(
-            [FFMPEG, "-hide_banner", "-filters"],
-            capture_output=True,
-            text=True,
-            check=False,
-        )
-        names: Set[str] = set()
-        for line in (p.stdout or "").splitlines():
-            line = line.strip()
-            if not line or line.startswith(("#", "-", "Filters:")):
-                continue
-            parts = line.split()
-            if len(parts) >= 2:
-                cand = parts[1].strip()
-                if cand and all(ch.isalnum() or ch in "._-" for ch in cand):
-                    names.add(cand)
-
-        _FFMPEG_FILTERS_CACHE = names
-    except Exception:
-        _FFMPEG_FILTERS_CACHE = set()
 
-    return _FFMPEG_FILTERS_CACHE
+async def probe_capabilities() -> Dict[str, Any]:
+    """Проба при старте процесса — в потоке, не блокируя event loop."""
+    global _CAPS
+    if _CAPS is None:
+        _CAPS = await asyncio.to_thread(_probe)
+        print(f"[ffmpeg] ok={_CAPS['ok']} {_CAPS['ffmpeg_version'] or 'ffmpeg not found'}")
+    return _CAPS
+
+
+async def refresh_capabilities() -> Dict[str, Any]:
+    """Перепроверить (поставили/обновили ffmpeg без рестарта)."""
+    global _CAPS
+    _CAPS = await asyncio.to_thread(_probe)
+    print(f"[ffmpeg] refreshed ok={_CAPS['ok']} {_CAPS['ffmpeg_version'] or 'ffmpeg not found'}")
+    return _CAPS
+
+
+def has_ffmpeg() -> bool:
+    return bool(capabilities()["ok"])
+
+
+def ffmpeg_version() -> Optional[str]:
+    return capabilities()["ffmpeg_version"]
+
+
+def ffprobe_version() -> Optional[str]:
+    return capabilities()["ffprobe_version"]
+
+
+def ffmpeg_available_filters() -> Set[str]:
+    """Множество имён доступных фильтров ffmpeg (из кеша возможностей)."""
+    return capabilities()["filters"]
 
 
 def ffmpeg_has_filter(name: str) -> bool:
     return name in ffmpeg_available_filters()
 
 
+def ffmpeg_has_encoder(name: str) -> bool:
+    return name in capabilities()["encoders"]
+
+
+def ffmpeg_hwaccels() -> List[str]:
+    return list(capabilities()["hwaccels"])
+
+
+# ── async execution (не блокирует event loop) ──────────────────────────
+class FFmpegTimeoutError(RuntimeError):
+    pass
+
+
+class FFmpegBusyError(FFmpegTimeoutError):
+    """Слот ffmpeg не освободился за FFMPEG_QUEUE_WAIT_SEC."""
+
+
+# Две независимые квоты: короткие вызовы внутри запроса (кадр обложки,
+# watermark) не стоят в очереди за многоминутными транскодами воркера.
+LANE_INTERACTIVE = "interactive"
+LANE_JOBS = "jobs"
+
+_FFMPEG_SEMAPHORES: Dict[str, asyncio.Semaphore] = {}
+
+
+def _ffmpeg_semaphore(lane: str) -> asyncio.Semaphore:
+    sem = _FFMPEG_SEMAPHORES.get(lane)
+    if sem is None:
+        if lane == LANE_JOBS:
+            limit = settings.FFMPEG_MAX_CONCURRENCY
+        else:
+            limit = settings.FFMPEG_INTERACTIVE_CONCURRENCY
+        sem = _FFMPEG_SEMAPHORES[lane] = asyncio.Semaphore(max(1, limit))
+    return sem
+
+
+async def _kill_process(proc: asyncio.subprocess.Process) -> None:
+    if proc.returncode is not None:
+        return
+    try:
+        proc.kill()
+    except ProcessLookupError:
+        return
+    try:
+        await proc.wait()
+    except Exception:
+        pass
+
+
+async def run_ffmpeg(
+    cmd: List[str],
+    *,
+    timeout_sec: Optional[float] = None,
+    lane: str = LANE_INTERACTIVE,
+) -> subprocess.CompletedProcess:
+    """
+    Асинхронный запуск ffmpeg (или любого бинаря с тем же контрактом).
+    - lane=LANE_JOBS (задачи воркера): не более FFMPEG_MAX_CONCURRENCY
+      процессов на инстанс, ожидание слота не ограничено;
+    - lane=LANE_INTERACTIVE (внутри HTTP-запроса): своя квота
+      FFMPEG_INTERACTIVE_CONCURRENCY, слот ждём не дольше
+      FFMPEG_QUEUE_WAIT_SEC → FFmpegBusyError
+    - wall-clock лимит (FFMPEG_TIMEOUT_SEC по умолчанию) → FFmpegTimeoutError
+    - при отмене корутины дочерний процесс убивается
+    Возвращает CompletedProcess (как subprocess.run(..., capture_output=True, text=True)).
+    """
+    timeout = settings.FFMPEG_TIMEOUT_SEC if timeout_sec is None else timeout_sec
+    sem = _ffmpeg_semaphore(lane)
+    wait = settings.FFMPEG_QUEUE_WAIT_SEC if lane != LANE_JOBS else 0
+
+    try:
+        await asyncio.wait_for(sem.acquire(), timeout=wait if wait > 0 else None)
+    except asyncio.TimeoutError:
+        raise FFmpegBusyError(f"ffmpeg busy: no free slot within {wait}s") from None
+
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            out, err = await asyncio.wait_for(
+                proc.communicate(),
+                timeout=timeout if timeout and timeout > 0 else None,
+            )
+        except asyncio.TimeoutError:
+            await _kill_process(proc)
+            raise FFmpegTimeoutError(f"ffmpeg timed out after {timeout}s") from None
+        except BaseException:
+            # CancelledError (shutdown / отмена job) и прочее — не оставляем сироту
+            await _kill_process(proc)
+            raise
+    finally:
+        sem.release()
+
+    return subprocess.CompletedProcess(
+        cmd,
+        proc.returncode,
+        (out or b"").decode("utf-8", errors="replace"),
+        (err or b"").decode("utf-8", errors="replace"),
+    )
+
+
 # ── ffprobe ────────────────────────────────────────────────────────────
 def ffprobe_json(path: Path) -> Dict[str, Any]:
     cmd = [
@@ -141,23 +296,66 @@ def ffprobe_json(path: Path) -> Dict[str, Any]:
         raise RuntimeError(f"ffprobe parse error: {e}")
 
 
+async def ffprobe_json_async(target: str, *, timeout_sec: float = 30) -> Dict[str, Any]:
+    """
+    ffprobe как asyncio-подпроцесс (без семафора run_ffmpeg: проба короткая
+    и не должна стоять в очереди за транскодами). target — путь или
+    http(s)-URL: ffprobe читает только заголовки (moov у faststart-файлов)
+    range-запросами, без скачивания всего файла. Протоколы ограничены
+    -protocol_whitelist: для URL — только http(s), для пути — только file.
+    """
+    cmd = [FFPROBE, "-v", "error"]
+    # target бывает URL от клиента: плейлист (HLS/concat) не должен
+    # подтянуть вложенные входы по file:/pipe:/прочим протоколам
+    if target.startswith(("http://", "https://")):
+        cmd += ["-protocol_whitelist", "http,https,tcp,tls"]
+        cmd += ["-rw_timeout", str(int(timeout_sec * 1_000_000))]
+    else:
+        cmd += ["-protocol_whitelist", "file"]
+    cmd += ["-show_format", "-show_streams", "-of", "json", target]
+
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        out, err = await asyncio.wait_for(proc.communicate(), timeout=timeout_sec)
+    except asyncio.TimeoutError:
+        await _kill_process(proc)
+        raise RuntimeError(f"ffprobe timed out after {timeout_sec}s") from None
+    except BaseException:
+        await _kill_process(proc)
+        raise
+    if proc.returncode != 0:
+        raise RuntimeError((err or b"").decode("utf-8", errors="replace").strip() or "ffprobe failed")
+    try:
+        return json.loads(out or b"{}")
+    except Exception as e:
+        raise RuntimeError(f"ffprobe parse error: {e}")
+
+
 # ── diagnostics for /health ────────────────────────────────────────────
 def ffmpeg_diag() -> Dict[str, Any]:
     """
-    Удобный диагностический пакет:
+    Удобный диагностический пакет (из кеша, без запуска процессов):
     - доступность ffmpeg / ffprobe
     - пути до бинарей
     - версии
-    - наличие ключевых фильтров
+    - наличие ключевых фильтров и энкодеров, hwaccel-методы
     """
-    ok = has_ffmpeg()
-    key_filters = ["scale", "fps", "boxblur", "gblur", "vignette"]
-
+    caps = capabilities()
+    ok = caps["ok"]
     return {
         "ok": ok,
-        "ffmpeg_bin": FFMPEG,
-        "ffprobe_bin": FFPROBE,
-        "ffmpeg_version": ffmpeg_version(),
-        "ffprobe_version": ffprobe_version(),
-        "filters": {f: ffmpeg_has_filter(f) for f in key_filters} if ok else {},
+        "ffmpeg_bin": caps["ffmpeg_bin"],
+        "ffprobe_bin": caps["ffprobe_bin"],
+        "ffmpeg_version": caps["ffmpeg_version"],
+        "ffprobe_version": caps["ffprobe_version"],
+        "filters": {f: f in caps["filters"] for f in KEY_FILTERS} if ok else {},
+        "filters_total": len(caps["filters"]),
+        "encoders": {e: e in caps["encoders"] for e in KEY_ENCODERS} if ok else {},
+        "hwaccels": list(caps["hwaccels"]),
+        "probed_at": caps["probed_at"],
     }
@@ -6,6 +6,8 @@ from typing import Optional
 
 import httpx
 
+from http_client import UPSTREAM_DOWNLOAD, shared_client
+
 
 def uuid_name(prefix: str, ext: str) -> str:
     ext = ext if ext.startswith(".") else f".{ext}"
@@ -17,6 +19,26 @@ def ext_from_url(url: str, default: str = ".bin") -> str:
     return guess if guess else default
 
 
+SNIFF_BYTES = 32
+
+
+def sniff_media_type(head: bytes) -> Optional[str]:
+    """MIME по первым байтам файла (сигнатуры форматов, что принимает /uploads)."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:4] == b"RIFF" and head[8:12] == b"AVI ":
+        return "video/x-msvideo"
+    if head[4:8] == b"ftyp":
+        return "video/quicktime" if head[8:10] == b"qt" else "video/mp4"
+    if head[:4] in (b"\x00\x00\x01\xba", b"\x00\x00\x01\xb3"):
+        return "video/mpeg"
+    return None
+
+
 def public_url(local_path: Path, static_dir: Path) -> str:
     rel = local_path.relative_to(static_dir).as_posix()
     return f"/static/{rel}"
@@ -36,6 +58,23 @@ async def download_to(
     - atomic write: сначала во временный .part, затем replace()
     - max_bytes: защита от огромных файлов
     """
+    await fetch_to(url, dst_path, timeout_sec=timeout_sec, max_bytes=max_bytes, headers=headers)
+    return dst_path
+
+
+async def fetch_to(
+    url: str,
+    dst_path: Path,
+    *,
+    timeout_sec: float = 120,
+    max_bytes: int = 200 * 1024 * 1024,
+    headers: Optional[dict] = None,
+) -> Optional[httpx.Headers]:
+    """
+    Как download_to, но возвращает заголовки ответа (ETag, Last-Modified...).
+    На условный запрос (If-None-Match / If-Modified-Since в headers) сервер
+    может ответить 304 — тогда файл не трогаем и возвращаем None.
+    """
     dst_path.parent.mkdir(parents=True, exist_ok=True)
 
     base_headers = {
@@ -45,12 +84,14 @@ async def download_to(
     if headers:
         base_headers.update(headers)
 
-    tmp_path = dst_path.with_suffix(dst_path.suffix + ".part")
+    tmp_path = dst_path.with_suffix(dst_path.suffix + f".{uuid.uuid4().hex[:8]}.part")
 
     timeout = httpx.Timeout(connect=10, read=timeout_sec, write=timeout_sec, pool=timeout_sec)
 
-    async with httpx.AsyncClient(timeout=timeout, headers=base_headers, follow_redirects=True) as client:
-        async with client.stream("GET", url) as r:
+    async with shared_client(UPSTREAM_DOWNLOAD) as client:
+        async with client.stream("GET", url, headers=base_headers, timeout=timeout) as r:
+            if r.status_code == 304:
+                return None
             try:
                 r.raise_for_status()
             except httpx.HTTPStatusError as e:
@@ -69,19 +110,19 @@ async def download_to(
                     pass
 
             written = 0
-            with tmp_path.open("wb") as f:
-                async for chunk in r.aiter_bytes():
-                    if not chunk:
-                        continue
-                    written += len(chunk)
-                    if written > max_bytes:
-                        try:
-                            f.close()
-                        finally:
-                            if tmp_path.exists():
-                                tmp_path.unlink(missing_ok=True)
-                        raise RuntimeError(f"Download too large: exceeded {max_bytes} bytes")
-                    f.write(chunk)
+            try:
+                with tmp_path.open("wb") as f:
+                    async for chunk in r.aiter_bytes():
+                        if not chunk:
+                            continue
+                        written += len(chunk)
+                        if written > max_bytes:
+                            raise RuntimeError(f"Download too large: exceeded {max_bytes} bytes")
+                        f.write(chunk)
+            except BaseException:
+                tmp_path.unlink(missing_ok=True)
+                raise
+            response_headers = r.headers
 
     tmp_path.replace(dst_path)
-    return dst_path
+    return response_headers
@@ -1,9 +1,12 @@
 # health_router.py
 from fastapi import APIRouter
 
+from ffmpeg_utils import ffmpeg_diag
+from image_ops import image_pool_stats
+
 router = APIRouter()
 
 
 @router.get("/health")
 def health():
-    return {"ok": True}
+    return {"ok": True, "ffmpeg": ffmpeg_diag(), "image_pool": image_pool_stats()}
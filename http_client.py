@@ -1,7 +1,16 @@
 import asyncio
+import hashlib
+import json
 import random
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
 import httpx
 
+from config import settings
+
 # Единый дефолтный timeout для всех запросов
 DEFAULT_TIMEOUT = httpx.Timeout(
     connect=10,
@@ -79,3 +88,295 @@ class RetryClient(httpx.AsyncClient):
         return await self.request(
             "DELETE", url, retries=retries, backoff=backoff, **kwargs
         )
+
+
+# ── Graph API: учёт лимитов Meta ───────────────────────────────────────
+# Meta отдаёт загрузку квоты в заголовках X-App-Usage (на приложение) и
+# X-Business-Use-Case-Usage (на бизнес-объект, т.е. на IG-аккаунт), в процентах.
+# Бюджет держим в Redis (общий для всех реплик): начиная с
+# GRAPH_USAGE_SLOWDOWN_PCT запросы притормаживаются, на 100% и после
+# троттлинга (429 / коды 4, 17, 32, 613, 800xx) scope блокируется до
+# Retry-After / estimated_time_to_regain_access. Scope аккаунта — хэш токена:
+# каждый IG-аккаунт ходит со своим токеном.
+GRAPH_THROTTLE_CODES = {4, 17, 32, 613}
+GRAPH_BUC_THROTTLE_CODES = range(80000, 80015)
+
+_APP_SCOPE = "app"
+_local_usage: Dict[str, Tuple[float, float, float]] = {}  # scope -> (usage_pct, blocked_until, synced_at)
+
+
+def _scope_for_token(token: Optional[str]) -> Optional[str]:
+    if not token:
+        return None
+    return "acct:" + hashlib.sha1(token.encode()).hexdigest()[:16]
+
+
+def _token_from_request(url: str, kwargs: Dict[str, Any]) -> Optional[str]:
+    for key in ("params", "data"):
+        src = kwargs.get(key)
+        if isinstance(src, dict) and src.get("access_token"):
+            return str(src["access_token"])
+    qs = parse_qs(urlsplit(str(url)).query)
+    return (qs.get("access_token") or [None])[0]
+
+
+def _usage_pct(block: Any) -> float:
+    if not isinstance(block, dict):
+        return 0.0
+    vals = [block.get(k) for k in ("call_count", "total_cputime", "total_time")]
+    return float(max([v for v in vals if isinstance(v, (int, float))] or [0]))
+
+
+def _parse_usage(resp: httpx.Response) -> Tuple[Optional[float], Optional[float], float]:
+    """(app_pct, account_pct, regain_sec) из заголовков ответа Graph API."""
+    app_pct = acct_pct = None
+    regain = 0.0
+    raw = resp.headers.get("X-App-Usage")
+    if raw:
+        try:
+            app_pct = _usage_pct(json.loads(raw))
+        except ValueError:
+            pass
+    raw = resp.headers.get("X-Business-Use-Case-Usage")
+    if raw:
+        try:
+            for entries in json.loads(raw).values():
+                for entry in entries or []:
+                    acct_pct = max(acct_pct or 0.0, _usage_pct(entry))
+                    minutes = entry.get("estimated_time_to_regain_access") or 0
+                    regain = max(regain, float(minutes) * 60)
+        except (ValueError, AttributeError):
+            pass
+    return app_pct, acct_pct, regain
+
+
+def _throttle_code(resp: httpx.Response) -> Optional[int]:
+    if resp.status_code == 429:
+        return 429
+    if resp.status_code < 400:
+        return None
+    try:
+        code = int((resp.json().get("error") or {}).get("code"))
+    except Exception:
+        return None
+    if code in GRAPH_THROTTLE_CODES or code in GRAPH_BUC_THROTTLE_CODES:
+        return code
+    return None
+
+
+def _usage_key(scope: str) -> str:
+    return f"{settings.REDIS_PREFIX}:graph:usage:{scope}"
+
+
+def _blocked_key(scope: str) -> str:
+    return f"{settings.REDIS_PREFIX}:graph:blocked:{scope}"
+
+
+async def _redis():
+    # импорт здесь: jobs → config, без циклов, но http_client нужен и без Redis
+    from jobs import get_redis
+
+    return await get_redis()
+
+
+async def _load_scopes(scopes: List[str]) -> Dict[str, Tuple[float, float]]:
+    """(usage_pct, blocked_until) по scope: локальный снимок, раз в GRAPH_USAGE_SYNC_SEC — из Redis."""
+    now = time.time()
+    out: Dict[str, Tuple[float, float]] = {}
+    stale = []
+    for scope in scopes:
+        usage, blocked, synced = _local_usage.get(scope, (0.0, 0.0, 0.0))
+        out[scope] = (usage, blocked)
+        if now - synced >= settings.GRAPH_USAGE_SYNC_SEC:
+            stale.append(scope)
+    if not stale:
+        return out
+    try:
+        r = await _redis()
+        values = await r.mget([k for sc in stale for k in (_usage_key(sc), _blocked_key(sc))])
+    except Exception:
+        return out  # без Redis — только локальный учёт этого процесса
+    for n, scope in enumerate(stale):
+        usage = float(values[2 * n] or 0)
+        blocked = max(float(values[2 * n + 1] or 0), _local_usage.get(scope, (0, 0, 0))[1])
+        _local_usage[scope] = (usage, blocked, now)
+        out[scope] = (usage, blocked)
+    return out
+
+
+async def _store_scope(scope: str, usage: Optional[float], block_sec: float) -> None:
+    now = time.time()
+    old_usage, old_blocked, synced = _local_usage.get(scope, (0.0, 0.0, 0.0))
+    blocked_until = max(old_blocked, now + block_sec) if block_sec > 0 else old_blocked
+    _local_usage[scope] = (old_usage if usage is None else usage, blocked_until, synced)
+    try:
+        r = await _redis()
+        async with r.pipeline(transaction=False) as pipe:
+            if usage is not None:
+                pipe.set(_usage_key(scope), f"{usage:.1f}", ex=settings.GRAPH_USAGE_TTL_SEC)
+            if block_sec > 0:
+                pipe.set(_blocked_key(scope), f"{blocked_until:.3f}", ex=max(1, int(block_sec) + 1))
+            await pipe.execute()
+    except Exception:
+        pass
+
+
+def _pacing_delay(usage: float) -> float:
+    """0 до GRAPH_USAGE_SLOWDOWN_PCT, дальше линейно до GRAPH_USAGE_MAX_DELAY_SEC на 100%."""
+    start = settings.GRAPH_USAGE_SLOWDOWN_PCT
+    if usage < start:
+        return 0.0
+    frac = min(1.0, (usage - start) / max(1.0, 100.0 - start))
+    return frac * settings.GRAPH_USAGE_MAX_DELAY_SEC
+
+
+def _throttled_response(request: httpx.Request, wait: float) -> httpx.Response:
+    """Ответ в формате ошибки Graph — вызывающий код обрабатывает его как обычный отказ Meta."""
+    return httpx.Response(
+        429,
+        headers={"Retry-After": str(int(wait) + 1)},
+        json={
+            "error": {
+                "message": f"Graph API rate limit: paused for {int(wait) + 1}s",
+                "type": "OAuthException",
+                "code": 4,
+            }
+        },
+        request=request,
+    )
+
+
+class GraphClient(RetryClient):
+    """
+    RetryClient для Graph API, который соблюдает лимиты Meta:
+    притормаживает по X-App-Usage / X-Business-Use-Case-Usage, ждёт
+    заблокированный scope (если недолго) и повторяет троттлинг-ответы
+    с задержкой из Retry-After / estimated_time_to_regain_access.
+    Ожидание дольше GRAPH_THROTTLE_MAX_WAIT_SEC не делаем — сразу 429.
+    """
+
+    async def request(self, method: str, url: str, *args, **kwargs):
+        scopes = [_APP_SCOPE]
+        acct = _scope_for_token(_token_from_request(url, kwargs))
+        if acct:
+            scopes.append(acct)
+
+        throttle_retries = settings.GRAPH_THROTTLE_RETRIES
+        attempt = 0
+        while True:
+            state = await _load_scopes(scopes)
+            now = time.time()
+            wait = max(
+                max(blocked - now for _usage, blocked in state.values()),
+                max(_pacing_delay(usage) for usage, _blocked in state.values()),
+                0.0,
+            )
+            if wait > settings.GRAPH_THROTTLE_MAX_WAIT_SEC:
+                return _throttled_response(self.build_request(method, url), wait)
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            resp = await super().request(method, url, *args, **kwargs)
+
+            app_pct, acct_pct, regain = _parse_usage(resp)
+            code = _throttle_code(resp)
+            block = 0.0
+            if code is not None:
+                retry_after = resp.headers.get("Retry-After")
+                block = max(
+                    regain,
+                    float(retry_after) if retry_after and retry_after.isdigit() else 0.0,
+                    settings.GRAPH_THROTTLE_BASE_SEC * (2 ** attempt),
+                )
+                print(f"[graph] throttled code={code} wait={block:.1f}s {method} {urlsplit(str(url)).path}")
+            elif (acct_pct or 0) >= 100 or (app_pct or 0) >= 100:
+                block = max(regain, settings.GRAPH_THROTTLE_BASE_SEC)
+
+            # код 4 и исчерпанный X-App-Usage — лимит приложения, остальное — аккаунта
+            app_block = acct_block = 0.0
+            if block:
+                if code == 4 or (app_pct or 0) >= 100 or not acct:
+                    app_block = block
+                else:
+                    acct_block = block
+            if app_pct is not None or app_block:
+                await _store_scope(_APP_SCOPE, app_pct, app_block)
+            if acct and (acct_pct is not None or acct_block):
+                await _store_scope(acct, acct_pct, acct_block)
+
+            if code is None or attempt >= throttle_retries or block > settings.GRAPH_THROTTLE_MAX_WAIT_SEC:
+                return resp
+            attempt += 1
+
+
+# ── Общие пулы соединений по upstream ───────────────────────────────────
+# Один долгоживущий клиент на сервис: TCP/TLS-соединения к graph.facebook.com,
+# api.cloudinary.com и AI-провайдерам переиспользуются между запросами
+# (keep-alive), а не открываются заново на каждый вызов.
+# graph — GraphClient (повторы сетевых ошибок + лимиты Meta, см. выше);
+# cloudinary/ai — без автоматических повторов: upload и генерация не идемпотентны.
+UPSTREAM_GRAPH = "graph"
+UPSTREAM_CLOUDINARY = "cloudinary"
+UPSTREAM_AI = "ai"
+UPSTREAM_DOWNLOAD = "download"
+UPSTREAMS = (UPSTREAM_GRAPH, UPSTREAM_CLOUDINARY, UPSTREAM_AI, UPSTREAM_DOWNLOAD)
+
+_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def _http2_enabled() -> bool:
+    """HTTP/2 только если включён в настройках и установлен пакет h2 (httpx[http2])."""
+    if not settings.HTTP2_ENABLED:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY_SEC,
+    )
+
+
+def get_client(name: str) -> httpx.AsyncClient:
+    """Общий клиент upstream'а; создаётся при первом обращении (или в init_clients)."""
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        cls = GraphClient if name == UPSTREAM_GRAPH else httpx.AsyncClient
+        client = cls(
+            timeout=DEFAULT_TIMEOUT,
+            limits=_limits(),
+            http2=_http2_enabled(),
+            follow_redirects=name == UPSTREAM_DOWNLOAD,
+        )
+        _clients[name] = client
+    return client
+
+
+@asynccontextmanager
+async def shared_client(name: str = UPSTREAM_GRAPH) -> AsyncIterator[httpx.AsyncClient]:
+    """
+    Замена `async with RetryClient() as client` в роутерах/сервисах:
+    отдаёт общий клиент и НЕ закрывает его на выходе.
+    """
+    yield get_client(name)
+
+
+def init_clients() -> None:
+    for name in UPSTREAMS:
+        get_client(name)
+
+
+async def close_clients() -> None:
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        try:
+            await client.aclose()
+        except Exception:
+            pass
@@ -0,0 +1,232 @@
+# image_ops.py
+"""
+Pillow-операции вне event loop.
+
+Сами операции — обычные функции над путями (открыть → обработать →
+сохранить JPEG), поэтому их можно отдать и в потоки, и в процессы:
+- IMAGE_POOL_PROCESSES > 0 — ProcessPoolExecutor (тяжёлые resize/blur
+  масштабируются по ядрам без GIL);
+- иначе ThreadPoolExecutor на IMAGE_POOL_THREADS потоков (0 — по числу
+  ядер): Pillow отпускает GIL в resize/фильтрах/кодеке.
+Очередь ограничена IMAGE_POOL_MAX_PENDING: сверх — ImagePoolBusy (→ 429),
+чтобы запросы не копились без конца. Время операций — image_pool_stats().
+"""
+import asyncio
+import os
+import textwrap
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from config import settings
+
+try:
+    from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageEnhance
+except Exception:
+    Image = None  # type: ignore
+    ImageDraw = None  # type: ignore
+    ImageFont = None  # type: ignore
+    ImageFilter = None  # type: ignore
+    ImageEnhance = None  # type: ignore
+
+# Pillow 10+ resampling constant (если Image доступен)
+try:
+    RESAMPLE_LANCZOS = Image.Resampling.LANCZOS  # type: ignore[attr-defined]
+except Exception:
+    RESAMPLE_LANCZOS = getattr(Image, "LANCZOS", getattr(Image, "BICUBIC", 3)) if Image else None
+
+
+class ImagePoolBusy(RuntimeError):
+    pass
+
+
+# ── операции (выполняются в пуле) ──────────────────────────────────────
+def _require_pil() -> None:
+    if Image is None:
+        raise RuntimeError("Pillow (PIL) is not installed. Install pillow.")
+
+
+def _save_rgb(img, dst: str, quality: int) -> None:
+    img.convert("RGB").save(dst, format="JPEG", quality=quality, optimize=True, progressive=True)
+
+
+def resize_image(src: str, dst: str, aspect: float, max_width: int, fit: str, background: str) -> None:
+    _require_pil()
+    img = Image.open(src).convert("RGBA")  # type: ignore
+    tw = max_width
+    th = int(round(tw / aspect))
+
+    if fit == "contain":
+        if isinstance(background, str) and background.lower() == "blur":
+            bg = img.copy().resize((tw, th), RESAMPLE_LANCZOS).filter(ImageFilter.GaussianBlur(radius=24))  # type: ignore
+            canvas = bg.convert("RGBA")
+        else:
+            try:
+                canvas = Image.new("RGBA", (tw, th), background)  # type: ignore
+            except Exception:
+                canvas = Image.new("RGBA", (tw, th), "black")  # type: ignore
+
+        img_ratio = img.width / img.height
+        if img_ratio > aspect:
+            nw = tw
+            nh = int(round(nw / img_ratio))
+        else:
+            nh = th
+            nw = int(round(nh * img_ratio))
+
+        img_res = img.resize((nw, nh), RESAMPLE_LANCZOS)
+        canvas.paste(img_res, ((tw - nw) // 2, (th - nh) // 2), img_res)
+        _save_rgb(canvas, dst, quality=90)
+        return
+
+    # cover
+    img_ratio = img.width / img.height
+    if img_ratio > aspect:
+        new_w = int(round(img.height * aspect))
+        left = (img.width - new_w) // 2
+        box = (left, 0, left + new_w, img.height)
+    else:
+        new_h = int(round(img.width / aspect))
+        top = (img.height - new_h) // 2
+        box = (0, top, img.width, top + new_h)
+    _save_rgb(img.crop(box).resize((tw, th), RESAMPLE_LANCZOS), dst, quality=92)
+
+
+def filter_image(src: str, dst: str, preset: str, k: float) -> None:
+    _require_pil()
+    img = Image.open(src).convert("RGB")  # type: ignore
+    if preset in ("b&w", "bw", "mono", "blackwhite"):
+        out_img = img.convert("L").convert("RGB")
+    else:
+        out_img = ImageEnhance.Contrast(img).enhance(1 + 0.12 * k)  # type: ignore
+        out_img = ImageEnhance.Color(out_img).enhance(1 + 0.10 * k)  # type: ignore
+        out_img = out_img.filter(ImageFilter.GaussianBlur(radius=0.3 * k))  # type: ignore
+    out_img.save(dst, quality=92, optimize=True, progressive=True)
+
+
+def watermark_image(src: str, logo: str, dst: str, position: str, opacity: float, margin: int) -> None:
+    _require_pil()
+    base = Image.open(src).convert("RGBA")  # type: ignore
+    mark = Image.open(logo).convert("RGBA")  # type: ignore
+
+    target_w = max(64, base.width // 6)
+    ratio = target_w / mark.width
+    mark = mark.resize((target_w, int(mark.height * ratio)), RESAMPLE_LANCZOS)
+
+    if opacity < 1.0:
+        alpha = mark.split()[-1].point(lambda p: int(p * opacity))
+        mark.putalpha(alpha)
+
+    if position in ("tr", "rt"):
+        x, y = base.width - mark.width - margin, margin
+    elif position in ("tl", "lt"):
+        x, y = margin, margin
+    elif position in ("bl", "lb"):
+        x, y = margin, base.height - mark.height - margin
+    else:
+        x, y = base.width - mark.width - margin, base.height - mark.height - margin
+
+    base.paste(mark, (x, y), mark)
+    _save_rgb(base, dst, quality=92)
+
+
+def cover_overlay(frame: str, dst: str, overlay: Dict[str, Any]) -> None:
+    _require_pil()
+    img = Image.open(frame).convert("RGBA")  # type: ignore
+    draw = ImageDraw.Draw(img)  # type: ignore
+    text = overlay.get("text") or ""
+    pos = overlay.get("pos") or "bottom"
+    padding = int(overlay.get("padding") or 32)
+
+    if text:
+        wrapped = textwrap.fill(text, width=20)
+        font = ImageFont.load_default()  # type: ignore
+        bbox = draw.multiline_textbbox((0, 0), wrapped, font=font, spacing=4, align="left")  # type: ignore
+        tw, th = bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+        xy = (padding, img.height - th - padding) if pos == "bottom" else (padding, padding)
+        bg = Image.new("RGBA", (tw + padding * 2, th + padding * 2), (0, 0, 0, 160))  # type: ignore
+        img.paste(bg, (xy[0] - padding, xy[1] - padding), bg)
+        draw.multiline_text(xy, wrapped, font=font, fill=(255, 255, 255, 255), spacing=4)  # type: ignore
+
+    _save_rgb(img, dst, quality=92)
+
+
+# ── пул ─────────────────────────────────────────────────────────────────
+_executor: Optional[Executor] = None
+_pending = 0
+_stats: Dict[str, Dict[str, float]] = {}
+_SLOW_OP_MS = 2000
+
+
+def _pool_size() -> int:
+    if settings.IMAGE_POOL_PROCESSES > 0:
+        return settings.IMAGE_POOL_PROCESSES
+    return settings.IMAGE_POOL_THREADS or (os.cpu_count() or 2)
+
+
+def _get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if settings.IMAGE_POOL_PROCESSES > 0:
+            _executor = ProcessPoolExecutor(max_workers=_pool_size())
+        else:
+            _executor = ThreadPoolExecutor(max_workers=_pool_size(), thread_name_prefix="image-ops")
+    return _executor
+
+
+def _record(op: str, elapsed_ms: float, ok: bool) -> None:
+    st = _stats.setdefault(op, {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+    st["count"] += 1
+    st["errors"] += 0 if ok else 1
+    st["total_ms"] += elapsed_ms
+    st["max_ms"] = max(st["max_ms"], elapsed_ms)
+
+
+async def run_image_op(func: Callable[..., Any], *args: Any) -> Any:
+    """
+    Выполнить операцию в пуле. ImagePoolBusy — если в очереди уже
+    IMAGE_POOL_MAX_PENDING операций (вызывающий отвечает 429).
+    """
+    global _pending
+    if _pending >= max(1, settings.IMAGE_POOL_MAX_PENDING):
+        raise ImagePoolBusy(f"Image workers are busy ({_pending} pending)")
+    _pending += 1
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(_get_executor(), func, *args)
+        ok = True
+        return result
+    finally:
+        _pending -= 1
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        _record(func.__name__, elapsed_ms, ok)
+        # тайминги всех операций — в _stats (/health); в лог только сбои и медленные
+        if not ok or elapsed_ms >= _SLOW_OP_MS:
+            print(f"[image_ops] op={func.__name__} ms={elapsed_ms:.0f} ok={ok}")
+
+
+def image_pool_stats() -> Dict[str, Any]:
+    return {
+        "kind": "process" if settings.IMAGE_POOL_PROCESSES > 0 else "thread",
+        "workers": _pool_size(),
+        "pending": _pending,
+        "max_pending": settings.IMAGE_POOL_MAX_PENDING,
+        "ops": {
+            op: {
+                "count": int(st["count"]),
+                "errors": int(st["errors"]),
+                "avg_ms": round(st["total_ms"] / st["count"], 1) if st["count"] else 0.0,
+                "max_ms": round(st["max_ms"], 1),
+            }
+            for op, st in _stats.items()
+        },
+    }
+
+
+def shutdown_image_pool() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
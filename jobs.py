@@ -1,7 +1,12 @@
 # jobs.py
+import asyncio
 import json
+import os
+import random
+import socket
 import time
-from typing import Any, Dict, Optional
+import uuid
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple
 
 import redis.asyncio as redis
 
@@ -11,16 +16,92 @@ PENDING = "PENDING"
 RUNNING = "RUNNING"
 DONE = "DONE"
 ERROR = "ERROR"
+TERMINAL_STATUSES = (DONE, ERROR)
 
 
 def _job_key(job_id: str) -> str:
     return f"{settings.REDIS_PREFIX}:job:{job_id}"
 
 
+def _job_channel(job_id: str) -> str:
+    """Pub/sub канал переходов статуса задачи."""
+    return f"{settings.REDIS_PREFIX}:job_events:{job_id}"
+
+
+# Запись задачи — Redis hash. Мелкие поля читаются/пишутся по отдельности,
+# payload/result лежат JSON-строками и загружаются только по запросу.
+# partial:<key> — промежуточные результаты длинных задач (avatar_batch).
+JOB_STATUS_FIELDS = (
+    "job_id", "kind", "status", "stage", "error", "progress", "attempts", "created_at", "updated_at",
+)
+_JSON_FIELDS = {"payload", "result", "progress"}
+_EVENT_EXCLUDED_FIELDS = {"payload", "result"}
+_PARTIAL_PREFIX = "partial:"
+_FLOAT_FIELDS = {"created_at", "updated_at", "enqueued_at"}
+_INT_FIELDS = {"attempts"}
+
+# HSET + EXPIRE + PUBLISH одной командой и только если запись ещё существует.
+# ARGV: ttl, channel, event, field1, value1, ...
+_UPDATE_JOB_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 4))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('PUBLISH', ARGV[2], ARGV[3])
+return 1
+"""
+
+_INCR_ATTEMPTS_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  return 0
+end
+return redis.call('HINCRBY', KEYS[1], 'attempts', 1)
+"""
+
+
+def _encode_job_fields(data: Dict[str, Any]) -> Dict[str, str]:
+    out: Dict[str, str] = {}
+    for k, v in data.items():
+        if k in _JSON_FIELDS or k.startswith(_PARTIAL_PREFIX):
+            out[k] = json.dumps(v)
+        elif v is not None:
+            out[k] = str(v)
+    return out
+
+
+def _decode_job_field(name: str, raw: Optional[str]) -> Any:
+    if raw is None:
+        return None
+    if name in _JSON_FIELDS or name.startswith(_PARTIAL_PREFIX):
+        return json.loads(raw)
+    if name in _FLOAT_FIELDS:
+        return float(raw)
+    if name in _INT_FIELDS:
+        return int(raw)
+    return raw
+
+
 def _now() -> float:
     return time.time()
 
 
+# ── reliable queue: идентификатор процесса-воркера и его ключи ──────────
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+def _processing_key(worker_id: str = WORKER_ID) -> str:
+    return f"{settings.REDIS_QUEUE}:processing:{worker_id}"
+
+
+def _heartbeat_key(worker_id: str = WORKER_ID) -> str:
+    return f"{settings.REDIS_PREFIX}:worker:{worker_id}"
+
+
+def _dead_letter_key() -> str:
+    return f"{settings.REDIS_QUEUE}:dead"
+
+
 _redis: Optional[redis.Redis] = None
 
 
@@ -36,14 +117,31 @@ async def get_redis() -> redis.Redis:
 async def close_redis() -> None:
     """
     Корректно закрывает Redis-подключение (на shutdown).
+    Перед этим гасит heartbeat воркера: незавершённые задачи из его
+    processing-списка сразу подберёт reaper другого процесса.
     """
     global _redis
     if _redis is None:
         return
     try:
+        await _stop_heartbeat()
         await _redis.aclose()
     finally:
         _redis = None
+        _scripts.clear()
+
+
+_scripts: Dict[str, Any] = {}
+
+
+async def redis_script(source: str):
+    """register_script кешируем на клиент: дальше EVALSHA без пересылки текста."""
+    script = _scripts.get(source)
+    if script is None:
+        r = await get_redis()
+        script = r.register_script(source)
+        _scripts[source] = script
+    return script
 
 
 async def create_job(kind: str, payload: Dict[str, Any]) -> Dict[str, Any]:
@@ -51,30 +149,55 @@ async def create_job(kind: str, payload: Dict[str, Any]) -> Dict[str, Any]:
 
     job_id = payload.get("job_id")
     if not job_id:
-        import uuid
         job_id = uuid.uuid4().hex
 
     data = {
         "job_id": job_id,
         "kind": kind,
+        "user_id": payload.get("user_id"),
         "status": PENDING,
         "stage": "queued",
         "payload": payload,
         "result": None,
         "error": None,
+        "attempts": 0,
         "created_at": _now(),
         "updated_at": _now(),
     }
-    await r.set(_job_key(job_id), json.dumps(data), ex=settings.JOB_TTL_SECONDS)
+    key = _job_key(job_id)
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.delete(key)
+        pipe.hset(key, mapping=_encode_job_fields(data))
+        pipe.expire(key, settings.JOB_TTL_SECONDS)
+        await pipe.execute()
     return data
 
 
-async def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+async def get_job(job_id: str, fields: Optional[Iterable[str]] = None) -> Optional[Dict[str, Any]]:
+    """
+    fields=None — вся запись (HGETALL, включая payload/result);
+    иначе только перечисленные поля (HMGET), напр. JOB_STATUS_FIELDS для поллинга.
+    """
     r = await get_redis()
-    raw = await r.get(_job_key(job_id))
-    if not raw:
+    key = _job_key(job_id)
+    if fields is None:
+        raw = await r.hgetall(key)
+        if not raw:
+            return None
+        data = {k: _decode_job_field(k, v) for k, v in raw.items()}
+        data.setdefault("result", None)
+        data.setdefault("error", None)
+        return data
+
+    names: List[str] = list(fields)
+    values = await r.hmget(key, names)
+    if all(v is None for v in values):
         return None
-    return json.loads(raw)
+    return {k: _decode_job_field(k, v) for k, v in zip(names, values)}
+
+
+async def get_job_status(job_id: str) -> Optional[Dict[str, Any]]:
+    return await get_job(job_id, fields=JOB_STATUS_FIELDS)
 
 
 async def update_job_status(
@@ -84,43 +207,550 @@ async def update_job_status(
     result: Optional[Dict[str, Any]] = None,
     error: Optional[str] = None,
     stage: Optional[str] = None,
+    progress: Optional[Dict[str, Any]] = None,
+    partial: Optional[Dict[str, Any]] = None,
 ) -> Optional[Dict[str, Any]]:
-    r = await get_redis()
-    key = _job_key(job_id)
-
-    raw = await r.get(key)
-    if not raw:
-        return None
-
-    data = json.loads(raw)
-    data["status"] = status
-    data["updated_at"] = _now()
+    """
+    Атомарно обновляет только переданные поля (Lua: HSET + EXPIRE) и
+    публикует переход в _job_channel (без result — он читается отдельно).
+    progress — {"completed": n, "total": m}; partial — {key: value},
+    пишется полями partial:<key> (см. get_job_partials).
+    Возвращает записанные поля или None, если задачи уже нет.
+    """
+    changes: Dict[str, Any] = {"status": status, "updated_at": _now()}
     if stage is not None:
-        data["stage"] = stage
+        changes["stage"] = stage
     if result is not None:
-        data["result"] = result
+        changes["result"] = result
     if error is not None:
-        data["error"] = error
+        changes["error"] = error
+    if progress is not None:
+        changes["progress"] = progress
 
-    await r.set(key, json.dumps(data), ex=settings.JOB_TTL_SECONDS)
-    return data
+    event = {"job_id": job_id, **{k: v for k, v in changes.items() if k not in _EVENT_EXCLUDED_FIELDS}}
+    fields = dict(changes)
+    for k, v in (partial or {}).items():
+        fields[f"{_PARTIAL_PREFIX}{k}"] = v
+    args: List[Any] = [settings.JOB_TTL_SECONDS, _job_channel(job_id), json.dumps(event)]
+    for k, v in _encode_job_fields(fields).items():
+        args += [k, v]
+
+    script = await redis_script(_UPDATE_JOB_LUA)
+    if not await script(keys=[_job_key(job_id)], args=args):
+        return None
+    return {"job_id": job_id, **changes}
+
+
+# Только поле progress, без смены status/stage и без события в канал задачи.
+_SET_PROGRESS_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  return 0
+end
+redis.call('HSET', KEYS[1], 'progress', ARGV[1])
+return 1
+"""
+
+
+async def set_job_progress(job_id: str, progress: Dict[str, Any]) -> bool:
+    """
+    Обновить progress задачи, не трогая status/stage и не публикуя переход:
+    для работы после завершения задачи (загрузка её результата в flow).
+    """
+    script = await redis_script(_SET_PROGRESS_LUA)
+    return bool(await script(keys=[_job_key(job_id)], args=[json.dumps(progress)]))
+
+
+async def get_job_partials(job_id: str) -> Dict[str, Any]:
+    """Промежуточные результаты задачи: {key: value} из полей partial:<key>."""
+    r = await get_redis()
+    out: Dict[str, Any] = {}
+    async for name, raw in r.hscan_iter(_job_key(job_id), match=f"{_PARTIAL_PREFIX}*"):
+        out[name[len(_PARTIAL_PREFIX):]] = json.loads(raw)
+    return out
+
+
+# --- Push-уведомления о статусе ---
+async def iter_job_events(
+    job_id: str,
+    *,
+    timeout: Optional[float] = None,
+    keepalive_sec: Optional[float] = None,
+) -> AsyncIterator[Optional[Dict[str, Any]]]:
+    """
+    Подписывается на переходы задачи и отдаёт статус-поля:
+    сначала текущее состояние, затем каждое изменение, до DONE/ERROR
+    (при DONE — вместе с result) или до timeout.
+    keepalive_sec: раз в столько секунд без событий отдаёт None (для SSE-пингов).
+    Pub/sub не гарантирует доставку, поэтому при тишине статус перечитывается
+    раз в JOB_EVENTS_RECHECK_SEC.
+    """
+    r = await get_redis()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout if timeout is not None else None
+    recheck = max(1.0, float(settings.JOB_EVENTS_RECHECK_SEC))
+
+    pubsub = r.pubsub()
+    await pubsub.subscribe(_job_channel(job_id))
+    try:
+        # статус читаем ПОСЛЕ подписки, чтобы не пропустить переход между ними
+        job = await get_job_status(job_id)
+        if job is None:
+            return
+        last_seen = loop.time()
+        while True:
+            if job.get("status") in TERMINAL_STATUSES:
+                if job.get("status") == DONE:
+                    job["result"] = ((await get_job(job_id, fields=("result",))) or {}).get("result")
+                yield job
+                return
+            yield job
+
+            changed = False
+            while not changed:
+                now = loop.time()
+                if deadline is not None and now >= deadline:
+                    return
+                wait = recheck
+                if keepalive_sec:
+                    wait = min(wait, keepalive_sec)
+                if deadline is not None:
+                    wait = min(wait, deadline - now)
+                msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=wait)
+                if msg is not None:
+                    job = {**job, **json.loads(msg["data"])}
+                    changed = True
+                elif loop.time() - last_seen >= recheck:
+                    fresh = await get_job_status(job_id)
+                    if fresh is None:
+                        return
+                    changed = fresh.get("status") != job.get("status") or fresh.get("stage") != job.get("stage")
+                    job = fresh
+                    last_seen = loop.time()
+                elif keepalive_sec:
+                    yield None
+            last_seen = loop.time()
+    finally:
+        try:
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
+        except Exception:
+            pass
+
+
+async def wait_for_job(job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+    """
+    Ждёт завершения задачи без поллинга. Возвращает статус-поля (+ result при DONE);
+    по таймауту — последнее известное состояние; None — задачи нет.
+    """
+    last: Optional[Dict[str, Any]] = None
+    async for job in iter_job_events(job_id, timeout=timeout):
+        if job is not None:
+            last = job
+    return last
 
 
 # --- Queue helpers ---
-async def rpush_job(job_id: str) -> None:
+# Очереди раздельные: {REDIS_QUEUE}:{lane}:{priority}.
+# lane — класс нагрузки: video (минуты CPU), ai (короткие сетевые вызовы),
+# batch (avatar_batch на десятки картинок); priority — high (синхронные
+# flow-сценарии, которые ждут результат) и normal.
+# Внутри очереди FIFO: enqueue — LPUSH, выдача — с правого края.
+# Reliable mode (JOB_RELIABLE_QUEUE=true): задача атомарно переносится
+# в processing-список процесса; после обработки — ack_job (LREM).
+# Процесс держит heartbeat-ключ с TTL = JOB_VISIBILITY_TIMEOUT_SEC;
+# если процесс умер (OOM, деплой), reaper возвращает его задачи в очередь,
+# а после JOB_MAX_ATTEMPTS попыток — в dead-letter список.
+LANE_VIDEO = "video"
+LANE_AI = "ai"
+LANE_BATCH = "batch"
+LANES = (LANE_VIDEO, LANE_AI, LANE_BATCH)
+
+PRIORITY_HIGH = "high"
+PRIORITY_NORMAL = "normal"
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL)
+
+KIND_LANES = {
+    "video_filter": LANE_VIDEO,
+    "video_pipeline": LANE_VIDEO,
+    "image_t2i": LANE_AI,
+    "image_i2i": LANE_AI,
+    "avatar_batch": LANE_BATCH,
+}
+
+
+def lane_for_kind(kind: Optional[str]) -> str:
+    return KIND_LANES.get((kind or "").lower(), LANE_AI)
+
+
+def _queue_key(lane: str, priority: str) -> str:
+    return f"{settings.REDIS_QUEUE}:{lane}:{priority}"
+
+
+def _wakeup_key() -> str:
+    return f"{settings.REDIS_QUEUE}:wakeup"
+
+
+def _wait_stats_key(lane: str) -> str:
+    return f"{settings.REDIS_QUEUE}:{lane}:waits"
+
+
+def _user_inflight_key(user_id: str) -> str:
+    return f"{settings.REDIS_PREFIX}:inflight:{user_id}"
+
+
+def _lane_weights() -> Dict[str, float]:
+    """JOB_LANE_WEIGHTS вида "ai:4,video:2,batch:1"; незаданные lane — вес 1."""
+    weights = {lane: 1.0 for lane in LANES}
+    for part in (settings.JOB_LANE_WEIGHTS or "").split(","):
+        name, _, value = part.partition(":")
+        name = name.strip()
+        if name not in weights:
+            continue
+        try:
+            weights[name] = max(0.01, float(value))
+        except ValueError:
+            pass
+    return weights
+
+
+def _dequeue_order(lanes: Iterable[str]) -> List[str]:
+    """
+    Порядок опроса очередей для одного dequeue — взвешенная случайная
+    перестановка (вес lane × вес приоритета). Среди непустых очередей первой
+    окажется каждая с вероятностью, пропорциональной весу: high и лёгкие
+    lane берутся чаще, но normal и video не голодают.
+    """
+    weights = _lane_weights()
+    high = max(1.0, float(settings.JOB_HIGH_PRIORITY_WEIGHT))
+    ranked = []
+    for lane in lanes:
+        for priority in PRIORITIES:
+            w = weights.get(lane, 1.0) * (high if priority == PRIORITY_HIGH else 1.0)
+            ranked.append((random.random() ** (1.0 / w), _queue_key(lane, priority)))
+    ranked.sort(reverse=True)
+    keys = [key for _, key in ranked]
+    # общая очередь до разделения на lane — дочищаем оставшееся после деплоя
+    keys.append(settings.REDIS_QUEUE)
+    return keys
+
+
+# KEYS[1] — processing-список, KEYS[2..] — очереди по порядку опроса.
+# Первая непустая очередь → processing (ARGV[1] == '1') или просто RPOP.
+_DEQUEUE_LUA = """
+for i = 2, #KEYS do
+  local job_id
+  if ARGV[1] == '1' then
+    job_id = redis.call('LMOVE', KEYS[i], KEYS[1], 'RIGHT', 'LEFT')
+  else
+    job_id = redis.call('RPOP', KEYS[i])
+  end
+  if job_id then
+    return {KEYS[i], job_id}
+  end
+end
+return false
+"""
+
+# Слот пользователя: не больше ARGV[2] задач одновременно. ARGV: job_id, limit, ttl
+_ACQUIRE_USER_SLOT_LUA = """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 1 then
+  return 1
+end
+if redis.call('SCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+  return 0
+end
+redis.call('SADD', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+
+async def enqueue_job(job: Dict[str, Any], priority: str = PRIORITY_NORMAL) -> str:
+    """
+    Ставит задачу (dict из create_job) в очередь её lane и возвращает ключ очереди.
+    Ключ сохраняется в записи задачи — по нему requeue/reaper возвращают её на место.
+    """
+    if priority not in PRIORITIES:
+        priority = PRIORITY_NORMAL
+    job_id = job["job_id"]
+    queue = _queue_key(lane_for_kind(job.get("kind")), priority)
     r = await get_redis()
-    await r.rpush(settings.REDIS_QUEUE, job_id)
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.hset(_job_key(job_id), mapping={"queue": queue, "enqueued_at": str(_now())})
+        pipe.lpush(queue, job_id)
+        pipe.lpush(_wakeup_key(), "1")
+        pipe.ltrim(_wakeup_key(), 0, 99)
+        await pipe.execute()
+    return queue
 
 
-async def lpush_job(job_id: str) -> None:
+async def dequeue_job(
+    lanes: Optional[Iterable[str]] = None, timeout: float = 5
+) -> Optional[Tuple[str, str]]:
+    """
+    Берёт следующую задачу из очередей указанных lane (по умолчанию — всех).
+    Возвращает (queue_key, job_id) или None, если за timeout ничего не пришло.
+    Пустые очереди не опрашиваются в цикле: между попытками ждём «звонок»,
+    который enqueue_job кладёт на каждую задачу. Если звонок заберёт воркер
+    другой lane, остальные заметят задачу не позже чем через timeout.
+    """
     r = await get_redis()
-    await r.lpush(settings.REDIS_QUEUE, job_id)
+    reliable = "1" if settings.JOB_RELIABLE_QUEUE else ""
+    if reliable:
+        await _ensure_heartbeat()
+    lanes = list(lanes or LANES)
+    script = await redis_script(_DEQUEUE_LUA)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        item = await script(keys=[_processing_key(), *_dequeue_order(lanes)], args=[reliable])
+        if item:
+            return item[0], item[1]
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return None
+        await r.brpop(_wakeup_key(), timeout=max(1, int(remaining)))
 
 
-async def brpop_job(timeout: int = 5) -> Optional[str]:
+async def ack_job(job_id: str) -> None:
+    """Задача обработана (успешно или с ошибкой) — убираем из processing."""
+    if not settings.JOB_RELIABLE_QUEUE:
+        return
     r = await get_redis()
-    item = await r.brpop(settings.REDIS_QUEUE, timeout=timeout)
-    if not item:
-        return None
-    _queue, job_id = item
-    return job_id
+    await r.lrem(_processing_key(), 1, job_id)
+
+
+async def _job_queue(job_id: str) -> str:
+    r = await get_redis()
+    return (await r.hget(_job_key(job_id), "queue")) or settings.REDIS_QUEUE
+
+
+async def requeue_job(job_id: str, queue: Optional[str] = None) -> None:
+    """Вернуть взятую задачу в конец её очереди (без учёта попытки)."""
+    r = await get_redis()
+    queue = queue or await _job_queue(job_id)
+    async with r.pipeline(transaction=True) as pipe:
+        if settings.JOB_RELIABLE_QUEUE:
+            pipe.lrem(_processing_key(), 1, job_id)
+        pipe.lpush(queue, job_id)
+        pipe.lpush(_wakeup_key(), "1")
+        pipe.ltrim(_wakeup_key(), 0, 99)
+        await pipe.execute()
+
+
+async def incr_job_attempts(job_id: str) -> int:
+    script = await redis_script(_INCR_ATTEMPTS_LUA)
+    return int(await script(keys=[_job_key(job_id)]) or 0)
+
+
+async def acquire_user_slot(user_id: Optional[str], job_id: str) -> bool:
+    """
+    Честность между пользователями: не больше JOB_USER_MAX_INFLIGHT задач
+    одного user_id в работе одновременно (по всем воркерам).
+    """
+    limit = settings.JOB_USER_MAX_INFLIGHT
+    if not user_id or limit <= 0:
+        return True
+    script = await redis_script(_ACQUIRE_USER_SLOT_LUA)
+    ok = await script(
+        keys=[_user_inflight_key(user_id)],
+        args=[job_id, limit, settings.JOB_TTL_SECONDS],
+    )
+    return bool(ok)
+
+
+async def release_user_slot(user_id: Optional[str], job_id: str) -> None:
+    if not user_id or settings.JOB_USER_MAX_INFLIGHT <= 0:
+        return
+    r = await get_redis()
+    await r.srem(_user_inflight_key(user_id), job_id)
+
+
+async def record_queue_wait(job: Dict[str, Any]) -> None:
+    """Время ожидания в очереди (enqueued_at → выдача) для queue_stats; последние 100 на lane."""
+    enqueued_at = job.get("enqueued_at")
+    if not enqueued_at:
+        return
+    key = _wait_stats_key(lane_for_kind(job.get("kind")))
+    r = await get_redis()
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.lpush(key, f"{max(0.0, _now() - float(enqueued_at)):.3f}")
+        pipe.ltrim(key, 0, 99)
+        await pipe.execute()
+
+
+async def queue_stats() -> Dict[str, Any]:
+    """Глубина и ожидание по каждой lane/priority + размер dead-letter."""
+    r = await get_redis()
+    queues = [(lane, priority, _queue_key(lane, priority)) for lane in LANES for priority in PRIORITIES]
+    async with r.pipeline(transaction=False) as pipe:
+        for _lane, _priority, key in queues:
+            pipe.llen(key)
+            pipe.lindex(key, -1)  # самая старая — следующая на выдачу
+        for lane in LANES:
+            pipe.lrange(_wait_stats_key(lane), 0, -1)
+        pipe.llen(settings.REDIS_QUEUE)
+        pipe.llen(_dead_letter_key())
+        res = await pipe.execute()
+
+    n = len(queues)
+    oldest_ids = [res[2 * i + 1] for i in range(n)]
+    async with r.pipeline(transaction=False) as pipe:
+        for job_id in oldest_ids:
+            pipe.hget(_job_key(job_id or "-"), "enqueued_at")
+        oldest_at = await pipe.execute()
+
+    now = _now()
+    lanes: Dict[str, Any] = {}
+    for i, (lane, priority, _key) in enumerate(queues):
+        entry = lanes.setdefault(lane, {"depth": {}, "oldest_wait_sec": {}})
+        entry["depth"][priority] = int(res[2 * i] or 0)
+        entry["oldest_wait_sec"][priority] = (
+            round(now - float(oldest_at[i]), 3) if oldest_ids[i] and oldest_at[i] else None
+        )
+    for j, lane in enumerate(LANES):
+        samples = sorted(float(v) for v in res[2 * n + j] or [])
+        lanes[lane]["recent_wait_sec"] = {
+            "samples": len(samples),
+            "avg": round(sum(samples) / len(samples), 3) if samples else None,
+            "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))] if samples else None,
+        }
+    return {
+        "lanes": lanes,
+        "legacy_depth": int(res[-2] or 0),
+        "dead_letter": int(res[-1] or 0),
+    }
+
+
+async def dead_letter_job(job_id: str, reason: str) -> None:
+    r = await get_redis()
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.lpush(_dead_letter_key(), job_id)
+        pipe.ltrim(_dead_letter_key(), 0, 999)
+        await pipe.execute()
+    await _mark_dead(job_id, reason)
+
+
+async def _mark_dead(job_id: str, reason: str) -> None:
+    await update_job_status(job_id, ERROR, error=reason, stage="dead")
+    # зарезервированные под задачу кредиты возвращаем — результата не будет
+    job = await get_job(job_id, fields=("payload",)) or {}
+    hold_id = (job.get("payload") or {}).get("credit_hold")
+    if hold_id:
+        from services.ai_subscription import refund_credits
+
+        await refund_credits(hold_id)
+
+
+# --- Heartbeat / reaper ---
+_heartbeat_task: Optional[asyncio.Task] = None
+
+
+async def _touch_heartbeat() -> None:
+    r = await get_redis()
+    await r.set(_heartbeat_key(), str(_now()), ex=max(1, settings.JOB_VISIBILITY_TIMEOUT_SEC))
+
+
+async def _heartbeat_loop() -> None:
+    interval = max(1.0, settings.JOB_VISIBILITY_TIMEOUT_SEC / 3)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await _touch_heartbeat()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[jobs] heartbeat failed: {e}")
+
+
+async def _ensure_heartbeat() -> None:
+    global _heartbeat_task
+    if _heartbeat_task is not None and not _heartbeat_task.done():
+        return
+    # ключ должен существовать до первого dequeue, иначе reaper сочтёт нас мёртвыми
+    await _touch_heartbeat()
+    _heartbeat_task = asyncio.create_task(_heartbeat_loop())
+
+
+async def _stop_heartbeat() -> None:
+    global _heartbeat_task
+    if _heartbeat_task is None:
+        return
+    _heartbeat_task.cancel()
+    try:
+        await _heartbeat_task
+    except BaseException:
+        pass
+    _heartbeat_task = None
+    if _redis is not None:
+        try:
+            await _redis.delete(_heartbeat_key())
+        except Exception:
+            pass
+
+
+# Перенос задачи из processing умершего процесса. KEYS[1] — processing,
+# KEYS[2] — куда (очередь / dead-letter; для drop не передаётся).
+# ARGV: job_id, mode (queue|dead|drop) → 1, если задачу забрали мы.
+_REAP_MOVE_LUA = """
+if redis.call('LREM', KEYS[1], -1, ARGV[1]) == 0 then
+  return 0
+end
+if ARGV[2] == 'queue' then
+  redis.call('RPUSH', KEYS[2], ARGV[1])
+elseif ARGV[2] == 'dead' then
+  redis.call('LPUSH', KEYS[2], ARGV[1])
+  redis.call('LTRIM', KEYS[2], 0, 999)
+end
+return 1
+"""
+
+
+async def reap_stale_jobs() -> int:
+    """
+    Находит processing-списки процессов без живого heartbeat и возвращает
+    их задачи в очередь (или в dead-letter, если попытки исчерпаны).
+    Уже завершённые задачи (DONE/ERROR до ack) только убираются из
+    processing — повторно они не запускаются.
+    Безопасно запускать параллельно на нескольких воркерах: задача
+    читается без снятия (LINDEX), а перенос — один Lua-вызов, который
+    выполнит только тот reaper, чей LREM её нашёл. Смерть reaper'а
+    посередине задачу не теряет: до переноса она остаётся в processing.
+    """
+    r = await get_redis()
+    move = await redis_script(_REAP_MOVE_LUA)
+    prefix = f"{settings.REDIS_QUEUE}:processing:"
+    reaped = 0
+    async for key in r.scan_iter(match=f"{prefix}*", count=100):
+        worker_id = key[len(prefix):]
+        if await r.exists(_heartbeat_key(worker_id)):
+            continue
+        while True:
+            job_id = await r.lindex(key, -1)
+            if not job_id:
+                break
+            job = await get_job(job_id, fields=("status", "attempts", "queue", "user_id"))
+            if not job or job.get("status") in TERMINAL_STATUSES:
+                # записи нет или задача успела завершиться — только убираем
+                if await move(keys=[key], args=[job_id, "drop"]) and job:
+                    await release_user_slot(job.get("user_id"), job_id)
+                continue
+            attempts = int(job.get("attempts") or 0)
+            if attempts >= settings.JOB_MAX_ATTEMPTS:
+                if not await move(keys=[key, _dead_letter_key()], args=[job_id, "dead"]):
+                    continue
+                await release_user_slot(job.get("user_id"), job_id)
+                await _mark_dead(job_id, f"Job abandoned after {attempts} attempts")
+                print(f"[jobs] job_id={job_id} dead-lettered (attempts={attempts})")
+            else:
+                # статус — до переноса: иначе взявший задачу воркер мог бы
+                # получить свой RUNNING перезаписанным на PENDING
+                await update_job_status(job_id, PENDING, stage="requeued")
+                # в голову своей очереди: задача уже ждала своей очереди
+                queue = job.get("queue") or settings.REDIS_QUEUE
+                if not await move(keys=[key, queue], args=[job_id, "queue"]):
+                    continue
+                await release_user_slot(job.get("user_id"), job_id)
+                print(f"[jobs] job_id={job_id} requeued from {worker_id} (attempts={attempts})")
+            reaped += 1
+    return reaped
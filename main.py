@@ -1,5 +1,4 @@
 import asyncio
-import subprocess
 from typing import Optional, List
 
 from fastapi import FastAPI, Body, Response
@@ -19,11 +18,14 @@ from routers.ai import router as ai_router
 from routers.uploads import router as uploads_router
 from routers.analytics import router as analytics_router
 from routers.accounts import router as accounts_router
-from ai_worker import process_ai_job
-from ffmpeg_utils import FFMPEG, has_ffmpeg
-from file_utils import download_to, ext_from_url, uuid_name, public_url
-from jobs import brpop_job, get_job, update_job_status, RUNNING, DONE, ERROR, close_redis
-from paths import STATIC_DIR, UPLOAD_DIR, OUT_DIR, ensure_dirs
+from routers.jobs import router as jobs_router
+from jobs import close_redis
+from http_client import init_clients, close_clients
+from ffmpeg_utils import probe_capabilities
+from image_ops import shutdown_image_pool
+from paths import STATIC_DIR, ensure_dirs
+from services.ig_state import stop_state_listener
+from worker import worker_loop, reaper_loop
 
 
 
@@ -45,129 +47,35 @@ app.include_router(ai_router)
 app.include_router(uploads_router)
 app.include_router(analytics_router)
 app.include_router(accounts_router)
+app.include_router(jobs_router)
 
 # ── JOB WORKERS (Redis-backed queue is handled inside jobs.py) ──────────
+# INPROCESS_WORKERS=false → API-реплика только ставит задачи в очередь,
+# обработкой занимается отдельный процесс `python -m worker`.
 VIDEO_WORKERS = settings.VIDEO_WORKERS
 
-async def _process_video_task(job_id: str) -> None:
-    job = await get_job(job_id)
-    if not job:
-        await update_job_status(job_id, ERROR, error="Job not found")
-        return
-
-    payload = job.get("payload") or {}
-    url = (payload.get("url") or "").strip()
-    preset = (payload.get("preset") or "cinematic").strip().lower()
-    try:
-        intensity = float(payload.get("intensity", 0.7))
-    except Exception:
-        intensity = 0.7
-    intensity = max(0.0, min(1.0, intensity))
-
-    if not url:
-        await update_job_status(job_id, ERROR, error="payload.url is required")
-        return
-
-    if not has_ffmpeg():
-        await update_job_status(job_id, ERROR, error="ffmpeg not available on server")
-        return
-
-    # 1) Resolve input file (local /static/... or download)
-    try:
-        if url.startswith("/static/"):
-            rel = url[len("/static/"):]
-            src = STATIC_DIR / rel
-            if not src.exists():
-                await update_job_status(job_id, ERROR, error=f"Local file not found: {src}")
-                return
-        else:
-            src = UPLOAD_DIR / uuid_name("src", ext_from_url(url, ".mp4"))
-            await download_to(url, src)
-    except Exception as e:
-        await update_job_status(job_id, ERROR, error=f"download/open failed: {e}")
-        return
-
-    # 2) Build very small filter set
-    k = intensity
-    if preset in ("bw", "b&w", "mono", "blackwhite", "black_white"):
-        vf = "hue=s=0"
-    else:
-        # cinematic-ish: slight contrast/sat + tiny gamma tweak
-        # keep it simple and stable
-        contrast = 1.0 + 0.20 * k
-        saturation = 1.0 + 0.15 * k
-        gamma = 1.0 - 0.05 * k
-        vf = f"eq=contrast={contrast}:saturation={saturation}:gamma={gamma}"
-
-    out = OUT_DIR / uuid_name("flt_vid_out", ".mp4")
-
-    cmd = [
-        FFMPEG, "-y",
-        "-i", str(src),
-        "-vf", vf,
-        "-c:v", "libx264",
-        "-preset", "veryfast",
-        "-crf", "21",
-        "-pix_fmt", "yuv420p",
-        "-movflags", "+faststart",
-        "-c:a", "aac",
-        "-b:a", "128k",
-        str(out),
-    ]
-
-    p = subprocess.run(cmd, capture_output=True, text=True)
-    if p.returncode != 0:
-        err = (p.stderr or "")[-1200:]
-        await update_job_status(job_id, ERROR, error=f"ffmpeg failed: {err}")
-        return
-
-    await update_job_status(
-        job_id,
-        DONE,
-        result={"output_url": public_url(out, STATIC_DIR)},
-    )
-
-async def _worker_loop(worker_idx: int):
-    while True:
-        job_id = await brpop_job(timeout=5)
-        if not job_id:
-            continue
-
-        job = await get_job(job_id)
-        if not job:
-            continue
-
-        try:
-            await update_job_status(job_id, RUNNING)
-
-            kind = (job.get("kind") or "").lower()
-            if kind == "video_filter":
-                await _process_video_task(job_id)
-            elif kind in ("image_t2i", "image_i2i", "avatar_batch"):
-                await process_ai_job(job_id, job)
-            else:
-                await update_job_status(
-                    job_id, ERROR, error=f"Unknown job kind: {job.get('kind')}"
-                )
-
-        except asyncio.CancelledError:
-            raise
-        except Exception as e:
-            await update_job_status(job_id, ERROR, error=str(e))
-
 @app.on_event("startup")
 async def _startup():
-    app.state._workers = [
-        asyncio.create_task(_worker_loop(i))
-        for i in range(max(1, VIDEO_WORKERS))
-    ]
+    init_clients()
+    await probe_capabilities()
+    app.state._workers = []
+    if settings.INPROCESS_WORKERS:
+        app.state._workers = [
+            asyncio.create_task(worker_loop(i))
+            for i in range(max(1, VIDEO_WORKERS))
+        ]
+        if settings.JOB_RELIABLE_QUEUE:
+            app.state._workers.append(asyncio.create_task(reaper_loop()))
 
 @app.on_event("shutdown")
 async def _shutdown():
     for t in getattr(app.state, "_workers", []):
         t.cancel()
     await asyncio.gather(*getattr(app.state, "_workers", []), return_exceptions=True)
+    await stop_state_listener()
     await close_redis()
+    await close_clients()
+    shutdown_image_pool()
 
 
 # 9) CAPTION SUGGEST
@@ -230,10 +138,13 @@ def root():
             "/ig/publish/story/image",
             "/ig/publish/story/video",
             "/ig/insights/media",
+            "/ig/insights/media/bulk",
             "/ig/insights/account",
             "/media/validate",
             "/media/filter/video",
             "/media/filter/status",
+            "/jobs/{job_id}/events",
+            "/jobs/queues",
             "/ig/schedule",
             "/caption/suggest",
             "/ig/publish/batch",
@@ -0,0 +1,183 @@
+# media_probe.py
+"""
+Асинхронный ffprobe с кешем в Redis.
+
+    info = await probe("https://res.cloudinary.com/.../video.mp4")
+    info = await probe(path, source_url=url)   # уже скачанный файл
+
+- URL пробуется напрямую: ffprobe читает только заголовки range-запросами
+  (у faststart MP4 — moov в начале файла), без скачивания целиком;
+  если не вышло (сервер без Range, сборка без https) — download_cached
+  и проба локальной копии;
+- результат — компактная схема normalize_probe, а не весь JSON ffprobe;
+- ключ кеша — sha256 содержимого (файл, или URL с уже известным хешем)
+  либо URL + ETag/Last-Modified из HEAD. URL без валидатора кешируется
+  только на DOWNLOAD_CACHE_FRESH_SEC. TTL — MEDIA_PROBE_CACHE_TTL_SEC.
+Без Redis кеш просто пропускается.
+"""
+import asyncio
+import hashlib
+import json
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+from config import settings
+from download_cache import content_sha256, download_cached, file_sha256
+from ffmpeg_utils import ffprobe_json_async
+from file_utils import ext_from_url, uuid_name
+from http_client import UPSTREAM_DOWNLOAD, get_client
+from jobs import get_redis
+from paths import UPLOAD_DIR
+from transform_cache import known_content_hash
+
+
+def _cache_key(kind: str, ident: str) -> str:
+    return f"{settings.REDIS_PREFIX}:probe:{kind}:{ident}"
+
+
+def _fps(rate: Optional[str]) -> float:
+    try:
+        a, b = (rate or "0/1").split("/")
+        return float(a) / float(b) if float(b) else 0.0
+    except Exception:
+        return 0.0
+
+
+def _rotation(stream: Dict[str, Any]) -> int:
+    # старые сборки пишут tags.rotate (по часовой), новые — displaymatrix (против)
+    rotate = (stream.get("tags") or {}).get("rotate")
+    if rotate is not None:
+        try:
+            return int(float(rotate)) % 360
+        except ValueError:
+            return 0
+    for side in stream.get("side_data_list") or []:
+        if "rotation" in side:
+            try:
+                return int(-float(side["rotation"])) % 360
+            except (TypeError, ValueError):
+                return 0
+    return 0
+
+
+def _int_or_none(value: Any) -> Optional[int]:
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def normalize_probe(meta: Dict[str, Any]) -> Dict[str, Any]:
+    """Сырой JSON ffprobe → {duration, width, height, fps, codecs, bitrate, rotation, ...}."""
+    streams = meta.get("streams") or []
+    v = next((s for s in streams if s.get("codec_type") == "video"), None) or {}
+    a = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    fmt = meta.get("format") or {}
+    duration = float(fmt.get("duration") or v.get("duration") or 0)
+    rate = v.get("avg_frame_rate")
+    if rate in (None, "0/0"):
+        rate = v.get("r_frame_rate")
+    return {
+        "duration": round(duration, 3),
+        "width": int(v.get("width") or 0),
+        "height": int(v.get("height") or 0),
+        "fps": round(_fps(rate), 3),
+        "rotation": _rotation(v) if v else 0,
+        "video_codec": v.get("codec_name"),
+        "pix_fmt": v.get("pix_fmt"),
+        "audio_codec": a.get("codec_name") if a else None,
+        "bitrate": _int_or_none(fmt.get("bit_rate")),
+        "size": _int_or_none(fmt.get("size")),
+        "format": fmt.get("format_name"),
+    }
+
+
+async def _cache_get(key: str) -> Optional[Dict[str, Any]]:
+    try:
+        r = await get_redis()
+        raw = await r.get(key)
+        return json.loads(raw) if raw else None
+    except Exception as e:
+        print(f"[media_probe] cache get failed: {e}")
+        return None
+
+
+async def _cache_set(key: str, info: Dict[str, Any], ttl: int) -> None:
+    try:
+        r = await get_redis()
+        await r.set(key, json.dumps(info), ex=max(1, ttl))
+    except Exception as e:
+        print(f"[media_probe] cache set failed: {e}")
+
+
+async def _url_validator(url: str) -> Optional[str]:
+    """ETag / Last-Modified по HEAD — версия ресурса для ключа кеша."""
+    try:
+        r = await get_client(UPSTREAM_DOWNLOAD).head(url, follow_redirects=True, timeout=10)
+    except Exception:
+        return None
+    if r.status_code >= 400:
+        return None
+    return r.headers.get("ETag") or r.headers.get("Last-Modified")
+
+
+async def _probe_file(path: Path, sha: str, timeout_sec: float) -> Dict[str, Any]:
+    key = _cache_key("sha", sha)
+    cached = await _cache_get(key)
+    if cached:
+        return cached
+    info = normalize_probe(await ffprobe_json_async(str(path), timeout_sec=timeout_sec))
+    await _cache_set(key, info, settings.MEDIA_PROBE_CACHE_TTL_SEC)
+    return info
+
+
+async def _probe_url(url: str, timeout_sec: float) -> Dict[str, Any]:
+    sha = await known_content_hash(url)
+    if sha:
+        cached = await _cache_get(_cache_key("sha", sha))
+        if cached:
+            return cached
+
+    validator = await _url_validator(url)
+    url_key = _cache_key("url", hashlib.sha256(f"{url}|{validator or ''}".encode()).hexdigest())
+    cached = await _cache_get(url_key)
+    if cached:
+        return cached
+
+    try:
+        info = normalize_probe(await ffprobe_json_async(url, timeout_sec=timeout_sec))
+    except Exception as e:
+        print(f"[media_probe] remote probe failed, downloading {url}: {e}")
+        tmp = UPLOAD_DIR / uuid_name("probe", ext_from_url(url))
+        try:
+            await download_cached(url, tmp)
+            info = await _probe_file(tmp, await content_sha256(url, tmp), timeout_sec)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    ttl = settings.MEDIA_PROBE_CACHE_TTL_SEC
+    if not validator:
+        ttl = min(ttl, settings.DOWNLOAD_CACHE_FRESH_SEC)
+    await _cache_set(url_key, info, ttl)
+    return info
+
+
+async def probe(
+    source: Union[str, Path],
+    *,
+    source_url: Optional[str] = None,
+    timeout_sec: float = 30,
+) -> Dict[str, Any]:
+    """
+    Нормализованные метаданные медиа по пути или http(s)-URL.
+    source_url — откуда скачан локальный файл: тогда sha256 берётся из
+    метаданных download_cache, а не пересчитывается.
+    """
+    if isinstance(source, str) and source.startswith(("http://", "https://")):
+        return await _probe_url(source, timeout_sec)
+    path = Path(source)
+    if source_url:
+        sha = await content_sha256(source_url, path)
+    else:
+        sha = await asyncio.to_thread(file_sha256, path)
+    return await _probe_file(path, sha, timeout_sec)
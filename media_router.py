@@ -1,65 +1,39 @@
 # media_router.py
-import textwrap
-import subprocess
-from pathlib import Path
 from typing import Optional, Dict, Any, List
 
 from fastapi import APIRouter, Body, Query, HTTPException
 
-from jobs import create_job, get_job, rpush_job
-from ffmpeg_utils import FFMPEG, FFPROBE, has_ffmpeg, ffprobe_json
-from file_utils import uuid_name, ext_from_url, public_url, download_to
+from jobs import create_job, get_job, get_job_status, enqueue_job, update_job_status, DONE
+from ffmpeg_utils import FFMPEG, FFmpegTimeoutError, ffprobe_json_async, has_ffmpeg, run_ffmpeg
+from file_utils import uuid_name, ext_from_url, public_url
+from download_cache import download_cached
+from media_probe import normalize_probe, probe
+from media_utils import parse_aspect
+from transform_cache import lookup_by_files, lookup_by_urls, put_cached_transform
 from fonts_utils import PIL_OK
+from image_ops import ImagePoolBusy, run_image_op, resize_image, filter_image, watermark_image, cover_overlay
+from video_worker import video_filter_params
+from video_pipeline import normalize_pipeline, overlay_position, pipeline_cache_params, pipeline_input_urls
 
 from paths import STATIC_DIR, UPLOAD_DIR, OUT_DIR
 
-# OPTIONAL: Pillow modules (используем только если PIL_OK)
+# OPTIONAL: Pillow (здесь только для чтения размеров в /validate;
+# вся обработка — в image_ops, вне event loop)
 try:
-    from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageEnhance
+    from PIL import Image
 except Exception:
     Image = None  # type: ignore
-    ImageDraw = None  # type: ignore
-    ImageFont = None  # type: ignore
-    ImageFilter = None  # type: ignore
-    ImageEnhance = None  # type: ignore
-
-# Pillow 10+ resampling constant (если Image доступен)
-try:
-    RESAMPLE_LANCZOS = Image.Resampling.LANCZOS  # type: ignore[attr-defined]
-except Exception:
-    RESAMPLE_LANCZOS = getattr(Image, "LANCZOS", getattr(Image, "BICUBIC", 3)) if Image else None
 
 
 router = APIRouter(prefix="/media", tags=["media"])
 
 
-def parse_aspect(aspect: Optional[str]) -> Optional[float]:
-    if not aspect:
-        return None
-    s = str(aspect).strip()
-    if ":" in s:
-        a, b = s.split(":", 1)
-        try:
-            return float(a) / float(b)
-        except Exception:
-            return None
+async def _image_op(func, *args) -> None:
+    """Pillow-операция в пуле image_ops; пул переполнен → 429."""
     try:
-        return float(s)
-    except Exception:
-        return None
-
-
-def image_open_rgba(path: Path):
-    if not PIL_OK or Image is None:
-        raise RuntimeError("Pillow (PIL) is not installed. Install pillow.")
-    return Image.open(path).convert("RGBA")
-
-
-def save_image_rgb(img, dst: Path, quality: int = 90):
-    if not PIL_OK or Image is None:
-        raise RuntimeError("Pillow (PIL) is not installed.")
-    img_rgb = img.convert("RGB")
-    img_rgb.save(dst, format="JPEG", quality=quality, optimize=True, progressive=True)
+        await run_image_op(func, *args)
+    except ImagePoolBusy as e:
+        raise HTTPException(429, str(e), headers={"Retry-After": "1"})
 
 
 # 1) VALIDATE
@@ -68,80 +42,94 @@ async def media_validate(
     url: str = Body(..., embed=True),
     type: str = Body(..., embed=True, description="video|image"),
     target: str = Body("REELS", embed=True),
+    download: bool = Body(True, embed=True, description="video: false — проба по URL без скачивания"),
 ):
-    try:
-        ext = ext_from_url(url, default=".bin")
-        tmp = UPLOAD_DIR / uuid_name("dl", ext)
-        await download_to(url, tmp)
-    except Exception as e:
-        return {"ok": False, "stage": "download", "error": str(e)}
-
-    info: Dict[str, Any] = {"path": str(tmp), "size": tmp.stat().st_size}
+    """
+    Проверка медиа перед публикацией. media_info.probe — нормализованные
+    метаданные (media_probe.normalize_probe).
+    Видео с download=false: ffprobe читает по URL только заголовки, файл не
+    скачивается — поэтому local_url = null, а media_info без path/ffprobe.
+    По умолчанию (download=true) ответ прежний: файл в static/uploads,
+    local_url, media_info.path и сырой media_info.ffprobe.
+    """
     compatible, reasons = True, []
 
     if type.lower() == "video":
         if not has_ffmpeg():
             return {"ok": False, "error": "ffmpeg/ffprobe is not available on server."}
-        try:
-            meta = ffprobe_json(tmp)
-            info["ffprobe"] = meta
-
-            vstreams = [s for s in meta.get("streams", []) if s.get("codec_type") == "video"]
-            astreams = [s for s in meta.get("streams", []) if s.get("codec_type") == "audio"]
-            fmt = meta.get("format", {})
-            duration = float(fmt.get("duration", 0) or 0)
-
-            if target.upper() == "REELS":
-                if duration <= 0 or duration > 90:
-                    compatible = False
-                    reasons.append("Duration must be 0–90s for safe Reels.")
-
-            if vstreams:
-                v = vstreams[0]
-                codec = v.get("codec_name")
-                width = int(v.get("width") or 0)
-                height = int(v.get("height") or 0)
-                pix_fmt = v.get("pix_fmt")
-
-                fps = 0.0
-                try:
-                    a, b = (v.get("r_frame_rate", "0/1") or "0/1").split("/")
-                    fps = float(a) / float(b)
-                except Exception:
-                    pass
-
-                if codec and codec != "h264":
-                    compatible = False
-                    reasons.append(f"Video codec {codec} != h264")
-                if pix_fmt and pix_fmt != "yuv420p":
-                    reasons.append(f"pix_fmt {pix_fmt} != yuv420p")
-                if width > 1080 or height > 1920:
-                    reasons.append("Resolution will be downscaled (OK).")
-                if fps > 60:
-                    reasons.append("FPS >60 — лучше снизить до 30.")
-
-            if target.upper() == "REELS":
-                if not astreams:
-                    reasons.append("No audio stream — допустимо, но добавьте звук.")
-                else:
-                    ac = astreams[0].get("codec_name")
-                    if ac and ac != "aac":
-                        reasons.append(f"Audio codec {ac} != aac (will be transcoded).")
+        local_url = None
+        if download:
+            try:
+                tmp = UPLOAD_DIR / uuid_name("dl", ext_from_url(url, default=".mp4"))
+                await download_cached(url, tmp)
+            except Exception as e:
+                return {"ok": False, "stage": "download", "error": str(e)}
+            try:
+                raw = await ffprobe_json_async(str(tmp))
+            except Exception as e:
+                return {"ok": False, "stage": "ffprobe", "error": str(e)}
+            meta = normalize_probe(raw)
+            info: Dict[str, Any] = {"path": str(tmp), "size": tmp.stat().st_size, "ffprobe": raw, "probe": meta}
+            local_url = public_url(tmp, STATIC_DIR)
+        else:
+            # ffprobe по URL читает только заголовки — видео не скачиваем
+            try:
+                meta = await probe(url)
+            except Exception as e:
+                return {"ok": False, "stage": "ffprobe", "error": str(e)}
+            info = {"size": meta["size"], "probe": meta}
+
+        duration = meta["duration"]
+        if target.upper() == "REELS":
+            if duration <= 0 or duration > 90:
+                compatible = False
+                reasons.append("Duration must be 0–90s for safe Reels.")
+
+        if meta["video_codec"]:
+            codec = meta["video_codec"]
+            pix_fmt = meta["pix_fmt"]
+            if codec != "h264":
+                compatible = False
+                reasons.append(f"Video codec {codec} != h264")
+            if pix_fmt and pix_fmt != "yuv420p":
+                reasons.append(f"pix_fmt {pix_fmt} != yuv420p")
+            if meta["width"] > 1080 or meta["height"] > 1920:
+                reasons.append("Resolution will be downscaled (OK).")
+            if meta["fps"] > 60:
+                reasons.append("FPS >60 — лучше снизить до 30.")
+
+        if target.upper() == "REELS":
+            if not meta["audio_codec"]:
+                reasons.append("No audio stream — допустимо, но добавьте звук.")
+            elif meta["audio_codec"] != "aac":
+                reasons.append(f"Audio codec {meta['audio_codec']} != aac (will be transcoded).")
+
+        return {
+            "ok": True,
+            "compatible": compatible,
+            "reasons": reasons,
+            "media_info": info,
+            "local_url": local_url,
+        }
 
-        except Exception as e:
-            return {"ok": False, "stage": "ffprobe", "error": str(e)}
+    try:
+        ext = ext_from_url(url, default=".bin")
+        tmp = UPLOAD_DIR / uuid_name("dl", ext)
+        await download_cached(url, tmp)
+    except Exception as e:
+        return {"ok": False, "stage": "download", "error": str(e)}
 
-    else:
-        if not PIL_OK:
-            return {"ok": False, "error": "Pillow is not installed on server."}
-        try:
-            im_raw = Image.open(tmp)  # type: ignore
-            w, h = im_raw.size
-            info["image"] = {"width": w, "height": h, "mode": im_raw.mode}
-            if target.upper() == "IMAGE" and max(w, h) > 2160:
-                reasons.append("Очень крупное изображение — будет ужато до 1080 по длинной стороне.")
-        except Exception as e:
-            return {"ok": False, "stage": "image_open", "error": str(e)}
+    info = {"path": str(tmp), "size": tmp.stat().st_size}
+    if not PIL_OK:
+        return {"ok": False, "error": "Pillow is not installed on server."}
+    try:
+        im_raw = Image.open(tmp)  # type: ignore
+        w, h = im_raw.size
+        info["image"] = {"width": w, "height": h, "mode": im_raw.mode}
+        if target.upper() == "IMAGE" and max(w, h) > 2160:
+            reasons.append("Очень крупное изображение — будет ужато до 1080 по длинной стороне.")
+    except Exception as e:
+        return {"ok": False, "stage": "image_open", "error": str(e)}
 
     return {
         "ok": True,
@@ -165,11 +153,25 @@ async def media_transcode_video(
     if not has_ffmpeg():
         return {"ok": False, "error": "ffmpeg not available."}
 
+    params = {
+        "target_aspect": target_aspect,
+        "max_duration_sec": max_duration_sec,
+        "max_width": max_width,
+        "fps": fps,
+        "normalize_audio": normalize_audio,
+    }
+    hit = await lookup_by_urls("transcode_video", params, url)
+    if hit:
+        return hit
+
     try:
         src = UPLOAD_DIR / uuid_name("src", ext_from_url(url, ".mp4"))
-        await download_to(url, src)
+        await download_cached(url, src)
+        tkey, hit = await lookup_by_files("transcode_video", params, (url, src))
     except Exception as e:
         return {"ok": False, "stage": "download", "error": str(e)}
+    if hit:
+        return hit
 
     aspect = parse_aspect(target_aspect) or (9 / 16)
     out = OUT_DIR / uuid_name("ready", ".mp4")
@@ -200,11 +202,16 @@ async def media_transcode_video(
         cmd += ["-af", ",".join(af)]
     cmd += ["-c:a", "aac", "-b:a", "128k", str(out)]
 
-    p = subprocess.run(cmd, capture_output=True, text=True)
+    try:
+        p = await run_ffmpeg(cmd)
+    except FFmpegTimeoutError as e:
+        return {"ok": False, "stage": "ffmpeg", "error": str(e)}
     if p.returncode != 0:
         return {"ok": False, "stage": "ffmpeg", "stderr": (p.stderr or "")[-1000:]}
 
-    return {"ok": True, "output_url": public_url(out, STATIC_DIR)}
+    result = {"ok": True, "output_url": public_url(out, STATIC_DIR)}
+    await put_cached_transform(tkey, result)
+    return result
 
 
 # 3) RESIZE IMAGE
@@ -218,59 +225,33 @@ async def media_resize_image(
 ):
     if not PIL_OK:
         return {"ok": False, "error": "Pillow not installed."}
+    fit = (fit or "cover").strip().lower()
+    background = (background or "black").strip().lower()
+    params = {"target_aspect": target_aspect, "max_width": max_width, "fit": fit, "background": background}
+    hit = await lookup_by_urls("resize_image", params, url)
+    if hit:
+        return hit
     try:
         src = UPLOAD_DIR / uuid_name("img", ext_from_url(url, ".jpg"))
-        await download_to(url, src)
-        img = image_open_rgba(src)
+        await download_cached(url, src)
+        tkey, hit = await lookup_by_files("resize_image", params, (url, src))
+        if hit:
+            return hit
     except Exception as e:
         return {"ok": False, "stage": "download/open", "error": str(e)}
 
     asp = parse_aspect(target_aspect) or 1.0
-    tw = max_width
-    th = int(round(tw / asp))
-
-    if fit == "contain":
-        if isinstance(background, str) and background.lower() == "blur":
-            bg = img.copy().resize((tw, th), RESAMPLE_LANCZOS).filter(ImageFilter.GaussianBlur(radius=24))  # type: ignore
-            canvas = bg.convert("RGBA")
-        else:
-            try:
-                canvas = Image.new("RGBA", (tw, th), background)  # type: ignore
-            except Exception:
-                canvas = Image.new("RGBA", (tw, th), "black")  # type: ignore
-
-        img_ratio = img.width / img.height
-        if img_ratio > asp:
-            nw = tw
-            nh = int(round(nw / img_ratio))
-        else:
-            nh = th
-            nw = int(round(nh * img_ratio))
-
-        img_res = img.resize((nw, nh), RESAMPLE_LANCZOS)
-        x = (tw - nw) // 2
-        y = (th - nh) // 2
-        canvas.paste(img_res, (x, y), img_res)
-
-        out = OUT_DIR / uuid_name("img_resized", ".jpg")
-        save_image_rgb(canvas, out, quality=90)
-        return {"ok": True, "output_url": public_url(out, STATIC_DIR)}
-
-    # cover
-    img_ratio = img.width / img.height
-    if img_ratio > asp:
-        new_w = int(round(img.height * asp))
-        left = (img.width - new_w) // 2
-        box = (left, 0, left + new_w, img.height)
-    else:
-        new_h = int(round(img.width / asp))
-        top = (img.height - new_h) // 2
-        box = (0, top, img.width, top + new_h)
+    out = OUT_DIR / uuid_name("img_resized" if fit == "contain" else "img_cover", ".jpg")
+    try:
+        await _image_op(resize_image, str(src), str(out), asp, max_width, fit, background)
+    except HTTPException:
+        raise
+    except Exception as e:
+        return {"ok": False, "stage": "resize", "error": str(e)}
 
-    img_c = img.crop(box).resize((tw, th), RESAMPLE_LANCZOS)
-    out = OUT_DIR / uuid_name("img_cover", ".jpg")
-    save_image_rgb(img_c, out, quality=92)
-    return {"ok": True, "output_url": public_url(out, STATIC_DIR)}
+    result = {"ok": True, "output_url": public_url(out, STATIC_DIR)}
+    await put_cached_transform(tkey, result)
+    return result
 
 
 # 4) REEL COVER (grab frame + optional text)
@@ -284,41 +265,27 @@ async def media_reel_cover(
         return {"ok": False, "error": "ffmpeg not available."}
     try:
         src = UPLOAD_DIR / uuid_name("vid", ext_from_url(video_url, ".mp4"))
-        await download_to(video_url, src)
+        await download_cached(video_url, src)
     except Exception as e:
         return {"ok": False, "stage": "download", "error": str(e)}
 
     frame = OUT_DIR / uuid_name("cover_frame", ".jpg")
-    p = subprocess.run(
-        [FFMPEG, "-y", "-ss", str(max(0.0, at)), "-i", str(src), "-frames:v", "1", "-q:v", "2", str(frame)],
-        capture_output=True,
-        text=True,
-    )
+    try:
+        p = await run_ffmpeg(
+            [FFMPEG, "-y", "-ss", str(max(0.0, at)), "-i", str(src), "-frames:v", "1", "-q:v", "2", str(frame)],
+        )
+    except FFmpegTimeoutError as e:
+        return {"ok": False, "stage": "ffmpeg", "error": str(e)}
     if p.returncode != 0:
         return {"ok": False, "stage": "ffmpeg", "stderr": (p.stderr or "")[-1000:]}
 
-    if overlay and PIL_OK and Image is not None:
+    if overlay and PIL_OK:
+        out = OUT_DIR / uuid_name("cover", ".jpg")
         try:
-            img = Image.open(frame).convert("RGBA")  # type: ignore
-            draw = ImageDraw.Draw(img)  # type: ignore
-            text = (overlay or {}).get("text") or ""
-            pos = (overlay or {}).get("pos") or "bottom"
-            padding = int((overlay or {}).get("padding") or 32)
-
-            if text:
-                wrapped = textwrap.fill(text, width=20)
-                font = ImageFont.load_default()  # type: ignore
-                bbox = draw.multiline_textbbox((0, 0), wrapped, font=font, spacing=4, align="left")  # type: ignore
-                tw, th = bbox[2] - bbox[0], bbox[3] - bbox[1]
-
-                xy = (padding, img.height - th - padding) if pos == "bottom" else (padding, padding)
-                bg = Image.new("RGBA", (tw + padding * 2, th + padding * 2), (0, 0, 0, 160))  # type: ignore
-                img.paste(bg, (xy[0] - padding, xy[1] - padding), bg)
-                draw.multiline_text(xy, wrapped, font=font, fill=(255, 255, 255, 255), spacing=4)  # type: ignore
-
-            out = OUT_DIR / uuid_name("cover", ".jpg")
-            save_image_rgb(img, out, quality=92)
+            await _image_op(cover_overlay, str(frame), str(out), dict(overlay))
             return {"ok": True, "cover_url": public_url(out, STATIC_DIR)}
+        except HTTPException:
+            raise
         except Exception as e:
             return {"ok": True, "cover_url": public_url(frame, STATIC_DIR), "note": f"PIL overlay skipped: {e}"}
 
@@ -338,60 +305,42 @@ async def media_watermark(
     ext = ext_from_url(url, "")
     is_video = type == "video" or ext.lower() in (".mp4", ".mov", ".m4v", ".webm")
 
+    position = (position or "br").strip().lower()
+    params = {"position": position, "opacity": opacity, "margin": margin, "video": is_video}
+    hit = await lookup_by_urls("watermark", params, url, logo_url)
+    if hit:
+        return hit
+
     try:
         src = UPLOAD_DIR / uuid_name("wm_src", ext or ".bin")
-        await download_to(url, src)
+        await download_cached(url, src)
         logo = UPLOAD_DIR / uuid_name("wm_logo", ext_from_url(logo_url, ".png"))
-        await download_to(logo_url, logo)
+        await download_cached(logo_url, logo)
+        tkey, hit = await lookup_by_files("watermark", params, (url, src), (logo_url, logo))
     except Exception as e:
         return {"ok": False, "stage": "download", "error": str(e)}
+    if hit:
+        return hit
 
     if not is_video:
-        if not PIL_OK or Image is None:
+        if not PIL_OK:
             return {"ok": False, "error": "Pillow not installed."}
+        out = OUT_DIR / uuid_name("wm_img", ".jpg")
         try:
-            base = image_open_rgba(src)
-            mark = Image.open(logo).convert("RGBA")  # type: ignore
-
-            target_w = max(64, base.width // 6)
-            ratio = target_w / mark.width
-            mark = mark.resize((target_w, int(mark.height * ratio)), RESAMPLE_LANCZOS)
-
-            if opacity < 1.0:
-                alpha = mark.split()[-1].point(lambda p: int(p * opacity))
-                mark.putalpha(alpha)
-
-            if position in ("tr", "rt"):
-                x = base.width - mark.width - margin
-                y = margin
-            elif position in ("tl", "lt"):
-                x = margin
-                y = margin
-            elif position in ("bl", "lb"):
-                x = margin
-                y = base.height - mark.height - margin
-            else:
-                x = base.width - mark.width - margin
-                y = base.height - mark.height - margin
-
-            base.paste(mark, (x, y), mark)
-            out = OUT_DIR / uuid_name("wm_img", ".jpg")
-            save_image_rgb(base, out, quality=92)
-            return {"ok": True, "output_url": public_url(out, STATIC_DIR)}
+            await _image_op(watermark_image, str(src), str(logo), str(out), position, opacity, margin)
+        except HTTPException:
+            raise
         except Exception as e:
             return {"ok": False, "stage": "image_wm", "error": str(e)}
+        result = {"ok": True, "output_url": public_url(out, STATIC_DIR)}
+        await put_cached_transform(tkey, result)
+        return result
 
     # video watermark
     if not has_ffmpeg():
         return {"ok": False, "error": "ffmpeg not available."}
 
-    pos_map = {
-        "tr": f"main_w-overlay_w-{margin}:{margin}",
-        "tl": f"{margin}:{margin}",
-        "bl": f"{margin}:main_h-overlay_h-{margin}",
-        "br": f"main_w-overlay_w-{margin}:main_h-overlay_h-{margin}",
-    }
-    expr = pos_map.get(position, pos_map["br"])
+    expr = overlay_position(position, margin)
 
     out = OUT_DIR / uuid_name("wm_vid", ".mp4")
     cmd = [
@@ -404,11 +353,16 @@ async def media_watermark(
         "-movflags", "+faststart",
         str(out),
     ]
-    p = subprocess.run(cmd, capture_output=True, text=True)
+    try:
+        p = await run_ffmpeg(cmd)
+    except FFmpegTimeoutError as e:
+        return {"ok": False, "stage": "ffmpeg", "error": str(e)}
     if p.returncode != 0:
         return {"ok": False, "stage": "ffmpeg", "stderr": (p.stderr or "")[-1000:]}
 
-    return {"ok": True, "output_url": public_url(out, STATIC_DIR)}
+    result = {"ok": True, "output_url": public_url(out, STATIC_DIR)}
+    await put_cached_transform(tkey, result)
+    return result
 
 
 # 6) FILTERS (image)
@@ -418,34 +372,37 @@ async def media_filter_image(
     preset: str = Body("cinematic", embed=True),
     intensity: float = Body(0.7, embed=True),
 ):
-    if not PIL_OK or Image is None:
+    if not PIL_OK:
         return {"ok": False, "error": "Pillow not installed."}
 
+    k = max(0.0, min(1.0, float(intensity)))
+    pkey = (preset or "").lower().strip()
+    params = {"preset": pkey, "intensity": k}
+    hit = await lookup_by_urls("filter_image", params, url)
+    if hit:
+        return hit
+
     try:
         src = UPLOAD_DIR / uuid_name("flt_img", ext_from_url(url, ".jpg"))
-        await download_to(url, src)
-        img = Image.open(src).convert("RGB")  # type: ignore
+        await download_cached(url, src)
+        tkey, hit = await lookup_by_files("filter_image", params, (url, src))
+        if hit:
+            return hit
     except Exception as e:
         return {"ok": False, "stage": "download/open", "error": str(e)}
 
-    k = max(0.0, min(1.0, float(intensity)))
-    pkey = (preset or "").lower().strip()
-
+    out = OUT_DIR / uuid_name("flt_img_out", ".jpg")
     try:
-        out_img = img
-        if pkey in ("b&w", "bw", "mono", "blackwhite"):
-            out_img = img.convert("L").convert("RGB")
-        else:
-            out_img = ImageEnhance.Contrast(img).enhance(1 + 0.12 * k)  # type: ignore
-            out_img = ImageEnhance.Color(out_img).enhance(1 + 0.10 * k)  # type: ignore
-            out_img = out_img.filter(ImageFilter.GaussianBlur(radius=0.3 * k))  # type: ignore
-
-        out = OUT_DIR / uuid_name("flt_img_out", ".jpg")
-        out_img.save(out, quality=92, optimize=True, progressive=True)
-        return {"ok": True, "preset": pkey, "intensity": k, "output_url": public_url(out, STATIC_DIR)}
+        await _image_op(filter_image, str(src), str(out), pkey, k)
+    except HTTPException:
+        raise
     except Exception as e:
         return {"ok": False, "stage": "filter", "error": str(e)}
 
+    result = {"ok": True, "preset": pkey, "intensity": k, "output_url": public_url(out, STATIC_DIR)}
+    await put_cached_transform(tkey, result)
+    return result
+
 
 # 7) FILTER VIDEO (enqueue)
 @router.post("/filter/video")
@@ -464,20 +421,54 @@ async def enqueue_filter_video(body: dict = Body(...)):
     job = await create_job(kind="video_filter", payload=payload)
     job_id = job["job_id"]
 
-    await rpush_job(job_id)
+    # тот же вход с теми же параметрами уже обрабатывали — задача сразу DONE
+    hit = await lookup_by_urls("video_filter", video_filter_params(payload), url)
+    if hit:
+        await update_job_status(job_id, DONE, result=hit, stage="done")
+    else:
+        await enqueue_job(job)
+
+    return {
+        "ok": True,
+        "job_id": job_id,
+        "status_url": f"/media/filter/status?job_id={job_id}",
+        "cached": bool(hit),
+    }
+
+
+# 8) PIPELINE (enqueue): transcode + filter + watermark + cover за один проход ffmpeg
+@router.post("/pipeline")
+async def enqueue_pipeline(body: dict = Body(...)):
+    try:
+        spec = normalize_pipeline(body)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(400, str(e))
+
+    job = await create_job(kind="video_pipeline", payload=spec)
+    job_id = job["job_id"]
+
+    hit = await lookup_by_urls("video_pipeline", pipeline_cache_params(spec), *pipeline_input_urls(spec))
+    if hit:
+        await update_job_status(job_id, DONE, result=hit, stage="done")
+    else:
+        await enqueue_job(job)
 
     return {
         "ok": True,
         "job_id": job_id,
         "status_url": f"/media/filter/status?job_id={job_id}",
+        "cached": bool(hit),
     }
 
 
 @router.get("/filter/status")
 async def media_filter_status(job_id: str):
-    job = await get_job(job_id)
+    job = await get_job_status(job_id)
     if not job:
         raise HTTPException(404, "Job not found")
+    result = None
+    if job.get("status") == DONE:
+        result = ((await get_job(job_id, fields=("result",))) or {}).get("result")
     return {
         "ok": True,
         "job_id": job_id,
@@ -485,6 +476,6 @@ async def media_filter_status(job_id: str):
         "status": job.get("status"),
         "created_at": job.get("created_at"),
         "updated_at": job.get("updated_at"),
-        "result": job.get("result"),
+        "result": result,
         "error": job.get("error"),
     }
@@ -45,7 +45,8 @@ def _uuid_name(prefix: str, ext: str) -> str:
     return uuid_name(prefix, ext)
 
 
-def _parse_aspect(aspect: Optional[str]) -> Optional[float]:
+def parse_aspect(aspect: Optional[str]) -> Optional[float]:
+    """"9:16" / "0.5625" → число; None, если не разобрать."""
     if not aspect:
         return None
     s = str(aspect).strip()
@@ -8,6 +8,9 @@ STATIC_DIR = BASE_DIR / "static"
 UPLOAD_DIR = STATIC_DIR / "uploads"
 OUT_DIR = STATIC_DIR / "out"
 
+# кеш скачанных медиа (download_cache.py) — вне static, на том же диске (hardlink)
+DOWNLOAD_CACHE_DIR = BASE_DIR / "cache" / "downloads"
+
 
 def ensure_dirs():
     for d in (STATIC_DIR, UPLOAD_DIR, OUT_DIR):
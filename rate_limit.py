@@ -0,0 +1,135 @@
+# rate_limit.py
+"""
+Распределённый rate limit (скользящее окно) как FastAPI-зависимость.
+
+    generate_limit = RateLimit("ai_generate", limit=10, window_sec=60)
+
+    @router.post("/generate/text", dependencies=[Depends(generate_limit)])
+
+Окно — ZSET в Redis (один Lua-вызов на запрос), поэтому лимит общий для
+всех воркеров и реплик. Окно по IP считается всегда: user_id из query
+не аутентифицирован, и ротацией ?user_id= его не обойти; если user_id
+передан, дополнительно действует окно пользователя (с нескольких IP).
+Квоты переопределяются в RATE_LIMITS ("ai_generate:10/60,ai_batch:3/60").
+Ответ несёт RateLimit-Limit / RateLimit-Remaining / RateLimit-Reset,
+при отказе — 429 с Retry-After.
+Если Redis недоступен — локальное окно в процессе; число ключей
+ограничено RATE_LIMIT_LOCAL_MAX_KEYS (LRU), чтобы память не росла.
+"""
+import math
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Literal, Optional, Tuple
+
+from fastapi import HTTPException, Request, Response
+
+from config import settings
+from jobs import redis_script
+
+# KEYS[1] = окно; ARGV = now_ms, window_ms, limit, member → {allowed, count, reset_ms}
+_SLIDING_WINDOW_LUA = """
+local key, now, window, limit = KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+local count = redis.call('ZCARD', key)
+local allowed = 0
+if count < limit then
+  redis.call('ZADD', key, now, ARGV[4])
+  count = count + 1
+  allowed = 1
+end
+redis.call('PEXPIRE', key, window)
+local reset = window
+local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+if oldest[2] then reset = tonumber(oldest[2]) + window - now end
+return {allowed, count, reset}
+"""
+
+_local: "OrderedDict[str, Deque[float]]" = OrderedDict()
+
+
+def _parse_quotas() -> Dict[str, Tuple[int, int]]:
+    """RATE_LIMITS вида "ai_generate:10/60,ai_batch:3/60" → {name: (limit, window_sec)}."""
+    quotas: Dict[str, Tuple[int, int]] = {}
+    for part in (settings.RATE_LIMITS or "").split(","):
+        name, _, spec = part.partition(":")
+        limit, _, window = spec.partition("/")
+        try:
+            quotas[name.strip()] = (int(limit), int(window or 60))
+        except ValueError:
+            continue
+    return quotas
+
+
+def _local_hit(key: str, now: float, limit: int, window_sec: int) -> Tuple[bool, int, float]:
+    bucket = _local.get(key)
+    if bucket is None:
+        bucket = _local[key] = deque()
+        while len(_local) > max(1, settings.RATE_LIMIT_LOCAL_MAX_KEYS):
+            _local.popitem(last=False)
+    _local.move_to_end(key)
+    while bucket and now - bucket[0] >= window_sec:
+        bucket.popleft()
+    allowed = len(bucket) < limit
+    if allowed:
+        bucket.append(now)
+    reset = (bucket[0] + window_sec - now) if bucket else window_sec
+    return allowed, len(bucket), reset
+
+
+class RateLimit:
+    """Зависимость FastAPI: лимит `limit` запросов за `window_sec` на ключ."""
+
+    def __init__(
+        self,
+        name: str,
+        limit: int,
+        window_sec: int,
+        key_by: Literal["ip_and_user", "user", "ip"] = "ip_and_user",
+    ):
+        self.name = name
+        self.limit, self.window_sec = _parse_quotas().get(name, (limit, window_sec))
+        self.key_by = key_by
+
+    def _identities(self, request: Request) -> List[str]:
+        """Окна, в которые засчитывается запрос; пройти нужно все."""
+        ip = request.client.host if request.client else "unknown"
+        user_id: Optional[str] = request.query_params.get("user_id")
+        if self.key_by == "user":
+            return [f"user:{user_id or 'anonymous'}"]
+        identities = [f"ip:{ip}"]
+        if self.key_by == "ip_and_user" and user_id:
+            identities.append(f"user:{user_id}")
+        return identities
+
+    async def hit(self, identity: str) -> Tuple[bool, int, float]:
+        """(разрешено, занято в окне, секунд до освобождения слота)"""
+        now = time.time()
+        try:
+            script = await redis_script(_SLIDING_WINDOW_LUA)
+            allowed, count, reset_ms = await script(
+                keys=[f"{settings.REDIS_PREFIX}:ratelimit:{self.name}:{identity}"],
+                args=[int(now * 1000), self.window_sec * 1000, self.limit, f"{int(now * 1000)}-{uuid.uuid4().hex[:8]}"],
+            )
+            return bool(allowed), int(count), int(reset_ms) / 1000
+        except Exception as e:
+            print(f"[rate_limit] redis unavailable, local window: {e}")
+            return _local_hit(f"{self.name}:{identity}", now, self.limit, self.window_sec)
+
+    async def __call__(self, request: Request, response: Response) -> None:
+        if not settings.RATE_LIMIT_ENABLED:
+            return
+        hits = [await self.hit(identity) for identity in self._identities(request)]
+        allowed = all(ok for ok, _, _ in hits)
+        count = max(used for _, used, _ in hits)
+        # при отказе Reset — когда освободятся все окна, где нет места
+        reset = max(wait for ok, _, wait in hits if allowed or not ok)
+        headers = {
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(max(0, self.limit - count)),
+            "RateLimit-Reset": str(max(0, math.ceil(reset))),
+        }
+        if not allowed:
+            headers["Retry-After"] = headers["RateLimit-Reset"]
+            raise HTTPException(429, "Rate limit exceeded. Try again later.", headers=headers)
+        response.headers.update(headers)
@@ -2,14 +2,12 @@
 """
 Роутер для управления множественными Instagram аккаунтами.
 """
-import json
 from typing import List, Optional
 from fastapi import APIRouter, HTTPException, Query, Body
 import httpx
 
-from http_client import RetryClient
+from http_client import shared_client
 from meta_config import ME_URL, GRAPH_BASE, APP_ID, APP_SECRET
-from jobs import get_redis
 from services.account_manager import (
     add_account,
     get_account,
@@ -19,20 +17,28 @@ from services.account_manager import (
     remove_account,
     _default_user_id,
     initialize_from_env,
-    _account_key,
+    count_accounts,
+    refresh_account,
+    refresh_accounts,
 )
 
 router = APIRouter(prefix="/accounts", tags=["accounts"])
 
 
 @router.get("/list")
-async def accounts_list(user_id: Optional[str] = Query(None, description="User ID (default: default_user)")):
+async def accounts_list(
+    user_id: Optional[str] = Query(None, description="User ID (default: default_user)"),
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=500, description="Page size (default: all)"),
+):
     """
-    Получает список всех аккаунтов пользователя.
+    Получает список аккаунтов пользователя в порядке добавления.
+    offset/limit — страница; total — сколько аккаунтов всего.
     """
     user_id = user_id or _default_user_id()
-    accounts = await list_accounts(user_id)
-    return {"ok": True, "accounts": accounts, "count": len(accounts)}
+    accounts = await list_accounts(user_id, offset=offset, limit=limit)
+    total = await count_accounts(user_id)
+    return {"ok": True, "accounts": accounts, "count": len(accounts), "total": total, "offset": offset}
 
 
 @router.get("/active")
@@ -90,7 +96,7 @@ async def accounts_add(
     """
     user_id = user_id or _default_user_id()
     
-    async with RetryClient() as client:
+    async with shared_client() as client:
         # Получаем список Pages
         r = await client.get(
             f"{ME_URL}/accounts",
@@ -185,39 +191,23 @@ async def accounts_refresh(
     """
     user_id = user_id or _default_user_id()
     
-    account = await get_account(user_id, account_id)
-    if not account:
-        raise HTTPException(404, f"Account {account_id} not found")
-    
-    access_token = account.get("access_token")
-    page_id = account.get("page_id")
+    async with shared_client() as client:
+        account = await refresh_account(user_id, account_id, client)
     
-    async with RetryClient() as client:
-        # Обновляем Instagram данные
-        r = await client.get(
-            f"{GRAPH_BASE}/{page_id}",
-            params={
-                "fields": "instagram_business_account{id,username}",
-                "access_token": access_token,
-            },
-            retries=4,
-        )
-        r.raise_for_status()
-        ig = r.json().get("instagram_business_account") or {}
-        ig_id = ig.get("id")
-        ig_username = ig.get("username")
-        
-        if not ig_id:
-            raise HTTPException(400, "This Page has no instagram_business_account linked.")
-        
-        # Обновляем аккаунт
-        account["ig_id"] = ig_id
-        account["ig_username"] = ig_username
-        
-        # Сохраняем обновленные данные
-        r_redis = await get_redis()
-        account_key = _account_key(user_id, account_id)
-        await r_redis.set(account_key, json.dumps(account))
-        
-        account_safe = {k: v for k, v in account.items() if k != "access_token"}
-        return {"ok": True, "message": "Account refreshed", "account": account_safe}
+    account_safe = {k: v for k, v in account.items() if k != "access_token"}
+    return {"ok": True, "message": "Account refreshed", "account": account_safe}
+
+
+@router.post("/refresh")
+async def accounts_refresh_many(
+    account_ids: Optional[List[str]] = Body(None, embed=True, description="Account IDs (default: all)"),
+    user_id: Optional[str] = Body(None, embed=True, description="User ID (default: default_user)"),
+):
+    """
+    Обновляет данные нескольких аккаунтов параллельно (по умолчанию — всех).
+    Ошибка одного аккаунта не прерывает остальные — смотрите results[].ok.
+    """
+    user_id = user_id or _default_user_id()
+    results = await refresh_accounts(user_id, account_ids)
+    refreshed = sum(1 for x in results if x["ok"])
+    return {"ok": True, "refreshed": refreshed, "failed": len(results) - refreshed, "results": results}
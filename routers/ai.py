@@ -1,13 +1,14 @@
-import time
 from typing import Any, Dict, List, Optional
 
-from fastapi import APIRouter, Body, HTTPException, Query, Request
+from fastapi import APIRouter, Body, Depends, HTTPException, Query
 
-from jobs import create_job, rpush_job, get_job
+from jobs import create_job, enqueue_job, get_job, get_job_status, DONE
+from rate_limit import RateLimit
 from services.ai_subscription import (
     get_subscription_status,
     check_credits,
-    use_credits,
+    reserve_credits,
+    refund_credits,
     set_subscription,
     cancel_subscription,
     AIAvatarPlanType,
@@ -18,20 +19,31 @@ from services.ai_subscription import (
 router = APIRouter(prefix="/ai", tags=["ai"])
 
 ALLOWED_ASPECTS = {"1:1", "3:4", "4:3", "9:16", "16:9", "5:8"}
-RATE_LIMIT_MAX = 10
-RATE_LIMIT_WINDOW_SEC = 60
-_rate_limit: Dict[str, List[float]] = {}
+# по IP (и по user_id, если передан); квоты переопределяются в RATE_LIMITS
+generate_limit = RateLimit("ai_generate", limit=10, window_sec=60)
+batch_limit = RateLimit("ai_batch", limit=3, window_sec=60)
 
 
-def _check_rate_limit(request: Request) -> None:
-    ip = (request.client.host if request.client else "unknown")
-    now = time.time()
-    bucket = _rate_limit.get(ip, [])
-    bucket = [t for t in bucket if now - t <= RATE_LIMIT_WINDOW_SEC]
-    if len(bucket) >= RATE_LIMIT_MAX:
-        raise HTTPException(429, "Rate limit exceeded. Try again later.")
-    bucket.append(now)
-    _rate_limit[ip] = bucket
+async def _reserve_or_402(uid: str, operation_type: str, what: str) -> str:
+    """Резервирует кредиты под задачу (списание при постановке, возврат при ошибке задачи)."""
+    hold = await reserve_credits(uid, operation_type)
+    if not hold["success"]:
+        raise HTTPException(
+            402,  # Payment Required
+            f"Cannot {what}: {hold['error']}. Please check your subscription and credits."
+        )
+    return hold["hold_id"]
+
+
+async def _enqueue_with_hold(kind: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """create_job + enqueue_job; если не получилось — резерв возвращается."""
+    try:
+        job = await create_job(kind, payload)
+        await enqueue_job(job)
+    except Exception:
+        await refund_credits(payload["credit_hold"])
+        raise
+    return job
 
 
 def _validate_steps(steps: Optional[int]) -> int:
@@ -57,44 +69,35 @@ def _validate_strength(strength: Optional[float]) -> float:
     return strength
 
 
-@router.post("/generate/text")
+@router.post("/generate/text", dependencies=[Depends(generate_limit)])
 async def ai_generate_text(
-    request: Request,
     prompt: str = Body(...),
     aspect_ratio: Optional[str] = Body(default="1:1"),
     steps: Optional[int] = Body(default=30),
     seed: Optional[int] = Body(default=None),
     user_id: Optional[str] = Query(None, description="User ID (default: default_user)"),
 ):
-    _check_rate_limit(request)
     if not prompt.strip():
         raise HTTPException(400, "prompt is required")
     
-    # Проверяем подписку и кредиты
     uid = user_id or _default_user_id()
-    credits_check = await check_credits(uid, "text_to_image")
-    if not credits_check["can_proceed"]:
-        raise HTTPException(
-            402,  # Payment Required
-            f"Cannot generate: {credits_check['reason']}. Please check your subscription and credits."
-        )
-    
     payload = {
         "prompt": prompt.strip(),
         "aspect_ratio": _validate_aspect(aspect_ratio),
         "steps": _validate_steps(steps),
         "seed": seed,
-        "user_id": uid,  # Сохраняем user_id для последующего списания кредитов
+        "user_id": uid,
         "operation_type": "text_to_image",
     }
-    job = await create_job("image_t2i", payload)
-    await rpush_job(job["job_id"])
+    # Кредиты резервируем только после валидации (списание атомарное):
+    # резерв — commit при DONE, refund при ERROR
+    payload["credit_hold"] = await _reserve_or_402(uid, "text_to_image", "generate")
+    job = await _enqueue_with_hold("image_t2i", payload)
     return {"ok": True, "job_id": job["job_id"], "status_url": f"/ai/status?job_id={job['job_id']}"}
 
 
-@router.post("/generate/image")
+@router.post("/generate/image", dependencies=[Depends(generate_limit)])
 async def ai_generate_image(
-    request: Request,
     image_url: str = Body(...),
     prompt: str = Body(...),
     strength: Optional[float] = Body(default=0.6),
@@ -103,21 +106,12 @@ async def ai_generate_image(
     seed: Optional[int] = Body(default=None),
     user_id: Optional[str] = Query(None, description="User ID (default: default_user)"),
 ):
-    _check_rate_limit(request)
     if not prompt.strip():
         raise HTTPException(400, "prompt is required")
     if not image_url.strip():
         raise HTTPException(400, "image_url is required")
     
-    # Проверяем подписку и кредиты
     uid = user_id or _default_user_id()
-    credits_check = await check_credits(uid, "image_to_image")
-    if not credits_check["can_proceed"]:
-        raise HTTPException(
-            402,  # Payment Required
-            f"Cannot generate: {credits_check['reason']}. Please check your subscription and credits."
-        )
-    
     payload = {
         "image_url": image_url.strip(),
         "prompt": prompt.strip(),
@@ -125,17 +119,18 @@ async def ai_generate_image(
         "aspect_ratio": _validate_aspect(aspect_ratio),
         "steps": _validate_steps(steps),
         "seed": seed,
-        "user_id": uid,  # Сохраняем user_id для последующего списания кредитов
+        "user_id": uid,
         "operation_type": "image_to_image",
     }
-    job = await create_job("image_i2i", payload)
-    await rpush_job(job["job_id"])
+    # Кредиты резервируем только после валидации (списание атомарное):
+    # резерв — commit при DONE, refund при ERROR
+    payload["credit_hold"] = await _reserve_or_402(uid, "image_to_image", "generate")
+    job = await _enqueue_with_hold("image_i2i", payload)
     return {"ok": True, "job_id": job["job_id"], "status_url": f"/ai/status?job_id={job['job_id']}"}
 
 
-@router.post("/generate/batch")
+@router.post("/generate/batch", dependencies=[Depends(batch_limit)])
 async def ai_generate_batch(
-    request: Request,
     image_urls: List[str] = Body(...),
     prompt: str = Body(...),
     strength: Optional[float] = Body(default=0.55),
@@ -145,7 +140,6 @@ async def ai_generate_batch(
     seed: Optional[int] = Body(default=None),
     user_id: Optional[str] = Query(None, description="User ID (default: default_user)"),
 ):
-    _check_rate_limit(request)
     if not prompt.strip():
         raise HTTPException(400, "prompt is required")
     cleaned_urls = [u.strip() for u in image_urls if u and u.strip()]
@@ -155,15 +149,7 @@ async def ai_generate_batch(
     if vpi < 1 or vpi > 4:
         raise HTTPException(400, "variants_per_image must be between 1 and 4")
     
-    # Проверяем подписку и кредиты для avatar batch
     uid = user_id or _default_user_id()
-    credits_check = await check_credits(uid, "avatar_batch")
-    if not credits_check["can_proceed"]:
-        raise HTTPException(
-            402,  # Payment Required
-            f"Cannot generate avatar batch: {credits_check['reason']}. Please check your subscription and credits."
-        )
-    
     payload = {
         "image_urls": cleaned_urls,
         "prompt": prompt.strip(),
@@ -172,19 +158,25 @@ async def ai_generate_batch(
         "steps": _validate_steps(steps),
         "variants_per_image": vpi,
         "seed": seed,
-        "user_id": uid,  # Сохраняем user_id для последующего списания кредитов
+        "user_id": uid,
         "operation_type": "avatar_batch",
     }
-    job = await create_job("avatar_batch", payload)
-    await rpush_job(job["job_id"])
+    # Кредиты для avatar batch резервируем только после валидации:
+    # резерв — commit при DONE, refund при ERROR
+    payload["credit_hold"] = await _reserve_or_402(uid, "avatar_batch", "generate avatar batch")
+    job = await _enqueue_with_hold("avatar_batch", payload)
     return {"ok": True, "job_id": job["job_id"], "status_url": f"/ai/status?job_id={job['job_id']}"}
 
 
 @router.get("/status")
 async def ai_status(job_id: str = Query(...)):
-    job = await get_job(job_id)
+    job = await get_job_status(job_id)
     if not job:
         return {"ok": False, "job_id": job_id, "status": "ERROR", "stage": "error", "error": "Job not found"}
+    # result (может быть большим) читаем только когда он уже есть
+    result = None
+    if job.get("status") == DONE:
+        result = ((await get_job(job_id, fields=("result",))) or {}).get("result")
     stage = job.get("stage")
     if not stage:
         status = job.get("status")
@@ -202,7 +194,8 @@ async def ai_status(job_id: str = Query(...)):
         "kind": job.get("kind"),
         "status": job.get("status"),
         "stage": stage,
-        "result": job.get("result"),
+        "progress": job.get("progress"),
+        "result": result,
         "error": job.get("error"),
     }
 
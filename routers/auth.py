@@ -6,7 +6,7 @@ import httpx
 from fastapi import APIRouter, HTTPException, Body
 from fastapi.responses import RedirectResponse
 
-from http_client import RetryClient
+from http_client import shared_client
 from meta_config import (
     APP_ID,
     APP_SECRET,
@@ -51,7 +51,7 @@ async def oauth_callback(
         raise HTTPException(400, "Invalid state or code")
     STATE_STORE.discard(state)
 
-    async with RetryClient() as client:
+    async with shared_client() as client:
         # 1) code -> short-lived
         r = await client.get(
             TOKEN_URL,
@@ -104,13 +104,14 @@ async def debug_scopes():
     if not APP_ID or not APP_SECRET:
         raise HTTPException(500, "META_APP_ID / META_APP_SECRET are not set.")
 
-    async with httpx.AsyncClient(timeout=20) as client:
+    async with shared_client() as client:
         r = await client.get(
             f"{GRAPH_BASE}/debug_token",
             params={
                 "input_token": IG_LONG_TOKEN,
                 "access_token": f"{APP_ID}|{APP_SECRET}",
             },
+            timeout=20,
         )
         r.raise_for_status()
 
@@ -135,7 +136,7 @@ async def refresh_token(current_token: Optional[str] = Body(None, embed=True)):
     if not APP_ID or not APP_SECRET:
         raise HTTPException(500, "META_APP_ID / META_APP_SECRET are not set.")
 
-    async with RetryClient() as client:
+    async with shared_client() as client:
         r = await client.get(
             TOKEN_URL,
             params={
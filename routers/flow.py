@@ -1,19 +1,15 @@
-import asyncio
-import time
-import subprocess
 from pathlib import Path
-from typing import Dict, Optional, Any
-import httpx
+from typing import Optional
 from fastapi import APIRouter, Body
 from errors import fail
 
 from paths import STATIC_DIR, OUT_DIR
 from file_utils import uuid_name
-from ffmpeg_utils import FFMPEG, has_ffmpeg
+from ffmpeg_utils import FFMPEG, FFmpegTimeoutError, has_ffmpeg, run_ffmpeg
 from fonts_utils import PIL_OK, pick_font
-from meta_config import CLOUDINARY_CLOUD, CLOUDINARY_UNSIGNED_PRESET
+from cloudinary_utils import cloudinary_unsigned_upload_file, job_upload_progress
 
-from jobs import create_job, get_job, lpush_job
+from jobs import create_job, enqueue_job, wait_for_job, PRIORITY_HIGH
 from services.ig_publish import publish_reel
 
 PIL_AVAILABLE = False
@@ -34,47 +30,6 @@ if PIL_OK:
 
 router = APIRouter(prefix="/flow", tags=["flow"])
 
-async def _cloudinary_unsigned_upload_file(
-    path: Path,
-    *,
-    resource_type: str = "video",
-    folder: Optional[str] = None,
-    public_id: Optional[str] = None,
-) -> Dict[str, Any]:
-    """
-    Загрузка локального файла в Cloudinary (unsigned).
-    Требуются ENV: CLOUDINARY_CLOUD и CLOUDINARY_UNSIGNED_PRESET.
-    """
-    if not CLOUDINARY_CLOUD or not CLOUDINARY_UNSIGNED_PRESET:
-        raise RuntimeError("Cloudinary not configured: set CLOUDINARY_CLOUD and CLOUDINARY_UNSIGNED_PRESET")
-    endpoint = (
-        f"https://api.cloudinary.com/v1_1/{CLOUDINARY_CLOUD}/{resource_type}/upload"
-    )
-    data = {"upload_preset": CLOUDINARY_UNSIGNED_PRESET}
-    if folder:
-        data["folder"] = folder
-    if public_id:
-        data["public_id"] = public_id
-
-    # определим mime
-    mime = "video/mp4" if resource_type == "video" else "image/jpeg"
-    files = {"file": (path.name, path.read_bytes(), mime)}
-
-    async with httpx.AsyncClient(timeout=300) as client:
-        r = await client.post(endpoint, data=data, files=files)
-        try:
-            r.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            try:
-                err = e.response.json()
-            except Exception:
-                err = {
-                    "status": e.response.status_code,
-                    "text": e.response.text[:500],
-                }
-            raise RuntimeError(f"Cloudinary upload failed: {err}")
-        return r.json()
-
 
 @router.post("/filter-and-publish")
 async def flow_filter_and_publish(
@@ -85,7 +40,7 @@ async def flow_filter_and_publish(
     share_to_feed: bool = Body(True, embed=True),
     cover_url: Optional[str] = Body(None, embed=True),
     timeout_sec: int = Body(600, embed=True),
-    poll_interval_sec: float = Body(1.5, embed=True),
+    poll_interval_sec: float = Body(1.5, embed=True),  # не используется: ожидание через pub/sub
     cloudinary_folder: Optional[str] = Body(None, embed=True),
 ):
     """
@@ -98,31 +53,21 @@ async def flow_filter_and_publish(
     job = await create_job(kind="video_filter", payload=payload)
     job_id = job["job_id"]  # create_job всегда возвращает dict
 
-    await lpush_job(job_id)
+    await enqueue_job(job, priority=PRIORITY_HIGH)  # запрос ждёт результат — high lane
     
-    # 2) wait for DONE (or ERROR/timeout)
-    deadline = time.time() + max(10, timeout_sec)
-    last_status = None
-    while time.time() < deadline:
-        j = await get_job(job_id)
-        if not j:
-            await asyncio.sleep(poll_interval_sec)
-            continue
-        st = (j.get("status") or "").upper()
-        last_status = {"status": st, "result": j.get("result"), "error": j.get("error")}
-        if st == "DONE":
-            break
-        if st == "ERROR":
-            return {
-                "ok": False,
-                "stage": "filter",
-                "job_id": job_id,
-                "error": j.get("error") or "unknown error",
-                "last_status": last_status,
-            }
-        await asyncio.sleep(poll_interval_sec)
+    # 2) wait for DONE (or ERROR/timeout) — pub/sub, без поллинга
+    j = await wait_for_job(job_id, timeout=max(10, timeout_sec))
+    st = ((j or {}).get("status") or "").upper()
+    if st == "ERROR":
+        return {
+            "ok": False,
+            "stage": "filter",
+            "job_id": job_id,
+            "error": (j or {}).get("error") or "unknown error",
+            "last_status": {"status": st, "error": (j or {}).get("error")},
+        }
 
-    if not last_status or last_status.get("status") != "DONE":
+    if st != "DONE":
         return {
             "ok": False,
             "stage": "filter",
@@ -130,7 +75,7 @@ async def flow_filter_and_publish(
             "error": "timeout waiting filter result",
         }
 
-    result = (await get_job(job_id) or {}).get("result") or {}
+    result = (j or {}).get("result") or {}
     out_url_local = result.get("output_url")
     if not out_url_local:
         return {
@@ -158,10 +103,11 @@ async def flow_filter_and_publish(
                 "error": f"local file not found: {local_path} (from output_url={out_url_local})",
             }
 
-        cld_resp = await _cloudinary_unsigned_upload_file(
+        cld_resp = await cloudinary_unsigned_upload_file(
             local_path,
             resource_type="video",
             folder=cloudinary_folder,
+            progress=job_upload_progress(job_id),
         )
         secure_url = cld_resp.get("secure_url")
         if not secure_url:
@@ -216,7 +162,7 @@ async def flow_filter_publish_with_cover(
     title_padding: int = Body(32, embed=True),
     cloudinary_folder: Optional[str] = Body(None, embed=True),
     timeout_sec: int = Body(600, embed=True),
-    poll_interval_sec: float = Body(1.5, embed=True),
+    poll_interval_sec: float = Body(1.5, embed=True),  # не используется: ожидание через pub/sub
 ):
     """
     Фильтруем видео → извлекаем кадр и рисуем титул → грузим в Cloudinary → публикуем в IG с cover.
@@ -228,25 +174,21 @@ async def flow_filter_publish_with_cover(
     job = await create_job(kind="video_filter", payload=payload)
     job_id = job["job_id"]
 
-    await lpush_job(job_id)  # <-- ОБЯЗАТЕЛЬНО, иначе воркер не увидит job
+    await enqueue_job(job, priority=PRIORITY_HIGH)  # <-- ОБЯЗАТЕЛЬНО, иначе воркер не увидит job
 
-    deadline = time.time() + max(10, timeout_sec)
+    j = await wait_for_job(job_id, timeout=max(10, timeout_sec))
     result = None
-    while time.time() < deadline:
-        j = await get_job(job_id)
-        if j:
-            st = (j.get("status") or "").upper()
-            if st == "DONE":
-                result = j.get("result") or {}
-                break
-            if st == "ERROR":
-                return {
-                    "ok": False,
-                    "stage": "filter",
-                    "job_id": job_id,
-                    "error": j.get("error"),
-                }
-        await asyncio.sleep(poll_interval_sec)
+    if j:
+        st = (j.get("status") or "").upper()
+        if st == "DONE":
+            result = j.get("result") or {}
+        elif st == "ERROR":
+            return {
+                "ok": False,
+                "stage": "filter",
+                "job_id": job_id,
+                "error": j.get("error"),
+            }
 
     if not result or not result.get("output_url"):
         return {
@@ -275,20 +217,20 @@ async def flow_filter_publish_with_cover(
         return {"ok": False, "stage": "ffmpeg", "error": "ffmpeg not available"}
 
     frame = OUT_DIR / uuid_name("cover_frame", ".jpg")
-    p = await asyncio.to_thread(
-        subprocess.run,
-        [
-            FFMPEG,
-            "-y",
-            "-ss", str(max(0.0, at)),
-            "-i", str(local_video_path),
-            "-frames:v", "1",
-            "-q:v", "2",
-            str(frame),
-        ],
-        capture_output=True,
-        text=True,
-    )
+    try:
+        p = await run_ffmpeg(
+            [
+                FFMPEG,
+                "-y",
+                "-ss", str(max(0.0, at)),
+                "-i", str(local_video_path),
+                "-frames:v", "1",
+                "-q:v", "2",
+                str(frame),
+            ],
+        )
+    except FFmpegTimeoutError as e:
+        return {"ok": False, "stage": "cover_frame", "error": str(e)}
     if p.returncode != 0:
         return {"ok": False, "stage": "cover_frame", "stderr": p.stderr[-800:]}
 
@@ -340,10 +282,13 @@ async def flow_filter_publish_with_cover(
 
     # 4) Cloudinary: грузим видео + обложку
     try:
-        cld_video = await _cloudinary_unsigned_upload_file(
-            local_video_path, resource_type="video", folder=cloudinary_folder
+        cld_video = await cloudinary_unsigned_upload_file(
+            local_video_path,
+            resource_type="video",
+            folder=cloudinary_folder,
+            progress=job_upload_progress(job_id),
         )
-        cld_cover = await _cloudinary_unsigned_upload_file(
+        cld_cover = await cloudinary_unsigned_upload_file(
             cover_path, resource_type="image", folder=cloudinary_folder
         )
     except Exception as e:
@@ -6,10 +6,17 @@ from uuid import uuid4
 from datetime import datetime, timezone
 
 from services.ig_state import load_state
-from http_client import RetryClient
+from http_client import RetryClient, shared_client
 from meta_config import GRAPH_BASE, CLOUDINARY_CLOUD
 from cloudinary_utils import cld_inject_transform, CLOUD_REELS_TRANSFORM
 from services.ig_publish import publish_reel
+from services.graph_batch import batch_get, graph_batch
+from services.graph_cache import (
+    COMMENT_INVALIDATES,
+    PUBLISH_INVALIDATES,
+    cached_graph_get,
+    invalidate_graph_cache,
+)
 from time_utils import iso_to_utc, sleep_seconds_until
 
 
@@ -102,10 +109,13 @@ async def ig_media(
     if after:
         params["after"] = after
 
-    async with RetryClient() as client:
-        r = await client.get(f"{GRAPH_BASE}/{ig_id}/media", params=params, retries=4)
-        r.raise_for_status()
-        payload = r.json()
+    async def fetch():
+        async with shared_client() as client:
+            r = await client.get(f"{GRAPH_BASE}/{ig_id}/media", params=params, retries=4)
+            r.raise_for_status()
+            return r.json()
+
+    payload = await cached_graph_get(ig_id, "media", params, fetch)
 
     return {
         "ok": True,
@@ -119,18 +129,19 @@ async def ig_media(
 @router.get("/comments")
 async def ig_comments(media_id: str = Query(...), limit: int = 25):
     st = await load_state()
-    async with RetryClient() as client:
-        r = await client.get(
-            f"{GRAPH_BASE}/{media_id}/comments",
-            params={
-                "access_token": st["page_token"],
-                "limit": max(1, min(limit, 50)),
-                "fields": "id,text,username,timestamp",
-            },
-            retries=4,
-        )
-        r.raise_for_status()
-        payload = r.json()
+    params = {
+        "access_token": st["page_token"],
+        "limit": max(1, min(limit, 50)),
+        "fields": "id,text,username,timestamp",
+    }
+
+    async def fetch():
+        async with shared_client() as client:
+            r = await client.get(f"{GRAPH_BASE}/{media_id}/comments", params=params, retries=4)
+            r.raise_for_status()
+            return r.json()
+
+    payload = await cached_graph_get(st["ig_id"], "comments", {"media_id": media_id, **params}, fetch)
 
     return {
         "ok": True,
@@ -198,7 +209,7 @@ async def ig_comment(
         raise HTTPException(400, "Provide media_id OR reply_to_comment_id")
 
     st = await load_state()
-    async with RetryClient() as client:
+    async with shared_client() as client:
         if reply_to_comment_id:
             r = await client.post(
                 f"{GRAPH_BASE}/{reply_to_comment_id}/replies",
@@ -212,6 +223,7 @@ async def ig_comment(
                 retries=4,
             )
         r.raise_for_status()
+    await invalidate_graph_cache(st["ig_id"], *COMMENT_INVALIDATES)
 
     return {"ok": True, "result": r.json()}
 
@@ -222,7 +234,7 @@ async def ig_comment_hide(
     hide: bool = Body(default=True, embed=True),
 ):
     st = await load_state()
-    async with RetryClient() as client:
+    async with shared_client() as client:
         try:
             r = await client.post(
                 f"{GRAPH_BASE}/{comment_id}",
@@ -233,6 +245,7 @@ async def ig_comment_hide(
                 retries=4,
             )
             r.raise_for_status()
+            await invalidate_graph_cache(st["ig_id"], *COMMENT_INVALIDATES)
             return {"ok": True}
         except httpx.HTTPStatusError as e:
             return {
@@ -245,7 +258,7 @@ async def ig_comment_hide(
 @router.post("/comments/delete")
 async def ig_comment_delete(comment_id: str = Body(..., embed=True)):
     st = await load_state()
-    async with RetryClient() as client:
+    async with shared_client() as client:
         r = await client.delete(
             f"{GRAPH_BASE}/{comment_id}",
             params={"access_token": st["page_token"]},
@@ -259,6 +272,7 @@ async def ig_comment_delete(comment_id: str = Body(..., embed=True)):
                 "status": e.response.status_code,
                 "error": e.response.json(),
             }
+    await invalidate_graph_cache(st["ig_id"], *COMMENT_INVALIDATES)
     return {"ok": True}
 
 
@@ -270,7 +284,7 @@ async def ig_comments_reply_many(
 ):
     st = await load_state()
     results = []
-    async with RetryClient() as client:
+    async with shared_client() as client:
         for cid in comment_ids:
             try:
                 r = await client.post(
@@ -290,6 +304,8 @@ async def ig_comments_reply_many(
                     }
                 )
             await asyncio.sleep(max(0.0, delay_ms / 1000.0))
+    if any(res["ok"] for res in results):
+        await invalidate_graph_cache(st["ig_id"], *COMMENT_INVALIDATES)
     return {"ok": True, "results": results}
 
 
@@ -300,7 +316,7 @@ async def ig_publish_image(
     caption: Optional[str] = Body(default=None, embed=True),
 ):
     st = await load_state()
-    async with RetryClient() as client:
+    async with shared_client() as client:
         try:
             payload = {"image_url": image_url, "access_token": st["page_token"]}
             if caption:
@@ -334,6 +350,7 @@ async def ig_publish_image(
                 timeout=60,
             )
             r2.raise_for_status()
+            await invalidate_graph_cache(st["ig_id"], *PUBLISH_INVALIDATES)
             return {"ok": True, "creation_id": creation_id, "published": r2.json()}
 
         except httpx.HTTPStatusError as e:
@@ -392,7 +409,7 @@ async def ig_publish_story_image(
     image_url: str = Body(..., embed=True),
 ):
     st = await load_state()
-    async with RetryClient() as client:
+    async with shared_client() as client:
         payload = {
             "access_token": st["page_token"],
             "image_url": image_url,
@@ -427,6 +444,7 @@ async def ig_publish_story_image(
                 timeout=60,
             )
             r2.raise_for_status()
+            await invalidate_graph_cache(st["ig_id"], *PUBLISH_INVALIDATES)
             return {"ok": True, "creation_id": creation_id, "published": r2.json()}
         except httpx.HTTPStatusError as e:
             try:
@@ -448,7 +466,7 @@ async def ig_publish_story_video(
     video_url: str = Body(..., embed=True),
 ):
     st = await load_state()
-    async with RetryClient() as client:
+    async with shared_client() as client:
         payload = {
             "access_token": st["page_token"],
             "video_url": video_url,
@@ -483,6 +501,7 @@ async def ig_publish_story_video(
                 timeout=60,
             )
             r2.raise_for_status()
+            await invalidate_graph_cache(st["ig_id"], *PUBLISH_INVALIDATES)
             return {"ok": True, "creation_id": creation_id, "published": r2.json()}
         except httpx.HTTPStatusError as e:
             try:
@@ -508,26 +527,27 @@ async def ig_profile(
     st = await load_state(account_id=account_id)
     ig_id, page_token = st["ig_id"], st["page_token"]
 
-    async with RetryClient() as client:
-        r = await client.get(
-            f"{GRAPH_BASE}/{ig_id}",
-            params={
-                "access_token": page_token,
-                "fields": ",".join([
-                    "id",
-                    "username",
-                    "name",
-                    "biography",
-                    "profile_picture_url",
-                    "media_count",
-                    "followers_count",
-                    "follows_count",
-                ]),
-            },
-            retries=4,
-        )
-        r.raise_for_status()
-        data = r.json()
+    params = {
+        "access_token": page_token,
+        "fields": ",".join([
+            "id",
+            "username",
+            "name",
+            "biography",
+            "profile_picture_url",
+            "media_count",
+            "followers_count",
+            "follows_count",
+        ]),
+    }
+
+    async def fetch():
+        async with shared_client() as client:
+            r = await client.get(f"{GRAPH_BASE}/{ig_id}", params=params, retries=4)
+            r.raise_for_status()
+            return r.json()
+
+    data = await cached_graph_get(ig_id, "profile", params, fetch)
 
     return {
         "ok": True,
@@ -596,22 +616,69 @@ def _pick_metrics_for_media(product_type: str) -> List[str]:
     return VIDEO_METRICS
 
 
+def _metrics_for_kind(mt_upper: str, override: List[str]) -> List[str]:
+    req_metrics = override or _pick_metrics_for_media(mt_upper)
+    # safety: impressions often not allowed for some types
+    if mt_upper in ("IMAGE", "PHOTO", "CAROUSEL", "CAROUSEL_ALBUM", "VIDEO"):
+        req_metrics = [m for m in req_metrics if m != "impressions"]
+    return req_metrics
+
+
+def _insight_value(entry: Dict[str, Any]) -> Any:
+    if isinstance(entry.get("total_value"), dict):
+        return entry["total_value"].get("value")
+    values = entry.get("values") or []
+    return values[0].get("value") if values and isinstance(values[0], dict) else None
+
+
+def _error_body(r: httpx.Response) -> Any:
+    """Тело ошибки Graph; не-JSON (HTML прокси, пустой ответ) — статус и начало текста."""
+    try:
+        return r.json()
+    except Exception:
+        return {"status": r.status_code, "text": r.text[:500]}
+
+
+async def _fetch_media_kind(client: RetryClient, media_id: str, token: str):
+    """
+    (media_type, product_type) одним GET. Если Graph не отдаёт product_type
+    для этого объекта — повтор только с media_type (product_type = None).
+    """
+    r = await client.get(
+        f"{GRAPH_BASE}/{media_id}",
+        params={"fields": "media_type,product_type", "access_token": token},
+        retries=4,
+    )
+    if r.status_code == 400:
+        r = await client.get(
+            f"{GRAPH_BASE}/{media_id}",
+            params={"fields": "media_type", "access_token": token},
+            retries=4,
+        )
+    r.raise_for_status()
+    data = r.json() or {}
+    return data.get("media_type", ""), data.get("product_type")
+
+
 @router.get("/insights/media")
 async def ig_media_insights(
     media_id: str = Query(..., description="Media ID"),
     metrics: str = Query("", description="Comma-separated metrics; if empty — auto by media type"),
 ):
     st = await load_state()
-    async with RetryClient() as client:
-        # media_type
+    return await cached_graph_get(
+        st["ig_id"],
+        "media_insights",
+        {"media_id": media_id, "metrics": metrics},
+        lambda: _fetch_media_insights(st, media_id, metrics),
+    )
+
+
+async def _fetch_media_insights(st: Dict[str, Any], media_id: str, metrics: str) -> Dict[str, Any]:
+    async with shared_client() as client:
+        # media_type + product_type одним запросом
         try:
-            r1 = await client.get(
-                f"{GRAPH_BASE}/{media_id}",
-                params={"fields": "media_type", "access_token": st["page_token"]},
-                retries=4,
-            )
-            r1.raise_for_status()
-            media_type = (r1.json() or {}).get("media_type", "")
+            media_type, product_type = await _fetch_media_kind(client, media_id, st["page_token"])
         except httpx.HTTPStatusError as e:
             return {
                 "ok": False,
@@ -620,29 +687,8 @@ async def ig_media_insights(
                 "error": (e.response.json() if (e.response is not None) else str(e)),
             }
 
-        # product_type (best-effort)
-        product_type = None
-        try:
-            r2 = await client.get(
-                f"{GRAPH_BASE}/{media_id}",
-                params={"fields": "product_type", "access_token": st["page_token"]},
-                retries=4,
-            )
-            if r2.status_code == 200:
-                product_type = (r2.json() or {}).get("product_type")
-        except Exception:
-            pass
-
         mt_upper = (product_type or media_type or "").upper()
-        req_metrics = (
-            [m.strip() for m in metrics.split(",") if m.strip()]
-            if metrics
-            else _pick_metrics_for_media(mt_upper)
-        )
-
-        # safety: impressions often not allowed for some types
-        if mt_upper in ("IMAGE", "PHOTO", "CAROUSEL", "CAROUSEL_ALBUM", "VIDEO"):
-            req_metrics = [m for m in req_metrics if m != "impressions"]
+        req_metrics = _metrics_for_kind(mt_upper, [m.strip() for m in metrics.split(",") if m.strip()])
 
         try:
             ins = await client.get(
@@ -672,6 +718,149 @@ async def ig_media_insights(
         }
 
 
+BULK_INSIGHTS_MAX_MEDIA = 100
+BULK_INSIGHTS_CONCURRENCY = 4  # одновременных batch-запросов (групп по типу)
+
+
+@router.post("/insights/media/bulk")
+async def ig_media_insights_bulk(
+    media_ids: Optional[List[str]] = Body(None, embed=True),
+    after: Optional[str] = Body(None, embed=True),
+    limit: int = Body(50, embed=True),
+    metrics: str = Body("", embed=True),
+    account_id: Optional[str] = Body(None, embed=True),
+):
+    """
+    Insights сразу для многих постов: media_ids (до 100) или страница /ig/media
+    (after + limit). Тип постов — одним field-запросом (batch), затем посты
+    группируются по набору метрик (_pick_metrics_for_media) и каждая группа
+    идёт batch-запросами параллельно. Ответ — одна таблица.
+    """
+    st = await load_state(account_id=account_id)
+    return await cached_graph_get(
+        st["ig_id"],
+        "media_insights",
+        {"bulk": media_ids, "after": after, "limit": limit, "metrics": metrics},
+        lambda: _fetch_media_insights_bulk(st, media_ids, after, limit, metrics),
+    )
+
+
+async def _fetch_media_insights_bulk(
+    st: Dict[str, Any],
+    media_ids: Optional[List[str]],
+    after: Optional[str],
+    limit: int,
+    metrics: str,
+) -> Dict[str, Any]:
+    token = st["page_token"]
+    override = [m.strip() for m in metrics.split(",") if m.strip()]
+    paging: Dict[str, Any] = {}
+    rows: Dict[str, Dict[str, Any]] = {}
+
+    async with shared_client() as client:
+        # 1) media_type + product_type
+        if media_ids:
+            ids = list(dict.fromkeys(m.strip() for m in media_ids if m and m.strip()))
+            if len(ids) > BULK_INSIGHTS_MAX_MEDIA:
+                return {
+                    "ok": False,
+                    "stage": "validate",
+                    "error": f"Too many media_ids: {len(ids)} > {BULK_INSIGHTS_MAX_MEDIA}",
+                }
+            try:
+                kinds = await graph_batch(
+                    client, token, [batch_get(mid, {"fields": "media_type,product_type,timestamp"}) for mid in ids]
+                )
+                # как в _fetch_media_kind: объекты без product_type отвечают 400 — повтор без него
+                rejected = [i for i, res in enumerate(kinds) if res["status"] == 400]
+                if rejected:
+                    retried = await graph_batch(
+                        client, token, [batch_get(ids[i], {"fields": "media_type,timestamp"}) for i in rejected]
+                    )
+                    for i, res in zip(rejected, retried):
+                        kinds[i] = res
+            except httpx.HTTPStatusError as e:
+                return {
+                    "ok": False,
+                    "stage": "get_media_type",
+                    "status": e.response.status_code,
+                    "error": _error_body(e.response),
+                }
+            for mid, res in zip(ids, kinds):
+                data = res["data"] or {}
+                rows[mid] = {
+                    "media_id": mid,
+                    "media_type": data.get("media_type"),
+                    "product_type": data.get("product_type"),
+                    "timestamp": data.get("timestamp"),
+                }
+                if not res["ok"]:
+                    rows[mid]["error"] = res["error"]
+        else:
+            params = {
+                "access_token": token,
+                "limit": max(1, min(limit, BULK_INSIGHTS_MAX_MEDIA)),
+                "fields": "id,media_type,product_type,timestamp",
+            }
+            if after:
+                params["after"] = after
+            r = await client.get(f"{GRAPH_BASE}/{st['ig_id']}/media", params=params, retries=4)
+            if r.status_code >= 400:
+                return {"ok": False, "stage": "list_media", "status": r.status_code, "error": _error_body(r)}
+            payload = r.json() or {}
+            paging = payload.get("paging", {})
+            for m in payload.get("data", []):
+                rows[m["id"]] = {
+                    "media_id": m["id"],
+                    "media_type": m.get("media_type"),
+                    "product_type": m.get("product_type"),
+                    "timestamp": m.get("timestamp"),
+                }
+
+        # 2) группы по набору метрик
+        groups: Dict[tuple, List[str]] = {}
+        for mid, row in rows.items():
+            if row.get("error"):
+                continue
+            mt_upper = (row.get("product_type") or row.get("media_type") or "").upper()
+            groups.setdefault(tuple(_metrics_for_kind(mt_upper, override)), []).append(mid)
+
+        # 3) insights: группы параллельно, внутри группы — batch по 50
+        sem = asyncio.Semaphore(BULK_INSIGHTS_CONCURRENCY)
+
+        async def fetch_group(group_metrics: tuple, mids: List[str]) -> None:
+            async with sem:
+                try:
+                    results = await graph_batch(
+                        client,
+                        token,
+                        [batch_get(f"{mid}/insights", {"metric": ",".join(group_metrics)}) for mid in mids],
+                    )
+                except httpx.HTTPStatusError as e:
+                    for mid in mids:
+                        rows[mid]["error"] = {"stage": "insights", "status": e.response.status_code}
+                    return
+            for mid, res in zip(mids, results):
+                rows[mid]["metrics"] = {}
+                if not res["ok"]:
+                    rows[mid]["error"] = res["error"]
+                    continue
+                for entry in (res["data"] or {}).get("data", []):
+                    rows[mid]["metrics"][entry.get("name")] = _insight_value(entry)
+
+        await asyncio.gather(*(fetch_group(gm, mids) for gm, mids in groups.items()))
+
+    columns = sorted({name for row in rows.values() for name in (row.get("metrics") or {})})
+    return {
+        "ok": True,
+        "count": len(rows),
+        "columns": columns,
+        "data": list(rows.values()),
+        "errors": sum(1 for row in rows.values() if row.get("error")),
+        "paging": paging,
+    }
+
+
 @router.get("/insights/account")
 async def ig_account_insights(
     metrics: str = Query("impressions,reach,profile_views"),
@@ -697,7 +886,16 @@ async def ig_account_insights(
             "error": f"Unsupported period: {period}. Allowed: {sorted(allowed_periods)}",
         }
 
-    async with RetryClient() as client:
+    return await cached_graph_get(
+        st["ig_id"],
+        "account_insights",
+        {"metrics": req_metrics, "period": period},
+        lambda: _fetch_account_insights(st, req_metrics, period),
+    )
+
+
+async def _fetch_account_insights(st: Dict[str, Any], req_metrics: List[str], period: str) -> Dict[str, Any]:
+    async with shared_client() as client:
         try:
             params = {
                 "metric": ",".join(req_metrics),
@@ -740,7 +938,7 @@ async def ig_comment_after_publish(
     message: str = Body(..., embed=True),
 ):
     st = await load_state()
-    async with RetryClient() as client:
+    async with shared_client() as client:
         r = await client.post(
             f"{GRAPH_BASE}/{media_id}/comments",
             data={"message": message, "access_token": st["page_token"]},
@@ -750,6 +948,7 @@ async def ig_comment_after_publish(
             r.raise_for_status()
         except httpx.HTTPStatusError as e:
             return {"ok": False, "stage": "comment", "error": e.response.json()}
+        await invalidate_graph_cache(st["ig_id"], *COMMENT_INVALIDATES)
         return {"ok": True, "result": r.json()}
 
 
@@ -764,7 +963,7 @@ async def _publish_job(
     await asyncio.sleep(wait)
     if JOBS.get(job_id, {}).get("status") == "canceled":
         return
-    async with RetryClient() as client:
+    async with shared_client() as client:
         try:
             r = await client.post(
                 f"{GRAPH_BASE}/{ig_id}/media_publish",
@@ -772,6 +971,7 @@ async def _publish_job(
                 retries=4,
             )
             r.raise_for_status()
+            await invalidate_graph_cache(ig_id, *PUBLISH_INVALIDATES)
             JOBS[job_id]["status"] = "done"
             JOBS[job_id]["result"] = r.json()
         except Exception as e:
@@ -824,7 +1024,7 @@ async def ig_publish_batch(
 ):
     st = await load_state()
     results = []
-    async with RetryClient() as client:
+    async with shared_client() as client:
         for it in items:
             t = (it.get("type") or "").lower()
             try:
@@ -863,6 +1063,7 @@ async def ig_publish_batch(
                         },
                     )
                     r2.raise_for_status()
+                    await invalidate_graph_cache(st["ig_id"], *PUBLISH_INVALIDATES)
                     results.append(
                         {
                             "type": "image",
@@ -923,6 +1124,7 @@ async def ig_publish_batch(
                         },
                     )
                     r2.raise_for_status()
+                    await invalidate_graph_cache(st["ig_id"], *PUBLISH_INVALIDATES)
                     results.append(
                         {
                             "type": "reel",
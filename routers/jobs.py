@@ -0,0 +1,47 @@
+import json
+
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+
+from jobs import get_job_status, iter_job_events, queue_stats
+
+router = APIRouter(prefix="/jobs", tags=["jobs"])
+
+
+@router.get("/queues")
+async def job_queues():
+    """
+    Глубина очередей по lane/priority, возраст самой старой задачи
+    и ожидание последних выданных задач (avg/p95).
+    """
+    return {"ok": True, **(await queue_stats())}
+
+
+@router.get("/{job_id}/events")
+async def job_events(
+    job_id: str,
+    request: Request,
+    timeout_sec: int = Query(900, ge=1, le=3600),
+):
+    """
+    Server-Sent Events вместо поллинга /ai/status и /media/filter/status:
+    первое событие — текущее состояние, дальше — каждый переход статуса,
+    последнее — DONE (с result) или ERROR; затем поток закрывается.
+    """
+    if not await get_job_status(job_id):
+        raise HTTPException(404, "Job not found")
+
+    async def stream():
+        async for job in iter_job_events(job_id, timeout=timeout_sec, keepalive_sec=15):
+            if await request.is_disconnected():
+                return
+            if job is None:
+                yield ": ping\n\n"
+                continue
+            yield f"event: status\ndata: {json.dumps(job)}\n\n"
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
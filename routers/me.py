@@ -4,7 +4,7 @@ from fastapi import APIRouter, Query
 import httpx
 
 from services.ig_state import load_state
-from http_client import RetryClient
+from http_client import shared_client
 from meta_config import IG_LONG_TOKEN, ME_URL, GRAPH_BASE
 
 router = APIRouter(prefix="/me", tags=["me"])
@@ -26,7 +26,7 @@ async def me_pages():
         return {"ok": False, "error": "IG_ACCESS_TOKEN not set"}
 
     out = []
-    async with RetryClient() as client:
+    async with shared_client() as client:
         r = await client.get(
             f"{ME_URL}/accounts",
             params={"access_token": IG_LONG_TOKEN, "fields": "id,name,access_token"},
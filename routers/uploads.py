@@ -1,10 +1,14 @@
+import re
 from pathlib import Path
-import uuid
+from typing import AsyncIterator, Optional, Set, Tuple
 
-from fastapi import APIRouter, File, UploadFile, HTTPException
+from fastapi import APIRouter, Depends, File, Query, Request, UploadFile, HTTPException
 
-from cloudinary_utils import cloudinary_unsigned_upload_file
+from cloudinary_utils import cloudinary_signed_upload_ticket, cloudinary_unsigned_upload_iter
 from config import settings
+from file_utils import SNIFF_BYTES, sniff_media_type
+from rate_limit import RateLimit
+from services.account_manager import count_accounts
 
 
 router = APIRouter(prefix="/uploads", tags=["uploads"])
@@ -13,6 +17,79 @@ ALLOWED_CONTENT_TYPES = {"image/jpeg", "image/png", "image/webp"}
 ALLOWED_VIDEO_TYPES = {"video/mp4", "video/quicktime", "video/x-msvideo", "video/mpeg"}
 MAX_UPLOAD_BYTES = 15 * 1024 * 1024
 MAX_VIDEO_UPLOAD_BYTES = 100 * 1024 * 1024  # 100MB for videos
+# расширения для allowed_formats в подписи прямой загрузки (= ALLOWED_VIDEO_TYPES)
+TICKET_VIDEO_FORMATS = ("mp4", "mov", "avi", "mpeg", "mpg")
+READ_CHUNK_BYTES = 1024 * 1024
+
+ticket_limit = RateLimit("upload_ticket", limit=20, window_sec=60)
+
+
+async def _upload_file_chunks(file: UploadFile) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await file.read(READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        yield chunk
+
+
+async def _sniff(chunks: AsyncIterator[bytes]) -> Tuple[Optional[str], AsyncIterator[bytes]]:
+    """Тип по первым байтам; возвращает тот же поток вместе с прочитанным началом."""
+    head = b""
+    async for block in chunks:
+        head += block
+        if len(head) >= SNIFF_BYTES:
+            break
+
+    async def replay() -> AsyncIterator[bytes]:
+        if head:
+            yield head
+        async for block in chunks:
+            yield block
+
+    return sniff_media_type(head), replay()
+
+
+async def _pass_through(
+    chunks: AsyncIterator[bytes],
+    size: Optional[int],
+    *,
+    filename: str,
+    allowed: Set[str],
+    max_bytes: int,
+    resource_type: str,
+    timeout_sec: int,
+    unsupported: str,
+) -> str:
+    """
+    Поток байтов → chunked upload в Cloudinary, без временного файла.
+    Лимит размера проверяется по заявленному size и по фактическому потоку.
+    """
+    if size is None:
+        raise HTTPException(411, "Content-Length required.")
+    if size > max_bytes:
+        raise HTTPException(413, f"File too large (max {max_bytes // (1024 * 1024)}MB).")
+
+    content_type, chunks = await _sniff(chunks)
+    if content_type not in allowed:
+        raise HTTPException(400, unsupported)
+
+    cld = await cloudinary_unsigned_upload_iter(
+        chunks,
+        size,
+        filename=filename,
+        content_type=content_type,
+        resource_type=resource_type,
+        timeout_sec=timeout_sec,
+    )
+    secure_url = cld.get("secure_url")
+    if not secure_url:
+        raise HTTPException(502, "Cloudinary upload failed: no secure_url")
+    return secure_url
+
+
+def _content_length(request: Request) -> Optional[int]:
+    raw = request.headers.get("content-length")
+    return int(raw) if raw and raw.isdigit() else None
 
 
 @router.post("/image")
@@ -20,33 +97,17 @@ async def upload_image(file: UploadFile = File(...)):
     if file.content_type not in ALLOWED_CONTENT_TYPES:
         raise HTTPException(400, "Unsupported file type. Use jpg/png/webp.")
 
-    tmp_dir = Path(settings.MEDIA_TMP_DIR)
-    tmp_dir.mkdir(parents=True, exist_ok=True)
-    suffix = Path(file.filename or "").suffix or ".jpg"
-    tmp_path = tmp_dir / f"upload_{uuid.uuid4().hex}{suffix}"
-
-    size = 0
-    try:
-        with tmp_path.open("wb") as f:
-            while True:
-                chunk = await file.read(1024 * 1024)
-                if not chunk:
-                    break
-                size += len(chunk)
-                if size > MAX_UPLOAD_BYTES:
-                    raise HTTPException(413, "File too large (max 15MB).")
-                f.write(chunk)
-
-        cld = await cloudinary_unsigned_upload_file(tmp_path, resource_type="image", timeout_sec=120)
-        image_url = cld.get("secure_url")
-        if not image_url:
-            raise HTTPException(502, "Cloudinary upload failed: no secure_url")
-        return {"ok": True, "image_url": image_url}
-    finally:
-        try:
-            tmp_path.unlink(missing_ok=True)
-        except Exception:
-            pass
+    image_url = await _pass_through(
+        _upload_file_chunks(file),
+        file.size,
+        filename=Path(file.filename or "").name or "upload.jpg",
+        allowed=ALLOWED_CONTENT_TYPES,
+        max_bytes=MAX_UPLOAD_BYTES,
+        resource_type="image",
+        timeout_sec=120,
+        unsupported="Unsupported file type. Use jpg/png/webp.",
+    )
+    return {"ok": True, "image_url": image_url}
 
 
 @router.post("/video")
@@ -54,30 +115,71 @@ async def upload_video(file: UploadFile = File(...)):
     if file.content_type not in ALLOWED_VIDEO_TYPES:
         raise HTTPException(400, "Unsupported file type. Use mp4/mov/avi/mpeg.")
 
-    tmp_dir = Path(settings.MEDIA_TMP_DIR)
-    tmp_dir.mkdir(parents=True, exist_ok=True)
-    suffix = Path(file.filename or "").suffix or ".mp4"
-    tmp_path = tmp_dir / f"upload_{uuid.uuid4().hex}{suffix}"
-
-    size = 0
-    try:
-        with tmp_path.open("wb") as f:
-            while True:
-                chunk = await file.read(1024 * 1024)
-                if not chunk:
-                    break
-                size += len(chunk)
-                if size > MAX_VIDEO_UPLOAD_BYTES:
-                    raise HTTPException(413, f"File too large (max {MAX_VIDEO_UPLOAD_BYTES // (1024*1024)}MB).")
-                f.write(chunk)
-
-        cld = await cloudinary_unsigned_upload_file(tmp_path, resource_type="video", timeout_sec=300)
-        video_url = cld.get("secure_url")
-        if not video_url:
-            raise HTTPException(502, "Cloudinary upload failed: no secure_url")
-        return {"ok": True, "video_url": video_url}
-    finally:
-        try:
-            tmp_path.unlink(missing_ok=True)
-        except Exception:
-            pass
+    video_url = await _pass_through(
+        _upload_file_chunks(file),
+        file.size,
+        filename=Path(file.filename or "").name or "upload.mp4",
+        allowed=ALLOWED_VIDEO_TYPES,
+        max_bytes=MAX_VIDEO_UPLOAD_BYTES,
+        resource_type="video",
+        timeout_sec=300,
+        unsupported="Unsupported file type. Use mp4/mov/avi/mpeg.",
+    )
+    return {"ok": True, "video_url": video_url}
+
+
+# --- Pass-through: сырое тело запроса (не multipart) сразу в Cloudinary
+
+
+@router.post("/image/stream")
+async def upload_image_stream(request: Request):
+    """Тело запроса — сам файл (Content-Length обязателен); тип определяется по байтам."""
+    image_url = await _pass_through(
+        request.stream(),
+        _content_length(request),
+        filename="upload.jpg",
+        allowed=ALLOWED_CONTENT_TYPES,
+        max_bytes=MAX_UPLOAD_BYTES,
+        resource_type="image",
+        timeout_sec=120,
+        unsupported="Unsupported file type. Use jpg/png/webp.",
+    )
+    return {"ok": True, "image_url": image_url}
+
+
+@router.post("/video/stream")
+async def upload_video_stream(request: Request):
+    """Тело запроса — сам файл (Content-Length обязателен); тип определяется по байтам."""
+    video_url = await _pass_through(
+        request.stream(),
+        _content_length(request),
+        filename="upload.mp4",
+        allowed=ALLOWED_VIDEO_TYPES,
+        max_bytes=MAX_VIDEO_UPLOAD_BYTES,
+        resource_type="video",
+        timeout_sec=300,
+        unsupported="Unsupported file type. Use mp4/mov/avi/mpeg.",
+    )
+    return {"ok": True, "video_url": video_url}
+
+
+@router.post("/video/ticket", dependencies=[Depends(ticket_limit)])
+async def upload_video_ticket(
+    user_id: str = Query(..., description="User ID with a connected account"),
+):
+    """
+    Подписанный тикет для загрузки напрямую в Cloudinary (мобильные клиенты,
+    большие видео): байты не идут через наш сервер. Выдаётся только
+    пользователю с подключённым аккаунтом; размер и формат ограничены
+    signed preset'ом и allowed_formats внутри подписи.
+    """
+    if await count_accounts(user_id) <= 0:
+        raise HTTPException(403, "No connected account for this user.")
+    ticket = cloudinary_signed_upload_ticket(
+        resource_type="video",
+        upload_preset=settings.CLOUDINARY_SIGNED_UPLOAD_PRESET,
+        allowed_formats=TICKET_VIDEO_FORMATS,
+        folder=settings.CLOUDINARY_UPLOAD_FOLDER,
+        tags=[f"user_{re.sub(r'[^A-Za-z0-9_-]', '_', user_id)}"],
+    )
+    return {"ok": True, "max_bytes": MAX_VIDEO_UPLOAD_BYTES, **ticket}
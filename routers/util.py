@@ -4,9 +4,11 @@ import time
 import httpx
 from fastapi import APIRouter, Body, HTTPException
 
+from http_client import UPSTREAM_CLOUDINARY, shared_client
 from meta_config import CLOUDINARY_CLOUD, CLOUDINARY_UNSIGNED_PRESET
 from paths import UPLOAD_DIR, OUT_DIR
 from fonts_utils import font_index
+from ffmpeg_utils import ffmpeg_diag, refresh_capabilities
 
 router = APIRouter(prefix="/util", tags=["util"])
 
@@ -27,8 +29,8 @@ async def cloudinary_upload(
     if public_id:
         form["public_id"] = public_id
 
-    async with httpx.AsyncClient(timeout=120) as client:
-        r = await client.post(endpoint, data=form)
+    async with shared_client(UPSTREAM_CLOUDINARY) as client:
+        r = await client.post(endpoint, data=form, timeout=120)
         try:
             r.raise_for_status()
         except httpx.HTTPStatusError as e:
@@ -64,6 +66,12 @@ def cleanup_tmp(hours: int = 12):
                 pass
     return {"ok": True, "removed": removed, "count": len(removed)}
 
+@router.post("/ffmpeg/refresh")
+async def ffmpeg_refresh():
+    """Перепробовать ffmpeg (после установки/обновления без рестарта)."""
+    await refresh_capabilities()
+    return {"ok": True, "ffmpeg": ffmpeg_diag()}
+
 @router.get("/fonts")
 def list_fonts(q: Optional[str] = None, limit: int = 100):
     idx = font_index()
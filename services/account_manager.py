@@ -2,14 +2,22 @@
 """
 Менеджер для управления множественными Instagram аккаунтами.
 Хранит информацию об аккаунтах в Redis.
+
+Аккаунт — hash {prefix}:account:{user_id}:{account_id}; старые записи
+(JSON-строка) переводятся в hash при первом чтении. Список аккаунтов
+пользователя — ZSET по created_at (стабильная пагинация); старый SET
+переносится туда при первом обращении. Чтение списка — ZRANGE + один
+Lua-вызов на всю страницу, а не GET на каждый аккаунт.
 """
+import asyncio
 import json
 import time
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Sequence
 import redis.asyncio as redis
+from fastapi import HTTPException
 
 from config import settings
-from jobs import get_redis
+from jobs import get_redis, redis_script
 
 
 def _account_key(user_id: str, account_id: str) -> str:
@@ -18,16 +26,118 @@ def _account_key(user_id: str, account_id: str) -> str:
 
 
 def _user_accounts_key(user_id: str) -> str:
-    """Redis ключ для списка аккаунтов пользователя"""
+    """Redis ключ старого списка аккаунтов пользователя (SET, только для миграции)"""
     return f"{settings.REDIS_PREFIX}:accounts:{user_id}"
 
 
+def _user_accounts_index_key(user_id: str) -> str:
+    """Redis ключ списка аккаунтов пользователя: ZSET account_id → created_at"""
+    return f"{settings.REDIS_PREFIX}:accounts_by_created:{user_id}"
+
+
+def _active_key(user_id: str) -> str:
+    return f"{settings.REDIS_PREFIX}:active_account:{user_id}"
+
+
 def _default_user_id() -> str:
     """Возвращает дефолтный user_id (пока используем один токен из env)"""
     # TODO: В будущем здесь будет реальный user_id из JWT токена или сессии
     return "default_user"
 
 
+# ── Хранение: hash + ленивая миграция из JSON ───────────────────────────
+# поля hash'а — строки; None не храним, bool — "1"/"0"
+_ACCOUNT_FIELDS = ("account_id", "page_id", "page_name", "access_token", "ig_id", "ig_username", "is_active", "created_at")
+_BOOL_FIELDS = {"is_active"}
+
+# Общая часть скриптов: прочитать аккаунт, по пути переведя JSON-строку в hash.
+_READ_ONE_LUA = """
+local function read_one(key)
+  local t = redis.call('TYPE', key)['ok']
+  if t == 'string' then
+    local data = cjson.decode(redis.call('GET', key))
+    redis.call('DEL', key)
+    local args = {}
+    for k, v in pairs(data) do
+      if v ~= cjson.null then
+        if type(v) == 'boolean' then v = v and '1' or '0' end
+        table.insert(args, k)
+        table.insert(args, tostring(v))
+      end
+    end
+    if #args > 0 then redis.call('HSET', key, unpack(args)) end
+  elseif t ~= 'hash' then
+    return {}
+  end
+  return redis.call('HGETALL', key)
+end
+"""
+
+# KEYS = ключи аккаунтов → [HGETALL...] в том же порядке ({} — нет аккаунта)
+_READ_MANY_LUA = _READ_ONE_LUA + """
+local out = {}
+for i, key in ipairs(KEYS) do out[i] = read_one(key) end
+return out
+"""
+
+# KEYS = index, legacy set, account, active; ARGV[1] = account_id → 1, если аккаунт был
+_REMOVE_LUA = """
+local existed = redis.call('ZREM', KEYS[1], ARGV[1]) + redis.call('SREM', KEYS[2], ARGV[1]) + redis.call('DEL', KEYS[3])
+if redis.call('GET', KEYS[4]) == ARGV[1] then redis.call('DEL', KEYS[4]) end
+return existed > 0 and 1 or 0
+"""
+
+
+def _encode(fields: Dict[str, Any]) -> Dict[str, str]:
+    out = {}
+    for k, v in fields.items():
+        if v is None:
+            continue
+        out[k] = ("1" if v else "0") if isinstance(v, bool) else str(v)
+    return out
+
+
+def _decode(flat: Sequence[str]) -> Optional[Dict[str, Any]]:
+    if not flat:
+        return None
+    raw = dict(zip(flat[::2], flat[1::2]))
+    account: Dict[str, Any] = {k: None for k in _ACCOUNT_FIELDS}
+    for k, v in raw.items():
+        account[k] = (v == "1") if k in _BOOL_FIELDS else v
+    return account
+
+
+def _created_ts(account: Dict[str, Any]) -> float:
+    try:
+        return float(json.loads(account.get("created_at") or "{}").get("timestamp") or 0)
+    except (ValueError, AttributeError):
+        return 0.0
+
+
+async def _read_accounts(user_id: str, account_ids: Sequence[str]) -> List[Optional[Dict[str, Any]]]:
+    if not account_ids:
+        return []
+    script = await redis_script(_READ_MANY_LUA)
+    rows = await script(keys=[_account_key(user_id, a) for a in account_ids])
+    return [_decode(row) for row in rows]
+
+
+async def _ensure_index(user_id: str) -> None:
+    """Переносит старый SET аккаунтов в ZSET по created_at (один раз)"""
+    r = await get_redis()
+    legacy = _user_accounts_key(user_id)
+    if not await r.exists(legacy):
+        return
+    account_ids = sorted(await r.smembers(legacy))
+    accounts = await _read_accounts(user_id, account_ids)
+    scores = {a: _created_ts(acc) for a, acc in zip(account_ids, accounts) if acc}
+    async with r.pipeline(transaction=True) as pipe:
+        if scores:
+            pipe.zadd(_user_accounts_index_key(user_id), scores, nx=True)
+        pipe.delete(legacy)
+        await pipe.execute()
+
+
 async def add_account(
     user_id: str,
     page_id: str,
@@ -51,8 +161,10 @@ async def add_account(
         Данные добавленного аккаунта
     """
     r = await get_redis()
+    await _ensure_index(user_id)
     
     account_id = page_id  # Используем page_id как account_id
+    now = time.time()
     
     account_data = {
         "account_id": account_id,
@@ -62,39 +174,78 @@ async def add_account(
         "ig_id": ig_id,
         "ig_username": ig_username,
         "is_active": True,
-        "created_at": json.dumps({"timestamp": time.time()}),
+        "created_at": json.dumps({"timestamp": now}),
     }
     
-    # Сохраняем данные аккаунта
+    # Сохраняем аккаунт и добавляем его в индекс пользователя одной транзакцией
     account_key = _account_key(user_id, account_id)
-    await r.set(account_key, json.dumps(account_data))
-    
-    # Добавляем account_id в список аккаунтов пользователя
-    user_accounts_key = _user_accounts_key(user_id)
-    await r.sadd(user_accounts_key, account_id)
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.delete(account_key)  # мог остаться в старом JSON-формате
+        pipe.hset(account_key, mapping=_encode(account_data))
+        pipe.zadd(_user_accounts_index_key(user_id), {account_id: now})
+        await pipe.execute()
+    await _invalidate_state(user_id)
     
     return account_data
 
 
 async def get_account(user_id: str, account_id: str) -> Optional[Dict[str, Any]]:
     """Получает данные конкретного аккаунта"""
+    return (await _read_accounts(user_id, [account_id]))[0]
+
+
+async def get_accounts(user_id: str, account_ids: Sequence[str]) -> List[Optional[Dict[str, Any]]]:
+    """Получает несколько аккаунтов за один запрос к Redis (None — аккаунта нет)"""
+    return await _read_accounts(user_id, list(account_ids))
+
+
+async def update_account(user_id: str, account_id: str, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Обновляет поля аккаунта (напр. ig_id после resolve/refresh); None — аккаунта нет"""
     r = await get_redis()
-    account_key = _account_key(user_id, account_id)
-    raw = await r.get(account_key)
-    if not raw:
+    account = await get_account(user_id, account_id)
+    if not account:
         return None
-    return json.loads(raw)
+    account.update(fields)
+    key = _account_key(user_id, account_id)
+    async with r.pipeline(transaction=True) as pipe:
+        values = _encode(fields)
+        if values:
+            pipe.hset(key, mapping=values)
+        empty = [k for k, v in fields.items() if v is None]
+        if empty:
+            pipe.hdel(key, *empty)
+        await pipe.execute()
+    await _invalidate_state(user_id)
+    return account
+
 
+async def _invalidate_state(user_id: str) -> None:
+    """Сбрасывает кеш load_state пользователя (на всех репликах)"""
+    from services.ig_state import invalidate_state
 
-async def list_accounts(user_id: str) -> List[Dict[str, Any]]:
-    """Получает список всех аккаунтов пользователя"""
+    await invalidate_state(user_id)
+
+
+async def count_accounts(user_id: str) -> int:
+    """Количество аккаунтов пользователя"""
+    await _ensure_index(user_id)
     r = await get_redis()
-    user_accounts_key = _user_accounts_key(user_id)
-    account_ids = await r.smembers(user_accounts_key)
+    return await r.zcard(_user_accounts_index_key(user_id))
+
+
+async def list_accounts(
+    user_id: str, offset: int = 0, limit: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """Получает список аккаунтов пользователя в порядке добавления (offset/limit — страница)"""
+    await _ensure_index(user_id)
+    r = await get_redis()
+    stop = -1 if limit is None else offset + max(0, limit) - 1
+    if stop < offset and stop != -1:
+        return []
+    account_ids = await r.zrange(_user_accounts_index_key(user_id), offset, stop)
     
     accounts = []
-    for account_id in account_ids:
-        account = await get_account(user_id, account_id)
+    for account in await _read_accounts(user_id, account_ids):
         if account:
             # Не возвращаем токен в списке (безопасность)
             account_safe = {k: v for k, v in account.items() if k != "access_token"}
@@ -113,8 +264,8 @@ async def set_active_account(user_id: str, account_id: str) -> bool:
         return False
     
     # Сохраняем ID активного аккаунта
-    active_key = f"{settings.REDIS_PREFIX}:active_account:{user_id}"
-    await r.set(active_key, account_id)
+    await r.set(_active_key(user_id), account_id)
+    await _invalidate_state(user_id)
     
     return True
 
@@ -122,35 +273,93 @@ async def set_active_account(user_id: str, account_id: str) -> bool:
 async def get_active_account(user_id: str) -> Optional[Dict[str, Any]]:
     """Получает активный аккаунт пользователя"""
     r = await get_redis()
-    active_key = f"{settings.REDIS_PREFIX}:active_account:{user_id}"
-    account_id = await r.get(active_key)
-    
+    account_id = await r.get(_active_key(user_id))
     if not account_id:
         return None
-    
-    return await get_account(user_id, account_id)
+    (account,) = await _read_accounts(user_id, [account_id])
+    return account
 
 
 async def remove_account(user_id: str, account_id: str) -> bool:
-    """Удаляет аккаунт из хранилища"""
-    r = await get_redis()
+    """Удаляет аккаунт из хранилища; False — такого аккаунта не было"""
+    script = await redis_script(_REMOVE_LUA)
+    existed = await script(
+        keys=[
+            _user_accounts_index_key(user_id),
+            _user_accounts_key(user_id),
+            _account_key(user_id, account_id),
+            _active_key(user_id),
+        ],
+        args=[account_id],
+    )
+    await _invalidate_state(user_id)
     
-    account_key = _account_key(user_id, account_id)
-    user_accounts_key = _user_accounts_key(user_id)
-    active_key = f"{settings.REDIS_PREFIX}:active_account:{user_id}"
-    
-    # Удаляем из списка аккаунтов
-    await r.srem(user_accounts_key, account_id)
+    return bool(existed)
+
+
+async def refresh_account(user_id: str, account_id: str, client) -> Dict[str, Any]:
+    """
+    Заново получает ig_id/ig_username аккаунта из Graph API и сохраняет их.
+    HTTPException: 404 — аккаунта нет, 400 — к Page не привязан IG.
+    """
+    from meta_config import GRAPH_BASE
+
+    account = await get_account(user_id, account_id)
+    if not account:
+        raise HTTPException(404, f"Account {account_id} not found")
     
-    # Удаляем данные аккаунта
-    await r.delete(account_key)
+    r = await client.get(
+        f"{GRAPH_BASE}/{account.get('page_id')}",
+        params={
+            "fields": "instagram_business_account{id,username}",
+            "access_token": account.get("access_token"),
+        },
+        retries=4,
+    )
+    r.raise_for_status()
+    ig = r.json().get("instagram_business_account") or {}
+    ig_id = ig.get("id")
+    ig_username = ig.get("username")
     
-    # Если это был активный аккаунт, очищаем
-    active_account_id = await r.get(active_key)
-    if active_account_id == account_id:
-        await r.delete(active_key)
+    if not ig_id:
+        raise HTTPException(400, "This Page has no instagram_business_account linked.")
     
-    return True
+    # Сохраняем обновленные данные (и сбрасываем кеш load_state)
+    account = await update_account(user_id, account_id, {"ig_id": ig_id, "ig_username": ig_username})
+    if not account:
+        raise HTTPException(404, f"Account {account_id} not found")
+    return account
+
+
+async def refresh_accounts(
+    user_id: str, account_ids: Optional[Sequence[str]] = None
+) -> List[Dict[str, Any]]:
+    """
+    refresh_account для многих аккаунтов (по умолчанию — всех) параллельно,
+    не больше ACCOUNT_REFRESH_CONCURRENCY одновременно. Ошибка одного
+    аккаунта не прерывает остальные: [{"account_id", "ok", "account"|"error"}].
+    """
+    from http_client import shared_client
+
+    if account_ids is None:
+        await _ensure_index(user_id)
+        r = await get_redis()
+        account_ids = await r.zrange(_user_accounts_index_key(user_id), 0, -1)
+    sem = asyncio.Semaphore(max(1, settings.ACCOUNT_REFRESH_CONCURRENCY))
+
+    async def one(client, account_id: str) -> Dict[str, Any]:
+        async with sem:
+            try:
+                account = await refresh_account(user_id, account_id, client)
+            except HTTPException as e:
+                return {"account_id": account_id, "ok": False, "status": e.status_code, "error": e.detail}
+            except Exception as e:
+                return {"account_id": account_id, "ok": False, "error": str(e)}
+        account_safe = {k: v for k, v in account.items() if k != "access_token"}
+        return {"account_id": account_id, "ok": True, "account": account_safe}
+
+    async with shared_client() as client:
+        return list(await asyncio.gather(*(one(client, a) for a in account_ids)))
 
 
 async def initialize_from_env() -> Optional[Dict[str, Any]]:
@@ -168,10 +377,10 @@ async def initialize_from_env() -> Optional[Dict[str, Any]]:
     page_id = PAGE_ID_ENV
     
     # Пытаемся получить Pages через API
-    from http_client import RetryClient
+    from http_client import shared_client
     from meta_config import ME_URL, GRAPH_BASE
     
-    async with RetryClient() as client:
+    async with shared_client() as client:
         r = await client.get(
             f"{ME_URL}/accounts",
             params={"access_token": settings.IG_ACCESS_TOKEN, "fields": "id,name,access_token"},
@@ -5,11 +5,12 @@
 """
 import json
 import time
+import uuid
 from datetime import datetime, timedelta
 from typing import Dict, Any, Optional, Literal
 from enum import Enum
 
-from jobs import get_redis
+from jobs import get_redis, redis_script
 from config import settings
 
 
@@ -189,6 +190,186 @@ async def cancel_subscription(user_id: str) -> bool:
     return deleted > 0
 
 
+# ── Кредиты: hash'и + атомарная проверка/списание в Lua ─────────────────
+# ai_credits:{user}            — hash: credits_remaining, reset_at, last_used_at
+# ai_daily_usage:{user}:{date} — hash: credits_used, date
+# ai_avatar_batch_usage:…      — hash: batches_used, date
+# Старые JSON-строки переводятся в hash самим скриптом при первом обращении.
+# Проверка и списание — один EVALSHA: параллельные задачи одного
+# пользователя не могут потратить кредиты дважды или потерять списание.
+
+# коды причин отказа (reason_code) → текст для пользователя
+REASON_OK = "ok"
+REASON_NO_SUBSCRIPTION = "no_subscription"
+REASON_NO_CREDITS_DATA = "no_credits_data"
+REASON_DAILY_LIMIT = "daily_limit"
+REASON_BATCH_NOT_INCLUDED = "batch_not_included"
+REASON_BATCH_DAILY_LIMIT = "batch_daily_limit"
+REASON_INSUFFICIENT = "insufficient_credits"
+
+HOLD_TTL_SEC = 7 * 86400  # резерв без commit/refund дольше этого — просто забывается
+
+_PLANS_JSON = json.dumps({plan.value: cfg for plan, cfg in PLAN_CONFIG.items()})
+
+_AS_HASH_LUA = """
+local function as_hash(key)
+  if redis.call('TYPE', key)['ok'] ~= 'string' then return end
+  local ttl = redis.call('PTTL', key)
+  local data = cjson.decode(redis.call('GET', key))
+  redis.call('DEL', key)
+  for k, v in pairs(data) do
+    if v ~= cjson.null and type(v) ~= 'table' then redis.call('HSET', key, k, tostring(v)) end
+  end
+  if ttl > 0 then redis.call('PEXPIRE', key, ttl) end
+end
+"""
+
+_READ_HASH_LUA = _AS_HASH_LUA + """
+as_hash(KEYS[1])
+return redis.call('HGETALL', KEYS[1])
+"""
+
+# KEYS: subscription, credits, daily, batch, hold
+# ARGV: operation, cost, plans_json, now_iso, today, daily_ttl, mode (check|deduct|reserve), user_id, hold_ttl
+# → {code, credits_needed, credits_remaining, daily_used, daily_limit, batch_per_day}
+_CHARGE_LUA = _AS_HASH_LUA + """
+local op, cost, mode = ARGV[1], tonumber(ARGV[2]), ARGV[7]
+local raw = redis.call('GET', KEYS[1])
+if not raw then return {'no_subscription', cost, 0, 0, 0, 0} end
+local sub = cjson.decode(raw)
+if string.sub(sub['expires_at'], 1, 19) < ARGV[4] then
+  redis.call('DEL', KEYS[1], KEYS[2])
+  return {'no_subscription', cost, 0, 0, 0, 0}
+end
+local plan = cjson.decode(ARGV[3])[sub['plan_type']]
+local daily_limit = tonumber(plan['daily_limit']) or 0
+local per_day = tonumber(plan['avatar_batch_per_day']) or 0
+
+as_hash(KEYS[2])
+if redis.call('EXISTS', KEYS[2]) == 0 then return {'no_credits_data', cost, 0, 0, daily_limit, per_day} end
+local remaining = tonumber(redis.call('HGET', KEYS[2], 'credits_remaining')) or 0
+as_hash(KEYS[3])
+local used = tonumber(redis.call('HGET', KEYS[3], 'credits_used')) or 0
+
+if used + cost > daily_limit then return {'daily_limit', cost, remaining, used, daily_limit, per_day} end
+local count_batch = false
+if op == 'avatar_batch' then
+  if not plan['avatar_batch_included'] then
+    return {'batch_not_included', cost, remaining, used, daily_limit, per_day}
+  end
+  if sub['plan_type'] == 'yearly' then
+    as_hash(KEYS[4])
+    local batches = tonumber(redis.call('HGET', KEYS[4], 'batches_used')) or 0
+    if batches >= per_day then return {'batch_daily_limit', cost, remaining, used, daily_limit, per_day} end
+    count_batch = true
+  end
+end
+if remaining < cost then return {'insufficient_credits', cost, remaining, used, daily_limit, per_day} end
+if mode == 'check' then return {'ok', cost, remaining, used, daily_limit, per_day} end
+
+remaining = redis.call('HINCRBY', KEYS[2], 'credits_remaining', -cost)
+redis.call('HSET', KEYS[2], 'last_used_at', ARGV[4])
+used = redis.call('HINCRBY', KEYS[3], 'credits_used', cost)
+redis.call('HSET', KEYS[3], 'date', ARGV[5])
+redis.call('EXPIRE', KEYS[3], tonumber(ARGV[6]))
+if count_batch then
+  redis.call('HINCRBY', KEYS[4], 'batches_used', 1)
+  redis.call('HSET', KEYS[4], 'date', ARGV[5])
+  redis.call('EXPIRE', KEYS[4], tonumber(ARGV[6]))
+end
+if mode == 'reserve' then
+  redis.call('HSET', KEYS[5], 'user_id', ARGV[8], 'operation', op, 'credits', cost,
+             'date', ARGV[5], 'batch', count_batch and '1' or '0')
+  redis.call('EXPIRE', KEYS[5], tonumber(ARGV[9]))
+end
+return {'ok', cost, remaining, used, daily_limit, per_day}
+"""
+
+# KEYS: hold, credits, daily, batch → сколько кредитов вернули (0 — резерва уже нет)
+_REFUND_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+local credits = tonumber(redis.call('HGET', KEYS[1], 'credits')) or 0
+local batch = redis.call('HGET', KEYS[1], 'batch') == '1'
+redis.call('DEL', KEYS[1])
+if redis.call('EXISTS', KEYS[2]) == 1 then redis.call('HINCRBY', KEYS[2], 'credits_remaining', credits) end
+if redis.call('EXISTS', KEYS[3]) == 1 then redis.call('HINCRBY', KEYS[3], 'credits_used', -credits) end
+if batch and redis.call('EXISTS', KEYS[4]) == 1 then redis.call('HINCRBY', KEYS[4], 'batches_used', -1) end
+return credits
+"""
+
+
+def _hold_key(hold_id: str) -> str:
+    """Redis ключ резерва кредитов под задачу"""
+    return f"{settings.REDIS_PREFIX}:ai_credit_hold:{hold_id}"
+
+
+def _daily_ttl_seconds() -> int:
+    """TTL дневных счётчиков: до конца дня + 1 день"""
+    now = datetime.now()
+    end_of_day = (now.replace(hour=23, minute=59, second=59) + timedelta(days=1))
+    return int((end_of_day - now).total_seconds())
+
+
+def _reason_text(code: str, credits_needed: int, credits_remaining: int, daily_limit: int, per_day: int) -> Optional[str]:
+    if code == REASON_OK:
+        return None
+    if code == REASON_NO_SUBSCRIPTION:
+        return "No active subscription"
+    if code == REASON_NO_CREDITS_DATA:
+        return "Credits data not found"
+    if code == REASON_DAILY_LIMIT:
+        return f"Daily limit reached ({daily_limit} credits/day)"
+    if code == REASON_BATCH_NOT_INCLUDED:
+        return "Avatar batch not included in this plan"
+    if code == REASON_BATCH_DAILY_LIMIT:
+        return f"Avatar batch daily limit reached ({per_day} batch/day)"
+    return f"Insufficient credits (need {credits_needed}, have {credits_remaining})"
+
+
+async def _read_hash(key: str) -> Dict[str, str]:
+    script = await redis_script(_READ_HASH_LUA)
+    flat = await script(keys=[key])
+    return dict(zip(flat[::2], flat[1::2]))
+
+
+async def _charge(
+    user_id: str,
+    operation_type: str,
+    mode: Literal["check", "deduct", "reserve"],
+    hold_id: str = "",
+) -> Dict[str, Any]:
+    """Один вызов Lua: проверка (и при mode != check — списание). Возвращает разобранный ответ."""
+    today = _get_today()
+    script = await redis_script(_CHARGE_LUA)
+    code, needed, remaining, used, daily_limit, per_day = await script(
+        keys=[
+            _subscription_key(user_id),
+            _credits_key(user_id),
+            _daily_usage_key(user_id, today),
+            _avatar_batch_usage_key(user_id, today),
+            _hold_key(hold_id or "-"),
+        ],
+        args=[
+            operation_type,
+            OPERATION_COSTS[operation_type],
+            _PLANS_JSON,
+            datetime.now().isoformat(timespec="seconds"),
+            today,
+            _daily_ttl_seconds(),
+            mode,
+            user_id,
+            HOLD_TTL_SEC,
+        ],
+    )
+    return {
+        "code": code,
+        "credits_needed": int(needed),
+        "credits_remaining": int(remaining),
+        "daily_used": int(used),
+        "reason": _reason_text(code, int(needed), int(remaining), int(daily_limit), int(per_day)),
+    }
+
+
 async def reset_credits(user_id: str, plan_type: AIAvatarPlanType) -> Dict[str, Any]:
     """
     Сбрасывает кредиты пользователя согласно плану.
@@ -212,11 +393,12 @@ async def reset_credits(user_id: str, plan_type: AIAvatarPlanType) -> Dict[str,
     
     # Сохраняем кредиты (TTL = период подписки + 1 день)
     period_seconds = config["period_days"] * 86400
-    await r.set(
-        _credits_key(user_id),
-        json.dumps(credits_data),
-        ex=period_seconds + 86400,
-    )
+    key = _credits_key(user_id)
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.delete(key)
+        pipe.hset(key, mapping=credits_data)
+        pipe.expire(key, period_seconds + 86400)
+        await pipe.execute()
     
     return credits_data
 
@@ -231,14 +413,12 @@ async def get_credits(user_id: str) -> Optional[Dict[str, Any]]:
     Returns:
         Информация о кредитах или None
     """
-    r = await get_redis()
-    key = _credits_key(user_id)
-    raw = await r.get(key)
-    
-    if not raw:
+    data = await _read_hash(_credits_key(user_id))
+    if not data:
         return None
     
-    return json.loads(raw)
+    data["credits_remaining"] = int(float(data.get("credits_remaining") or 0))
+    return data
 
 
 async def get_daily_usage(user_id: str, date: Optional[str] = None) -> int:
@@ -255,15 +435,8 @@ async def get_daily_usage(user_id: str, date: Optional[str] = None) -> int:
     if date is None:
         date = _get_today()
     
-    r = await get_redis()
-    key = _daily_usage_key(user_id, date)
-    raw = await r.get(key)
-    
-    if not raw:
-        return 0
-    
-    usage_data = json.loads(raw)
-    return usage_data.get("credits_used", 0)
+    data = await _read_hash(_daily_usage_key(user_id, date))
+    return int(float(data.get("credits_used") or 0))
 
 
 async def get_avatar_batch_usage(user_id: str, date: Optional[str] = None) -> int:
@@ -280,15 +453,8 @@ async def get_avatar_batch_usage(user_id: str, date: Optional[str] = None) -> in
     if date is None:
         date = _get_today()
     
-    r = await get_redis()
-    key = _avatar_batch_usage_key(user_id, date)
-    raw = await r.get(key)
-    
-    if not raw:
-        return 0
-    
-    usage_data = json.loads(raw)
-    return usage_data.get("batches_used", 0)
+    data = await _read_hash(_avatar_batch_usage_key(user_id, date))
+    return int(float(data.get("batches_used") or 0))
 
 
 async def check_credits(
@@ -296,7 +462,7 @@ async def check_credits(
     operation_type: Literal["text_to_image", "image_to_image", "avatar_batch"],
 ) -> Dict[str, Any]:
     """
-    Проверяет, достаточно ли кредитов для операции.
+    Проверяет, достаточно ли кредитов для операции (без списания).
     
     Args:
         user_id: ID пользователя
@@ -308,88 +474,18 @@ async def check_credits(
             "credits_needed": int,
             "credits_remaining": int,
             "daily_limit_reached": bool,
-            "reason": Optional[str]
+            "reason": Optional[str],
+            "reason_code": str
         }
     """
-    subscription = await get_subscription(user_id)
-    if not subscription:
-        return {
-            "can_proceed": False,
-            "credits_needed": OPERATION_COSTS[operation_type],
-            "credits_remaining": 0,
-            "daily_limit_reached": False,
-            "reason": "No active subscription",
-        }
-    
-    plan_type = AIAvatarPlanType(subscription["plan_type"])
-    config = PLAN_CONFIG[plan_type]
-    credits_needed = OPERATION_COSTS[operation_type]
-    
-    # Проверяем кредиты
-    credits_data = await get_credits(user_id)
-    if not credits_data:
-        return {
-            "can_proceed": False,
-            "credits_needed": credits_needed,
-            "credits_remaining": 0,
-            "daily_limit_reached": False,
-            "reason": "Credits data not found",
-        }
-    
-    credits_remaining = credits_data["credits_remaining"]
-    
-    # Проверяем дневной лимит
-    daily_usage = await get_daily_usage(user_id)
-    daily_limit = config["daily_limit"]
-    
-    if daily_usage + credits_needed > daily_limit:
-        return {
-            "can_proceed": False,
-            "credits_needed": credits_needed,
-            "credits_remaining": credits_remaining,
-            "daily_limit_reached": True,
-            "reason": f"Daily limit reached ({daily_limit} credits/day)",
-        }
-    
-    # Для avatar_batch проверяем специальные лимиты
-    if operation_type == "avatar_batch":
-        if not config.get("avatar_batch_included", False):
-            return {
-                "can_proceed": False,
-                "credits_needed": credits_needed,
-                "credits_remaining": credits_remaining,
-                "daily_limit_reached": False,
-                "reason": "Avatar batch not included in this plan",
-            }
-        
-        # Для yearly плана проверяем лимит batch в день
-        if plan_type == AIAvatarPlanType.YEARLY:
-            batch_usage = await get_avatar_batch_usage(user_id)
-            if batch_usage >= config.get("avatar_batch_per_day", 0):
-                return {
-                    "can_proceed": False,
-                    "credits_needed": credits_needed,
-                    "credits_remaining": credits_remaining,
-                    "daily_limit_reached": True,
-                    "reason": f"Avatar batch daily limit reached ({config.get('avatar_batch_per_day', 0)} batch/day)",
-                }
-    
-    # Проверяем общий баланс кредитов
-    if credits_remaining < credits_needed:
-        return {
-            "can_proceed": False,
-            "credits_needed": credits_needed,
-            "credits_remaining": credits_remaining,
-            "daily_limit_reached": False,
-            "reason": f"Insufficient credits (need {credits_needed}, have {credits_remaining})",
-        }
-    
+    res = await _charge(user_id, operation_type, "check")
     return {
-        "can_proceed": True,
-        "credits_needed": credits_needed,
-        "credits_remaining": credits_remaining,
-        "daily_limit_reached": False,
-        "reason": None,
+        "can_proceed": res["code"] == REASON_OK,
+        "credits_needed": res["credits_needed"],
+        "credits_remaining": res["credits_remaining"],
+        "daily_limit_reached": res["code"] in (REASON_DAILY_LIMIT, REASON_BATCH_DAILY_LIMIT),
+        "reason": res["reason"],
+        "reason_code": res["code"],
     }
 
 
@@ -398,8 +494,7 @@ async def use_credits(
     operation_type: Literal["text_to_image", "image_to_image", "avatar_batch"],
 ) -> Dict[str, Any]:
     """
-    Использует кредиты для операции.
-    Должен вызываться ПОСЛЕ успешной генерации.
+    Атомарно проверяет и списывает кредиты для операции.
     
     Args:
         user_id: ID пользователя
@@ -410,83 +505,76 @@ async def use_credits(
             "success": bool,
             "credits_used": int,
             "credits_remaining": int,
-            "error": Optional[str]
+            "error": Optional[str],
+            "reason_code": str
         }
     """
-    # Сначала проверяем
-    check_result = await check_credits(user_id, operation_type)
-    if not check_result["can_proceed"]:
-        return {
-            "success": False,
-            "credits_used": 0,
-            "credits_remaining": check_result["credits_remaining"],
-            "error": check_result["reason"],
-        }
-    
-    r = await get_redis()
-    credits_needed = OPERATION_COSTS[operation_type]
-    
-    # Обновляем кредиты
-    credits_key = _credits_key(user_id)
-    credits_raw = await r.get(credits_key)
-    if not credits_raw:
-        return {
-            "success": False,
-            "credits_used": 0,
-            "credits_remaining": 0,
-            "error": "Credits data not found",
-        }
-    
-    credits_data = json.loads(credits_raw)
-    credits_data["credits_remaining"] -= credits_needed
-    credits_data["last_used_at"] = datetime.now().isoformat()
-    
-    # Сохраняем обновленные кредиты
-    ttl = await r.ttl(credits_key)
-    await r.set(credits_key, json.dumps(credits_data), ex=ttl if ttl > 0 else 86400)
-    
-    # Обновляем дневное использование
-    today = _get_today()
-    daily_key = _daily_usage_key(user_id, today)
-    daily_raw = await r.get(daily_key)
-    
-    if daily_raw:
-        daily_data = json.loads(daily_raw)
-        daily_data["credits_used"] += credits_needed
-    else:
-        daily_data = {"credits_used": credits_needed, "date": today}
-    
-    # TTL до конца дня + 1 день
-    now = datetime.now()
-    end_of_day = (now.replace(hour=23, minute=59, second=59) + timedelta(days=1))
-    ttl_seconds = int((end_of_day - now).total_seconds())
-    await r.set(daily_key, json.dumps(daily_data), ex=ttl_seconds)
-    
-    # Для avatar_batch обновляем счетчик batch
-    if operation_type == "avatar_batch":
-        subscription = await get_subscription(user_id)
-        if subscription:
-            plan_type = AIAvatarPlanType(subscription["plan_type"])
-            if plan_type == AIAvatarPlanType.YEARLY:
-                batch_key = _avatar_batch_usage_key(user_id, today)
-                batch_raw = await r.get(batch_key)
-                
-                if batch_raw:
-                    batch_data = json.loads(batch_raw)
-                    batch_data["batches_used"] = batch_data.get("batches_used", 0) + 1
-                else:
-                    batch_data = {"batches_used": 1, "date": today}
-                
-                await r.set(batch_key, json.dumps(batch_data), ex=ttl_seconds)
+    res = await _charge(user_id, operation_type, "deduct")
+    ok = res["code"] == REASON_OK
+    return {
+        "success": ok,
+        "credits_used": res["credits_needed"] if ok else 0,
+        "credits_remaining": res["credits_remaining"],
+        "error": res["reason"],
+        "reason_code": res["code"],
+    }
+
+
+async def reserve_credits(
+    user_id: str,
+    operation_type: Literal["text_to_image", "image_to_image", "avatar_batch"],
+) -> Dict[str, Any]:
+    """
+    Резервирует кредиты при постановке задачи: списывает их сразу и
+    запоминает резерв (hold_id). Когда задача завершится — commit_credits
+    при успехе или refund_credits при ошибке.
     
+    Returns:
+        как use_credits + "hold_id" (None, если резерв не удался)
+    """
+    hold_id = uuid.uuid4().hex
+    res = await _charge(user_id, operation_type, "reserve", hold_id)
+    ok = res["code"] == REASON_OK
     return {
-        "success": True,
-        "credits_used": credits_needed,
-        "credits_remaining": credits_data["credits_remaining"],
-        "error": None,
+        "success": ok,
+        "hold_id": hold_id if ok else None,
+        "credits_used": res["credits_needed"] if ok else 0,
+        "credits_remaining": res["credits_remaining"],
+        "error": res["reason"],
+        "reason_code": res["code"],
     }
 
 
+async def commit_credits(hold_id: str) -> bool:
+    """Подтверждает резерв (кредиты остаются списанными). False — резерва уже нет."""
+    r = await get_redis()
+    return bool(await r.delete(_hold_key(hold_id)))
+
+
+async def refund_credits(hold_id: str) -> int:
+    """
+    Возвращает зарезервированные кредиты (и дневной счётчик). Идемпотентно:
+    повторный вызов или вызов после commit ничего не делает. Возвращает
+    сколько кредитов вернули.
+    """
+    r = await get_redis()
+    hold = await r.hgetall(_hold_key(hold_id))
+    if not hold:
+        return 0
+    user_id, date = hold.get("user_id") or "", hold.get("date") or _get_today()
+    script = await redis_script(_REFUND_LUA)
+    return int(
+        await script(
+            keys=[
+                _hold_key(hold_id),
+                _credits_key(user_id),
+                _daily_usage_key(user_id, date),
+                _avatar_batch_usage_key(user_id, date),
+            ]
+        )
+    )
+
+
 async def get_subscription_status(user_id: str) -> Dict[str, Any]:
     """
     Получает полный статус подписки пользователя.
@@ -0,0 +1,82 @@
+# services/graph_batch.py
+"""
+Graph API batch: независимые GET-запросы пачками до 50 штук в одном
+POST {GRAPH_BASE}/ c полем batch=[...] — один round trip вместо N.
+
+Ответы разбираются по позициям: у каждого под-запроса свой статус и
+своя ошибка, падение одного элемента не ломает остальные. Элементы,
+на которые Meta не успела ответить (null в ответе), повторяются один раз.
+"""
+import asyncio
+import json
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlencode
+
+from http_client import RetryClient
+from meta_config import GRAPH_BASE
+
+GRAPH_BATCH_LIMIT = 50
+
+
+def batch_get(path: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, str]:
+    """Под-запрос GET; path — относительно версии API, напр. "{media_id}/insights"."""
+    rel = path.lstrip("/")
+    if params:
+        rel = f"{rel}?{urlencode({k: v for k, v in params.items() if v is not None})}"
+    return {"method": "GET", "relative_url": rel}
+
+
+def _parse_item(item: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if item is None:
+        return {"ok": False, "status": None, "data": None, "error": {"message": "No response in batch (timeout)"}}
+    status = item.get("code")
+    try:
+        body = json.loads(item.get("body") or "null")
+    except ValueError:
+        body = {"raw": (item.get("body") or "")[:500]}
+    error = body.get("error") if isinstance(body, dict) else None
+    ok = status is not None and 200 <= int(status) < 300 and not error
+    return {"ok": ok, "status": status, "data": body if ok else None, "error": None if ok else (error or body)}
+
+
+async def _post_chunk(
+    client: RetryClient, access_token: str, chunk: Sequence[Dict[str, str]]
+) -> List[Optional[Dict[str, Any]]]:
+    r = await client.post(
+        f"{GRAPH_BASE}/",
+        data={
+            "access_token": access_token,
+            "include_headers": "false",
+            "batch": json.dumps(list(chunk)),
+        },
+        timeout=120,
+    )
+    r.raise_for_status()  # ошибка всего батча (токен, лимиты) — как у обычного запроса
+    items = r.json() or []
+    return list(items) + [None] * (len(chunk) - len(items))
+
+
+async def graph_batch(
+    client: RetryClient,
+    access_token: str,
+    requests: Sequence[Dict[str, str]],
+) -> List[Dict[str, Any]]:
+    """
+    Выполняет под-запросы (см. batch_get) и возвращает результаты в том же
+    порядке: {"ok", "status", "data", "error"}. Пачки по GRAPH_BATCH_LIMIT
+    уходят параллельно. Ошибка HTTP всего батча пробрасывается
+    (httpx.HTTPStatusError), ошибки элементов — в их "error".
+    """
+    chunks = [requests[i:i + GRAPH_BATCH_LIMIT] for i in range(0, len(requests), GRAPH_BATCH_LIMIT)]
+    raw: List[Optional[Dict[str, Any]]] = []
+    for part in await asyncio.gather(*(_post_chunk(client, access_token, c) for c in chunks)):
+        raw.extend(part)
+
+    # элементы без ответа (Meta обрезала батч по времени) — ещё одна попытка
+    missing: List[Tuple[int, Dict[str, str]]] = [(i, requests[i]) for i, it in enumerate(raw) if it is None]
+    if missing:
+        retry = await _post_chunk(client, access_token, [req for _, req in missing][:GRAPH_BATCH_LIMIT])
+        for (i, _req), item in zip(missing, retry):
+            raw[i] = item
+
+    return [_parse_item(item) for item in raw]
@@ -0,0 +1,177 @@
+# services/graph_cache.py
+"""
+Read-through кеш ответов Graph API в Redis.
+
+Ключ: аккаунт (ig_id) + endpoint + нормализованные параметры.
+- свежая запись (моложе TTL endpoint'а) — отдаётся без похода в Graph;
+- устаревшая, но в пределах GRAPH_CACHE_STALE_SEC — отдаётся сразу,
+  а обновление идёт в фоне (stale-while-revalidate);
+- промах — один запрос в Graph на все одновременные промахи: локально
+  через общий Task, между репликами — через короткий Redis-лок.
+Ответы с "ok": False, с ненулевым "errors" (частичные сбои bulk-запросов,
+в т.ч. троттлинг отдельных элементов) и исключения не кешируются.
+Мутации (публикация, комментарии) сбрасывают записи аккаунта через
+invalidate_graph_cache — ключи аккаунта лежат в отдельном SET.
+Без Redis кеш просто пропускается.
+"""
+import asyncio
+import hashlib
+import json
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from config import settings
+from jobs import get_redis
+
+# TTL (сек) по endpoint'ам: профиль и инсайты меняются медленно, комментарии — быстрее
+GRAPH_CACHE_TTLS: Dict[str, int] = {
+    "profile": 300,
+    "media": 120,
+    "comments": 60,
+    "media_insights": 900,
+    "account_insights": 1800,
+}
+
+# что сбрасывать после мутаций
+PUBLISH_INVALIDATES = ("media", "profile", "account_insights", "media_insights")
+COMMENT_INVALIDATES = ("comments", "media_insights")
+
+_LOCK_TTL_SEC = 30
+_LOCK_WAIT_SEC = 5.0
+
+_inflight: Dict[str, "asyncio.Task[Any]"] = {}
+_background: Set["asyncio.Task[Any]"] = set()
+
+
+def _cache_key(account: str, endpoint: str, params: Dict[str, Any]) -> str:
+    # токен в ключ не входит: аккаунт уже задан, а токены ротируются
+    norm = json.dumps(
+        {k: params[k] for k in sorted(params) if params[k] is not None and k != "access_token"},
+        separators=(",", ":"),
+    )
+    digest = hashlib.sha1(norm.encode()).hexdigest()[:20]
+    return f"{settings.REDIS_PREFIX}:gcache:{account}:{endpoint}:{digest}"
+
+
+def _index_key(account: str) -> str:
+    return f"{settings.REDIS_PREFIX}:gcache_idx:{account}"
+
+
+def _cacheable(value: Any) -> bool:
+    if not isinstance(value, dict):
+        return True
+    return value.get("ok") is not False and not value.get("errors")
+
+
+async def _store(key: str, account: str, value: Any, ttl: int) -> None:
+    r = await get_redis()
+    keep = ttl + settings.GRAPH_CACHE_STALE_SEC
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.set(key, json.dumps({"at": time.time(), "value": value}), ex=keep)
+        pipe.sadd(_index_key(account), key)
+        pipe.expire(_index_key(account), keep)
+        await pipe.execute()
+
+
+async def _fetch_and_store(
+    key: str, account: str, ttl: int, fetch: Callable[[], Awaitable[Any]]
+) -> Any:
+    """Один поход в Graph на ключ: остальные реплики ждут записи под локом."""
+    lock = f"{key}:lock"
+    try:
+        r = await get_redis()
+        locked = await r.set(lock, "1", nx=True, ex=_LOCK_TTL_SEC)
+    except Exception:
+        return await fetch()
+    if not locked:
+        # другая реплика уже запрашивает — ждём её результат, потом идём сами
+        deadline = time.monotonic() + _LOCK_WAIT_SEC
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+            raw = await r.get(key)
+            if raw and time.time() - json.loads(raw)["at"] < ttl:
+                return json.loads(raw)["value"]
+    try:
+        value = await fetch()
+        if _cacheable(value):
+            try:
+                await _store(key, account, value, ttl)
+            except Exception as e:
+                print(f"[graph_cache] store failed key={key}: {e}")
+        return value
+    finally:
+        if locked:
+            try:
+                await r.delete(lock)
+            except Exception:
+                pass
+
+
+def _single_flight(key: str, factory: Callable[[], Awaitable[Any]]) -> "asyncio.Task[Any]":
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        _inflight[key] = task
+        task.add_done_callback(lambda _t: _inflight.pop(key, None))
+    return task
+
+
+async def cached_graph_get(
+    account: str,
+    endpoint: str,
+    params: Dict[str, Any],
+    fetch: Callable[[], Awaitable[Any]],
+    *,
+    ttl: Optional[int] = None,
+) -> Any:
+    """
+    Вернуть закешированный результат fetch() для (account, endpoint, params).
+    fetch — корутина-функция, которая ходит в Graph и возвращает JSON-совместимое значение.
+    """
+    if not settings.GRAPH_CACHE_ENABLED or not account:
+        return await fetch()
+    ttl = ttl or GRAPH_CACHE_TTLS.get(endpoint, 60)
+    key = _cache_key(account, endpoint, params)
+
+    try:
+        r = await get_redis()
+        raw = await r.get(key)
+    except Exception:
+        return await fetch()
+
+    if raw:
+        entry = json.loads(raw)
+        if time.time() - entry["at"] < ttl:
+            return entry["value"]
+        # stale-while-revalidate: отдаём что есть, обновляем в фоне
+        if key not in _inflight:
+            task = _single_flight(key, lambda: _fetch_and_store(key, account, ttl, fetch))
+            _background.add(task)
+            task.add_done_callback(_background.discard)
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return entry["value"]
+
+    # shield: отмена одного запроса-ожидающего не отменяет общий fetch
+    return await asyncio.shield(_single_flight(key, lambda: _fetch_and_store(key, account, ttl, fetch)))
+
+
+async def invalidate_graph_cache(account: str, *endpoints: str) -> int:
+    """Сбросить кеш аккаунта: все endpoint'ы или только перечисленные."""
+    if not account:
+        return 0
+    try:
+        r = await get_redis()
+        keys = await r.smembers(_index_key(account))
+        prefix = f"{settings.REDIS_PREFIX}:gcache:{account}:"
+        if endpoints:
+            keys = {k for k in keys if k[len(prefix):].split(":", 1)[0] in endpoints}
+        if not keys:
+            return 0
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.delete(*keys)
+            pipe.srem(_index_key(account), *keys)
+            await pipe.execute()
+        return len(keys)
+    except Exception as e:
+        print(f"[graph_cache] invalidate failed account={account}: {e}")
+        return 0
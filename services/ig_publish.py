@@ -2,9 +2,10 @@
 import asyncio
 import httpx
 from typing import Optional
-from http_client import RetryClient
+from http_client import shared_client
 from meta_config import GRAPH_BASE
 from services.ig_state import load_state
+from services.graph_cache import PUBLISH_INVALIDATES, invalidate_graph_cache
 from cloudinary_utils import cld_inject_transform, CLOUD_REELS_TRANSFORM
 
 async def publish_reel(
@@ -17,7 +18,7 @@ async def publish_reel(
     video_url = cld_inject_transform(video_url, CLOUD_REELS_TRANSFORM)
     st = await load_state()
 
-    async with RetryClient() as client:
+    async with shared_client() as client:
         payload = {
             "access_token": st["page_token"],
             "video_url": video_url,
@@ -64,4 +65,5 @@ async def publish_reel(
             timeout=60,
         )
         r2.raise_for_status()
+        await invalidate_graph_cache(st["ig_id"], *PUBLISH_INVALIDATES)
         return {"ok": True, "creation_id": creation_id, "published": r2.json()}
@@ -1,15 +1,123 @@
-from typing import Dict, Any, Optional
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
 
 from fastapi import HTTPException
 
-from http_client import RetryClient
+from config import settings
+from http_client import RetryClient, shared_client
+from jobs import get_redis
 from meta_config import IG_LONG_TOKEN, PAGE_ID_ENV, ME_URL, GRAPH_BASE
 from services.account_manager import (
     get_active_account,
     get_account,
+    update_account,
     _default_user_id,
 )
 
+# ── Кеш состояния ───────────────────────────────────────────────────────
+# Уровень 1: LRU в процессе с коротким TTL (IG_STATE_CACHE_TTL_SEC) —
+# большинство IG-запросов не ходят ни в Redis, ни в Graph.
+# Уровень 2: Redis — у аккаунтов resolved ig_id пишется обратно в запись
+# аккаунта, для env-токена — в отдельный ключ с TTL.
+# Смена/обновление/удаление аккаунта сбрасывает уровень 1 на всех репликах
+# через pub/sub; если подписка недоступна, устаревание ограничено TTL.
+_ACTIVE = "@active"
+_state_cache: "OrderedDict[Tuple[str, str], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_listener: Optional[asyncio.Task] = None
+
+
+def _invalidate_channel() -> str:
+    return f"{settings.REDIS_PREFIX}:ig_state:invalidate"
+
+
+def _env_state_key() -> str:
+    digest = hashlib.sha1(f"{IG_LONG_TOKEN}:{PAGE_ID_ENV}".encode()).hexdigest()[:16]
+    return f"{settings.REDIS_PREFIX}:ig_state:env:{digest}"
+
+
+def _cache_get(key: Tuple[str, str]) -> Optional[Dict[str, Any]]:
+    hit = _state_cache.get(key)
+    if hit is None:
+        return None
+    expires_at, state = hit
+    if expires_at < time.monotonic():
+        _state_cache.pop(key, None)
+        return None
+    _state_cache.move_to_end(key)
+    return dict(state)
+
+
+def _cache_put(key: Tuple[str, str], state: Dict[str, Any]) -> None:
+    _state_cache[key] = (time.monotonic() + settings.IG_STATE_CACHE_TTL_SEC, dict(state))
+    _state_cache.move_to_end(key)
+    while len(_state_cache) > max(1, settings.IG_STATE_CACHE_SIZE):
+        _state_cache.popitem(last=False)
+
+
+def _drop_local(user_id: Optional[str]) -> None:
+    if user_id is None:
+        _state_cache.clear()
+        return
+    for key in [k for k in _state_cache if k[0] == user_id]:
+        _state_cache.pop(key, None)
+
+
+async def _listen_invalidations() -> None:
+    while True:
+        pubsub = None
+        try:
+            r = await get_redis()
+            pubsub = r.pubsub()
+            await pubsub.subscribe(_invalidate_channel())
+            async for msg in pubsub.listen():
+                if msg.get("type") == "message":
+                    _drop_local(msg["data"] or None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[ig_state] invalidation listener failed: {e}")
+            _drop_local(None)  # могли пропустить сообщения
+            await asyncio.sleep(5)
+        finally:
+            if pubsub is not None:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+
+def _ensure_listener() -> None:
+    global _listener
+    if _listener is None or _listener.done():
+        _listener = asyncio.create_task(_listen_invalidations())
+
+
+async def stop_state_listener() -> None:
+    """Остановить подписку на инвалидации (на shutdown, до close_redis)."""
+    global _listener
+    if _listener is None:
+        return
+    _listener.cancel()
+    try:
+        await _listener
+    except BaseException:
+        pass
+    _listener = None
+
+
+async def invalidate_state(user_id: Optional[str] = None) -> None:
+    """Сбросить кеш load_state пользователя (None — всех) здесь и на других репликах."""
+    _drop_local(user_id)
+    try:
+        r = await get_redis()
+        await r.publish(_invalidate_channel(), user_id or "")
+    except Exception as e:
+        print(f"[ig_state] invalidate publish failed: {e}")
+
 
 async def _resolve_page_and_ig_id(
     client: RetryClient, access_token: str, page_id: Optional[str] = None
@@ -63,7 +171,18 @@ async def load_state(
         Словарь с данными аккаунта: ig_id, page_token, user_token, page_id, ig_username
     """
     user_id = user_id or _default_user_id()
-    
+    cache_key = (user_id, account_id or _ACTIVE)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return cached
+    _ensure_listener()
+
+    state = await _load_state_uncached(user_id, account_id)
+    _cache_put(cache_key, state)
+    return dict(state)
+
+
+async def _load_state_uncached(user_id: str, account_id: Optional[str]) -> Dict[str, Any]:
     # Пытаемся получить аккаунт из Redis
     account = None
     if account_id:
@@ -78,15 +197,16 @@ async def load_state(
         ig_id = account.get("ig_id")
         ig_username = account.get("ig_username")
         
-        # Если ig_id отсутствует, получаем его через API
+        # Если ig_id отсутствует, получаем его через API и сохраняем в аккаунт
         if not ig_id:
-            async with RetryClient() as client:
+            async with shared_client() as client:
                 resolved = await _resolve_page_and_ig_id(client, access_token, page_id)
-                ig_id = resolved["ig_id"]
-                ig_username = resolved["ig_username"]
-                # Обновляем кеш
-                account["ig_id"] = ig_id
-                account["ig_username"] = ig_username
+            ig_id = resolved["ig_id"]
+            ig_username = resolved["ig_username"]
+            if account.get("account_id"):
+                await update_account(
+                    user_id, account["account_id"], {"ig_id": ig_id, "ig_username": ig_username}
+                )
         
         return {
             "ig_id": ig_id,
@@ -99,13 +219,29 @@ async def load_state(
     # Fallback: используем старую логику (из env переменных)
     if not IG_LONG_TOKEN:
         raise HTTPException(500, "IG_ACCESS_TOKEN is not set in env and no account found.")
-    
-    async with RetryClient() as client:
+
+    # env-режим раньше работал без Redis — его недоступность не ошибка
+    r = None
+    try:
+        r = await get_redis()
+        raw = await r.get(_env_state_key())
+        if raw:
+            return json.loads(raw)
+    except Exception as e:
+        print(f"[ig_state] env state read failed: {e}")
+
+    async with shared_client() as client:
         resolved = await _resolve_page_and_ig_id(client, IG_LONG_TOKEN, PAGE_ID_ENV)
-        return {
-            "ig_id": resolved["ig_id"],
-            "page_token": IG_LONG_TOKEN,
-            "user_token": IG_LONG_TOKEN,
-            "page_id": resolved["page_id"],
-            "ig_username": resolved["ig_username"],
-        }
+    state = {
+        "ig_id": resolved["ig_id"],
+        "page_token": IG_LONG_TOKEN,
+        "user_token": IG_LONG_TOKEN,
+        "page_id": resolved["page_id"],
+        "ig_username": resolved["ig_username"],
+    }
+    if r is not None:
+        try:
+            await r.set(_env_state_key(), json.dumps(state), ex=settings.IG_STATE_ENV_TTL_SEC)
+        except Exception as e:
+            print(f"[ig_state] env state write failed: {e}")
+    return state
@@ -0,0 +1,29 @@
+import asyncio
+import os
+
+os.environ.setdefault("DISABLE_DOTENV", "1")
+
+import fakeredis
+import pytest
+
+import jobs
+from config import settings
+
+
+@pytest.fixture
+def run():
+    """Прогон корутины в свежем event loop (без pytest-asyncio)."""
+    return asyncio.run
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """jobs.get_redis() → in-memory fakeredis с поддержкой Lua."""
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    monkeypatch.setattr(settings, "REDIS_URL", "redis://fake")
+    monkeypatch.setattr(jobs, "_redis", client)
+    jobs._scripts.clear()
+    yield client
+    jobs._scripts.clear()
+    monkeypatch.setattr(jobs, "_redis", None)
@@ -0,0 +1,146 @@
+import json
+
+import pytest
+from fastapi import HTTPException
+
+import jobs
+from routers import ai
+from services.ai_subscription import (
+    AIAvatarPlanType,
+    PLAN_CONFIG,
+    commit_credits,
+    get_avatar_batch_usage,
+    get_credits,
+    get_daily_usage,
+    refund_credits,
+    reserve_credits,
+    set_subscription,
+    _hold_key,
+)
+
+UID = "u1"
+
+
+async def _remaining(uid=UID):
+    return (await get_credits(uid))["credits_remaining"]
+
+
+def test_reserve_then_commit_keeps_credits_spent(fake_redis, run):
+    async def scenario():
+        await set_subscription(UID, AIAvatarPlanType.WEEKLY)
+        start = await _remaining()
+
+        hold = await reserve_credits(UID, "image_to_image")
+        assert hold["success"] and hold["credits_used"] == 2
+        assert await _remaining() == start - 2
+        assert await get_daily_usage(UID) == 2
+
+        assert await commit_credits(hold["hold_id"]) is True
+        assert not await fake_redis.exists(_hold_key(hold["hold_id"]))
+        # после commit возврат уже ничего не делает
+        assert await refund_credits(hold["hold_id"]) == 0
+        assert await _remaining() == start - 2
+        assert await get_daily_usage(UID) == 2
+
+    run(scenario())
+
+
+def test_reserve_then_refund_restores_credits_once(fake_redis, run):
+    async def scenario():
+        await set_subscription(UID, AIAvatarPlanType.YEARLY)
+        start = await _remaining()
+
+        hold = await reserve_credits(UID, "text_to_image")
+        assert hold["success"]
+        assert await refund_credits(hold["hold_id"]) == 1
+        assert await refund_credits(hold["hold_id"]) == 0  # идемпотентно
+        assert await _remaining() == start
+        assert await get_daily_usage(UID) == 0
+        assert await commit_credits(hold["hold_id"]) is False
+
+    run(scenario())
+
+
+def test_refund_returns_yearly_batch_slot(fake_redis, run, monkeypatch):
+    # дневной лимит yearly (10) меньше цены batch (25) — поднимаем его для теста
+    plans = {plan: dict(cfg) for plan, cfg in PLAN_CONFIG.items()}
+    plans[AIAvatarPlanType.YEARLY]["daily_limit"] = 100
+    monkeypatch.setattr(
+        "services.ai_subscription._PLANS_JSON",
+        json.dumps({plan.value: cfg for plan, cfg in plans.items()}),
+    )
+
+    async def scenario():
+        await set_subscription(UID, AIAvatarPlanType.YEARLY)
+        hold = await reserve_credits(UID, "avatar_batch")
+        assert hold["success"]
+        assert await get_avatar_batch_usage(UID) == 1
+        second = await reserve_credits(UID, "avatar_batch")
+        assert not second["success"] and second["reason_code"] == "batch_daily_limit"
+
+        assert await refund_credits(hold["hold_id"]) == 25
+        assert await get_avatar_batch_usage(UID) == 0
+
+    run(scenario())
+
+
+def test_reserve_fails_without_spending(fake_redis, run):
+    async def scenario():
+        assert (await reserve_credits(UID, "text_to_image"))["reason_code"] == "no_subscription"
+
+        await set_subscription(UID, AIAvatarPlanType.WEEKLY)
+        start = await _remaining()
+        limit = PLAN_CONFIG[AIAvatarPlanType.WEEKLY]["daily_limit"]
+        for _ in range(limit):
+            assert (await reserve_credits(UID, "text_to_image"))["success"]
+        over = await reserve_credits(UID, "text_to_image")
+        assert not over["success"] and over["reason_code"] == "daily_limit"
+        assert over["hold_id"] is None
+        assert await _remaining() == start - limit
+
+    run(scenario())
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"aspect_ratio": "7:3"},
+        {"steps": 5},
+        {"strength": 1.5},
+    ],
+)
+def test_validation_failure_does_not_charge(fake_redis, run, kwargs):
+    async def scenario():
+        await set_subscription(UID, AIAvatarPlanType.WEEKLY)
+        start = await _remaining()
+        params = {
+            "image_url": "https://example.com/a.jpg",
+            "prompt": "portrait",
+            "strength": 0.6,
+            "aspect_ratio": "3:4",
+            "steps": 30,
+            "seed": None,
+            "user_id": UID,
+            **kwargs,
+        }
+        with pytest.raises(HTTPException) as exc:
+            await ai.ai_generate_image(**params)
+        assert exc.value.status_code == 400
+        assert await _remaining() == start
+        assert await get_daily_usage(UID) == 0
+        assert not [k async for k in fake_redis.scan_iter(match="*ai_credit_hold:*")]
+
+    run(scenario())
+
+
+def test_generate_enqueues_job_with_hold(fake_redis, run):
+    async def scenario():
+        await set_subscription(UID, AIAvatarPlanType.WEEKLY)
+        start = await _remaining()
+        res = await ai.ai_generate_text(prompt="cat", aspect_ratio="1:1", steps=30, seed=None, user_id=UID)
+        job = await jobs.get_job(res["job_id"])
+        hold_id = job["payload"]["credit_hold"]
+        assert await fake_redis.exists(_hold_key(hold_id))
+        assert await _remaining() == start - 1
+
+    run(scenario())
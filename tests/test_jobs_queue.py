@@ -0,0 +1,152 @@
+import random
+
+import jobs
+from config import settings
+
+
+async def _enqueue(kind, priority=jobs.PRIORITY_NORMAL, **payload):
+    job = await jobs.create_job(kind, payload)
+    await jobs.enqueue_job(job, priority)
+    return job["job_id"]
+
+
+async def _drain(lanes=None):
+    out = []
+    while True:
+        item = await jobs.dequeue_job(lanes, timeout=0)
+        if not item:
+            return out
+        out.append(item)
+
+
+def test_dequeue_is_fifo_within_queue_and_moves_to_processing(fake_redis, run):
+    async def scenario():
+        ids = [await _enqueue("video_filter") for _ in range(3)]
+        got = await _drain()
+        assert [job_id for _, job_id in got] == ids
+        assert {queue for queue, _ in got} == {jobs._queue_key(jobs.LANE_VIDEO, jobs.PRIORITY_NORMAL)}
+        # reliable mode: всё выданное лежит в processing до ack
+        assert sorted(await fake_redis.lrange(jobs._processing_key(), 0, -1)) == sorted(ids)
+        for job_id in ids:
+            await jobs.ack_job(job_id)
+        assert await fake_redis.llen(jobs._processing_key()) == 0
+        await jobs._stop_heartbeat()
+
+    run(scenario())
+
+
+def test_dequeue_respects_lanes_and_drains_legacy_queue_last(fake_redis, run):
+    async def scenario():
+        video = await _enqueue("video_filter")
+        ai = await _enqueue("image_t2i")
+        await fake_redis.lpush(settings.REDIS_QUEUE, "legacy")
+
+        assert await jobs.dequeue_job([jobs.LANE_AI], timeout=0) == (
+            jobs._queue_key(jobs.LANE_AI, jobs.PRIORITY_NORMAL),
+            ai,
+        )
+        assert [job_id for _, job_id in await _drain([jobs.LANE_VIDEO])] == [video, "legacy"]
+        await jobs._stop_heartbeat()
+
+    run(scenario())
+
+
+def test_weighted_order_prefers_high_priority_without_starving_normal(fake_redis, run, monkeypatch):
+    monkeypatch.setattr(settings, "JOB_LANE_WEIGHTS", "ai:1,video:1,batch:1")
+    monkeypatch.setattr(settings, "JOB_HIGH_PRIORITY_WEIGHT", 4)
+    random.seed(1234)
+
+    async def scenario():
+        firsts = {jobs.PRIORITY_HIGH: 0, jobs.PRIORITY_NORMAL: 0}
+        for _ in range(200):
+            high = await _enqueue("image_t2i", jobs.PRIORITY_HIGH)
+            normal = await _enqueue("image_t2i")
+            _, first = await jobs.dequeue_job([jobs.LANE_AI], timeout=0)
+            firsts[jobs.PRIORITY_HIGH if first == high else jobs.PRIORITY_NORMAL] += 1
+            await _drain([jobs.LANE_AI])
+            await fake_redis.delete(jobs._processing_key())
+        # P(high первым) = 4 / (4 + 1) = 0.8
+        assert 140 <= firsts[jobs.PRIORITY_HIGH] <= 185
+        assert firsts[jobs.PRIORITY_NORMAL] > 0
+        await jobs._stop_heartbeat()
+
+    run(scenario())
+
+
+def test_user_slot_limits_inflight_jobs(fake_redis, run, monkeypatch):
+    monkeypatch.setattr(settings, "JOB_USER_MAX_INFLIGHT", 2)
+
+    async def scenario():
+        assert await jobs.acquire_user_slot("u1", "a")
+        assert await jobs.acquire_user_slot("u1", "a")  # повторно — тот же слот
+        assert await jobs.acquire_user_slot("u1", "b")
+        assert not await jobs.acquire_user_slot("u1", "c")
+        assert await jobs.acquire_user_slot("u2", "c")
+        await jobs.release_user_slot("u1", "a")
+        assert await jobs.acquire_user_slot("u1", "c")
+
+    run(scenario())
+
+
+def test_reaper_requeues_jobs_of_dead_worker_to_queue_head(fake_redis, run):
+    async def scenario():
+        first = await _enqueue("video_filter", user_id="u1")
+        second = await _enqueue("video_filter")
+        queue, job_id = await jobs.dequeue_job(timeout=0)
+        assert job_id == first
+        await jobs.acquire_user_slot("u1", first)
+        await jobs.incr_job_attempts(first)
+
+        # процесс умер: heartbeat истёк, processing-список остался
+        await jobs._stop_heartbeat()
+        assert await jobs.reap_stale_jobs() == 1
+
+        assert await fake_redis.llen(jobs._processing_key()) == 0
+        assert await fake_redis.lrange(queue, 0, -1) == [second, first]
+        assert await fake_redis.smembers(jobs._user_inflight_key("u1")) == set()
+        job = await jobs.get_job_status(first)
+        assert (job["status"], job["stage"]) == (jobs.PENDING, "requeued")
+
+        # вернувшаяся задача выдаётся раньше тех, что ждали после неё
+        assert (await jobs.dequeue_job(timeout=0))[1] == first
+        await jobs._stop_heartbeat()
+
+    run(scenario())
+
+
+def test_reaper_dead_letters_after_max_attempts(fake_redis, run, monkeypatch):
+    monkeypatch.setattr(settings, "JOB_MAX_ATTEMPTS", 2)
+
+    async def scenario():
+        job_id = await _enqueue("video_filter")
+        await jobs.dequeue_job(timeout=0)
+        for _ in range(2):
+            await jobs.incr_job_attempts(job_id)
+        await jobs._stop_heartbeat()
+
+        assert await jobs.reap_stale_jobs() == 1
+        assert await fake_redis.lrange(jobs._dead_letter_key(), 0, -1) == [job_id]
+        job = await jobs.get_job_status(job_id)
+        assert (job["status"], job["stage"]) == (jobs.ERROR, "dead")
+        assert (await jobs.queue_stats())["dead_letter"] == 1
+
+    run(scenario())
+
+
+def test_reaper_drops_finished_jobs_without_rerunning(fake_redis, run):
+    async def scenario():
+        job_id = await _enqueue("video_filter", user_id="u1")
+        queue, _ = await jobs.dequeue_job(timeout=0)
+        await jobs.acquire_user_slot("u1", job_id)
+        # воркер успел записать результат, но умер до ack_job
+        await jobs.update_job_status(job_id, jobs.DONE, stage="done", result={"output_url": "x"})
+        await jobs._stop_heartbeat()
+
+        assert await jobs.reap_stale_jobs() == 0
+        assert await fake_redis.llen(jobs._processing_key()) == 0
+        assert await fake_redis.llen(queue) == 0
+        assert await fake_redis.smembers(jobs._user_inflight_key("u1")) == set()
+        job = await jobs.get_job(job_id)
+        assert (job["status"], job["stage"], job["result"]) == (jobs.DONE, "done", {"output_url": "x"})
+
+    run(scenario())
@@ -0,0 +1,165 @@
+# transform_cache.py
+"""
+Кеш результатов детерминированных медиа-преобразований
+(resize / filter / watermark / transcode / video_filter).
+
+Ключ — sha256(содержимое входа) + операция + канонизированные параметры;
+значение — готовый ответ ({"output_url": ...}) в Redis с TTL
+TRANSFORM_CACHE_TTL_SEC. Индекс ZSET по времени последнего обращения
+держит не больше TRANSFORM_CACHE_MAX_ENTRIES записей (LRU).
+Запись с /static/... считается живой, только пока файл есть на диске
+(его могла удалить /util/cleanup); при попадании mtime файла обновляется.
+
+URL → sha256 запоминается на DOWNLOAD_CACHE_FRESH_SEC, чтобы проверить кеш
+ещё до постановки задачи, не скачивая вход.
+Без Redis кеш просто пропускается.
+"""
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from config import settings
+from download_cache import content_sha256, fresh_content_sha256
+from jobs import get_redis
+from paths import STATIC_DIR
+
+
+def _entry_key(key: str) -> str:
+    return f"{settings.REDIS_PREFIX}:tcache:{key}"
+
+
+def _index_key() -> str:
+    return f"{settings.REDIS_PREFIX}:tcache_idx"
+
+
+def _alias_key(url: str) -> str:
+    return f"{settings.REDIS_PREFIX}:tcache_url:{hashlib.sha256(url.encode()).hexdigest()}"
+
+
+def _canonical(value: Any) -> Any:
+    # 0.7 и 0.70000001 из разных клиентов — один ключ; строки как есть
+    # (enum-поля вроде preset/fit/position нормализует сам вызывающий)
+    if isinstance(value, float):
+        return round(value, 4)
+    if isinstance(value, dict):
+        return {k: _canonical(v) for k, v in value.items() if v is not None}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return value
+
+
+def transform_key(op: str, params: Dict[str, Any], *content_hashes: str) -> str:
+    """Ключ результата: операция + параметры + sha256 всех входов (по порядку)."""
+    norm = json.dumps(
+        {"op": op, "in": list(content_hashes), "params": _canonical(params)},
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(norm.encode()).hexdigest()
+
+
+def _output_alive(result: Dict[str, Any]) -> bool:
+    for field in ("output_url", "cover_url"):
+        url = result.get(field)
+        if isinstance(url, str) and url.startswith("/static/"):
+            path = STATIC_DIR / url[len("/static/"):]
+            if not path.exists():
+                return False
+            try:
+                os.utime(path)  # чтобы /util/cleanup не удалил популярный результат
+            except OSError:
+                pass
+    return True
+
+
+async def get_cached_transform(key: str) -> Optional[Dict[str, Any]]:
+    if not settings.TRANSFORM_CACHE_ENABLED:
+        return None
+    try:
+        r = await get_redis()
+        raw = await r.get(_entry_key(key))
+        if not raw:
+            return None
+        result = json.loads(raw)
+        if not _output_alive(result):
+            async with r.pipeline(transaction=False) as pipe:
+                pipe.delete(_entry_key(key))
+                pipe.zrem(_index_key(), key)
+                await pipe.execute()
+            return None
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.zadd(_index_key(), {key: time.time()})
+            pipe.expire(_entry_key(key), settings.TRANSFORM_CACHE_TTL_SEC)
+            await pipe.execute()
+        return result
+    except Exception as e:
+        print(f"[transform_cache] get failed key={key}: {e}")
+        return None
+
+
+async def put_cached_transform(key: str, result: Dict[str, Any]) -> None:
+    if not settings.TRANSFORM_CACHE_ENABLED or not result.get("ok", True):
+        return
+    try:
+        r = await get_redis()
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.set(_entry_key(key), json.dumps(result), ex=settings.TRANSFORM_CACHE_TTL_SEC)
+            pipe.zadd(_index_key(), {key: time.time()})
+            pipe.zcard(_index_key())
+            *_, size = await pipe.execute()
+        overflow = int(size) - settings.TRANSFORM_CACHE_MAX_ENTRIES
+        if overflow > 0:
+            stale = await r.zpopmin(_index_key(), overflow)
+            if stale:
+                await r.delete(*[_entry_key(k) for k, _score in stale])
+    except Exception as e:
+        print(f"[transform_cache] put failed key={key}: {e}")
+
+
+async def remember_content_hash(url: str, sha256: str) -> None:
+    """URL → sha256 входа, чтобы следующий запрос проверил кеш без скачивания."""
+    if not settings.TRANSFORM_CACHE_ENABLED or url.startswith("/static/"):
+        return
+    try:
+        r = await get_redis()
+        await r.set(_alias_key(url), sha256, ex=max(1, settings.DOWNLOAD_CACHE_FRESH_SEC))
+    except Exception as e:
+        print(f"[transform_cache] alias failed: {e}")
+
+
+async def known_content_hash(url: str) -> Optional[str]:
+    """sha256 входа без скачивания: из свежего download_cache или из Redis-алиаса."""
+    local = fresh_content_sha256(url)
+    if local:
+        return local
+    try:
+        r = await get_redis()
+        return await r.get(_alias_key(url))
+    except Exception:
+        return None
+
+
+async def lookup_by_urls(op: str, params: Dict[str, Any], *urls: str) -> Optional[Dict[str, Any]]:
+    """Проверка до скачивания: работает, только если sha256 всех входов уже известны."""
+    hashes = [await known_content_hash(u) for u in urls]
+    if not all(hashes):
+        return None
+    hit = await get_cached_transform(transform_key(op, params, *hashes))  # type: ignore[arg-type]
+    return {**hit, "cached": True} if hit else None
+
+
+async def lookup_by_files(
+    op: str, params: Dict[str, Any], *inputs: Tuple[str, Path]
+) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """Проверка по скачанным входам [(url, path)...] → (ключ для put_cached_transform, попадание)."""
+    hashes = []
+    for url, path in inputs:
+        sha = await content_sha256(url, path)
+        await remember_content_hash(url, sha)
+        hashes.append(sha)
+    key = transform_key(op, params, *hashes)
+    hit = await get_cached_transform(key)
+    return key, ({**hit, "cached": True} if hit else None)
@@ -0,0 +1,309 @@
+# video_pipeline.py
+"""
+Составной видео-пайплайн (задача video_pipeline, lane video): вместо
+transcode → video_filter → watermark → reel-cover (четыре скачивания,
+декодирования и перекодирования) — один запуск ffmpeg.
+
+    {"url": "...", "ops": [
+        {"op": "trim", "start": 0, "duration": 30},
+        {"op": "aspect", "aspect": "9:16", "max_width": 1080},
+        {"op": "fps", "fps": 30},
+        {"op": "eq", "preset": "cinematic", "intensity": 0.7},
+        {"op": "logo", "url": "...", "position": "br", "opacity": 0.85, "margin": 24},
+        {"op": "loudnorm"}],
+     "cover": {"at": 1.0, "overlay": {"text": "..."}}}
+
+Видео-операции применяются в порядке списка и собираются в один
+-filter_complex; trim — опции входа (-ss/-t), loudnorm — аудио-ветка.
+Обложка — второй выход того же графа (split), без отдельного декодирования;
+cover.at — секунда уже обрезанного видео. Каждая операция — не больше раза.
+"""
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import settings
+from ffmpeg_utils import FFMPEG, LANE_JOBS, FFmpegTimeoutError, has_ffmpeg, run_ffmpeg
+from file_utils import public_url, uuid_name
+from fonts_utils import PIL_OK
+from image_ops import cover_overlay, run_image_op
+from jobs import get_job, update_job_status, DONE, ERROR, RUNNING
+from media_probe import probe
+from media_utils import parse_aspect
+from paths import STATIC_DIR, OUT_DIR
+from transform_cache import lookup_by_files, put_cached_transform
+from video_worker import resolve_input, video_filter_params, video_filter_vf
+
+PIPELINE_OPS = ("trim", "aspect", "fps", "eq", "logo", "loudnorm")
+LOGO_POSITIONS = ("tr", "tl", "bl", "br")
+
+
+def overlay_position(position: str, margin: int) -> str:
+    """Координаты overlay для угла tr/tl/bl/br (по умолчанию br)."""
+    pos_map = {
+        "tr": f"main_w-overlay_w-{margin}:{margin}",
+        "tl": f"{margin}:{margin}",
+        "bl": f"{margin}:main_h-overlay_h-{margin}",
+        "br": f"main_w-overlay_w-{margin}:main_h-overlay_h-{margin}",
+    }
+    return pos_map.get(position, pos_map["br"])
+
+
+def _normalize_op(raw: Any) -> Dict[str, Any]:
+    if not isinstance(raw, dict):
+        raise ValueError("Each op must be an object with an 'op' field")
+    name = str(raw.get("op") or "").strip().lower()
+    if name not in PIPELINE_OPS:
+        raise ValueError(f"Unknown op {name!r}; allowed: {', '.join(PIPELINE_OPS)}")
+
+    if name == "trim":
+        start = max(0.0, float(raw.get("start") or 0))
+        duration = raw.get("duration")
+        duration = float(duration) if duration is not None else None
+        if duration is not None and duration <= 0:
+            raise ValueError("trim.duration must be > 0")
+        return {"op": name, "start": start, "duration": duration}
+    if name == "aspect":
+        aspect = parse_aspect(raw.get("aspect") or "9:16")
+        if not aspect or aspect <= 0:
+            raise ValueError("aspect.aspect must look like '9:16'")
+        max_width = max(16, min(4096, int(raw.get("max_width") or 1080)))
+        return {"op": name, "aspect": round(aspect, 4), "max_width": max_width}
+    if name == "fps":
+        return {"op": name, "fps": max(1.0, min(120.0, float(raw.get("fps") or 30)))}
+    if name == "eq":
+        return {"op": name, **video_filter_params(raw)}
+    if name == "logo":
+        url = (raw.get("url") or "").strip()
+        if not url:
+            raise ValueError("logo.url is required")
+        position = str(raw.get("position") or "br").lower()
+        return {
+            "op": name,
+            "url": url,
+            "position": position if position in LOGO_POSITIONS else "br",
+            "opacity": max(0.0, min(1.0, float(raw.get("opacity", 0.85)))),
+            "margin": max(0, int(raw.get("margin", 24))),
+        }
+    return {"op": name}
+
+
+def normalize_pipeline(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """payload запроса/задачи → {"url", "ops", "cover"}; ValueError — неверная спецификация."""
+    url = (payload.get("url") or "").strip()
+    if not url:
+        raise ValueError("Field 'url' is required")
+    raw_ops = payload.get("ops") or []
+    if not isinstance(raw_ops, list):
+        raise ValueError("Field 'ops' must be a list")
+
+    ops: List[Dict[str, Any]] = []
+    for raw in raw_ops:
+        op = _normalize_op(raw)
+        if any(o["op"] == op["op"] for o in ops):
+            raise ValueError(f"Op {op['op']!r} given more than once")
+        ops.append(op)
+
+    cover = payload.get("cover")
+    if cover is not None:
+        if not isinstance(cover, dict):
+            raise ValueError("Field 'cover' must be an object")
+        overlay = cover.get("overlay")
+        cover = {
+            "at": max(0.0, float(cover.get("at", 1.0))),
+            "overlay": dict(overlay) if isinstance(overlay, dict) else None,
+        }
+    return {"url": url, "ops": ops, "cover": cover}
+
+
+def _find_op(spec: Dict[str, Any], name: str) -> Optional[Dict[str, Any]]:
+    return next((o for o in spec["ops"] if o["op"] == name), None)
+
+
+def pipeline_input_urls(spec: Dict[str, Any]) -> List[str]:
+    logo = _find_op(spec, "logo")
+    return [spec["url"]] + ([logo["url"]] if logo else [])
+
+
+def pipeline_cache_params(spec: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Параметры для transform_cache: входы идут хешами содержимого, поэтому
+    URL логотипа убираем.
+    """
+    ops = [{k: v for k, v in o.items() if not (o["op"] == "logo" and k == "url")} for o in spec["ops"]]
+    return {"ops": ops, "cover": spec.get("cover")}
+
+
+def build_pipeline_command(
+    src: Path,
+    out: Path,
+    spec: Dict[str, Any],
+    *,
+    logo: Optional[Path] = None,
+    cover_out: Optional[Path] = None,
+    cover_at: float = 0.0,
+    has_audio: bool = True,
+) -> List[str]:
+    """Команда ffmpeg: один -filter_complex, видео [vout] (+ кадр обложки [vcover])."""
+    cmd = [FFMPEG, "-y"]
+    trim = _find_op(spec, "trim")
+    if trim:
+        if trim["start"]:
+            cmd += ["-ss", str(trim["start"])]
+        if trim["duration"]:
+            cmd += ["-t", str(trim["duration"])]
+    cmd += ["-i", str(src)]
+    if logo is not None:
+        cmd += ["-i", str(logo)]
+
+    graph: List[str] = []
+    chain: List[str] = []
+    cur = "[0:v]"
+    n = 0
+    for op in spec["ops"]:
+        if op["op"] == "aspect":
+            a = op["aspect"]
+            chain += [
+                f"crop='min(iw,ih*{a})':'min(ih,iw/{a})'",
+                f"scale='trunc(min({op['max_width']},iw)/2)*2':-2",
+                "setsar=1",
+            ]
+        elif op["op"] == "fps":
+            chain.append(f"fps={op['fps']:g}")
+        elif op["op"] == "eq":
+            chain.append(video_filter_vf(op["preset"], op["intensity"]))
+        elif op["op"] == "logo" and logo is not None:
+            # логотип ложится поверх того, что уже собрано до него в списке
+            graph.append(f"{cur}{','.join(chain) or 'null'}[v{n + 1}]")
+            graph.append(f"[1:v]format=rgba,colorchannelmixer=aa={op['opacity']}[lg]")
+            graph.append(f"[v{n + 1}][lg]overlay={overlay_position(op['position'], op['margin'])}[v{n + 2}]")
+            n += 2
+            cur = f"[v{n}]"
+            chain = []
+
+    if cover_out is not None:
+        graph.append(f"{cur}{','.join(chain + ['split=2'])}[vmain][vc]")
+        graph.append("[vmain]format=yuv420p[vout]")
+        graph.append(f"[vc]trim=start={cover_at:g},setpts=PTS-STARTPTS[vcover]")
+    else:
+        graph.append(f"{cur}{','.join(chain + ['format=yuv420p'])}[vout]")
+
+    loudnorm = has_audio and _find_op(spec, "loudnorm") is not None
+    if loudnorm:
+        graph.append("[0:a]loudnorm=I=-16:TP=-1.5:LRA=11[aout]")
+
+    cmd += ["-filter_complex", ";".join(graph), "-map", "[vout]"]
+    if has_audio:
+        cmd += ["-map", "[aout]" if loudnorm else "0:a:0"]
+    cmd += [
+        "-c:v", "libx264",
+        "-preset", "veryfast",
+        "-crf", "21",
+        "-movflags", "+faststart",
+    ]
+    if has_audio:
+        cmd += ["-c:a", "aac", "-b:a", "128k"]
+    cmd.append(str(out))
+    if cover_out is not None:
+        cmd += ["-map", "[vcover]", "-frames:v", "1", "-q:v", "2", str(cover_out)]
+    return cmd
+
+
+def _cover_time(spec: Dict[str, Any], duration: float) -> float:
+    """cover.at в пределах итоговой длительности (иначе кадра не будет)."""
+    trim = _find_op(spec, "trim")
+    if trim:
+        duration = max(0.0, duration - trim["start"])
+        if trim["duration"]:
+            duration = min(duration, trim["duration"])
+    at = spec["cover"]["at"]
+    return max(0.0, min(at, duration - 0.1)) if duration > 0 else 0.0
+
+
+async def _resolve_inputs(spec: Dict[str, Any]) -> Tuple[Path, Optional[Path]]:
+    src = await resolve_input(spec["url"])
+    logo_op = _find_op(spec, "logo")
+    logo = await resolve_input(logo_op["url"], "pl_logo", ".png") if logo_op else None
+    return src, logo
+
+
+async def process_pipeline_job(job_id: str) -> None:
+    job = await get_job(job_id, fields=("payload",))
+    if not job:
+        await update_job_status(job_id, ERROR, error="Job not found")
+        return
+    try:
+        spec = normalize_pipeline(job.get("payload") or {})
+    except (ValueError, TypeError) as e:
+        await update_job_status(job_id, ERROR, error=f"invalid pipeline: {e}")
+        return
+
+    if not has_ffmpeg():
+        await update_job_status(job_id, ERROR, error="ffmpeg not available on server")
+        return
+
+    # 1) входы (скачивание через download_cache) + кеш результата
+    await update_job_status(job_id, RUNNING, stage="download")
+    try:
+        src, logo = await _resolve_inputs(spec)
+        inputs = [(spec["url"], src)] + ([(_find_op(spec, "logo")["url"], logo)] if logo else [])
+        tkey, hit = await lookup_by_files("video_pipeline", pipeline_cache_params(spec), *inputs)
+    except FileNotFoundError as e:
+        await update_job_status(job_id, ERROR, error=str(e))
+        return
+    except Exception as e:
+        await update_job_status(job_id, ERROR, error=f"download/open failed: {e}")
+        return
+    if hit:
+        await update_job_status(job_id, DONE, result=hit)
+        return
+
+    # 2) есть ли аудио и длительность — для loudnorm/map и кадра обложки
+    try:
+        meta = await probe(src, source_url=None if spec["url"].startswith("/static/") else spec["url"])
+    except Exception as e:
+        await update_job_status(job_id, ERROR, error=f"ffprobe failed: {e}")
+        return
+
+    # 3) один проход ffmpeg: видео + кадр обложки
+    out = OUT_DIR / uuid_name("pipeline_out", ".mp4")
+    frame = OUT_DIR / uuid_name("pipeline_cover", ".jpg") if spec["cover"] else None
+    cmd = build_pipeline_command(
+        src,
+        out,
+        spec,
+        logo=logo,
+        cover_out=frame,
+        cover_at=_cover_time(spec, meta["duration"]) if frame else 0.0,
+        has_audio=bool(meta["audio_codec"]),
+    )
+    await update_job_status(job_id, RUNNING, stage="encode")
+    try:
+        p = await run_ffmpeg(cmd, timeout_sec=settings.FFMPEG_TIMEOUT_SEC, lane=LANE_JOBS)
+    except FFmpegTimeoutError as e:
+        out.unlink(missing_ok=True)
+        if frame:
+            frame.unlink(missing_ok=True)
+        await update_job_status(job_id, ERROR, error=str(e))
+        return
+    if p.returncode != 0:
+        err = (p.stderr or "")[-1200:]
+        await update_job_status(job_id, ERROR, error=f"ffmpeg failed: {err}")
+        return
+
+    result: Dict[str, Any] = {"output_url": public_url(out, STATIC_DIR)}
+    if frame:
+        cover_path = frame
+        overlay = spec["cover"].get("overlay")
+        if overlay and PIL_OK:
+            # текст на обложке — Pillow в пуле image_ops, не в event loop
+            cover_path = OUT_DIR / uuid_name("pipeline_cover_txt", ".jpg")
+            try:
+                await run_image_op(cover_overlay, str(frame), str(cover_path), overlay)
+            except Exception as e:
+                cover_path = frame
+                result["note"] = f"PIL overlay skipped: {e}"
+        result["cover_url"] = public_url(cover_path, STATIC_DIR)
+
+    if "note" not in result:
+        await put_cached_transform(tkey, result)
+    await update_job_status(job_id, DONE, result=result, stage="done")
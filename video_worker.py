@@ -0,0 +1,118 @@
+# video_worker.py
+from pathlib import Path
+
+from config import settings
+from ffmpeg_utils import FFMPEG, LANE_JOBS, FFmpegTimeoutError, has_ffmpeg, run_ffmpeg
+from file_utils import ext_from_url, uuid_name, public_url
+from download_cache import download_cached
+from transform_cache import lookup_by_files, put_cached_transform
+from jobs import get_job, update_job_status, DONE, ERROR
+from paths import STATIC_DIR, UPLOAD_DIR, OUT_DIR
+
+
+def video_filter_params(payload: dict) -> dict:
+    """Нормализованные параметры video_filter (ключ transform_cache)."""
+    try:
+        intensity = float(payload.get("intensity", 0.7))
+    except Exception:
+        intensity = 0.7
+    return {
+        "preset": (payload.get("preset") or "cinematic").strip().lower(),
+        "intensity": max(0.0, min(1.0, intensity)),
+    }
+
+
+async def resolve_input(url: str, prefix: str = "src", default_ext: str = ".mp4") -> Path:
+    """Локальный /static/... как есть, иначе — скачать (через download_cache) в UPLOAD_DIR."""
+    if url.startswith("/static/"):
+        root = STATIC_DIR.resolve()
+        src = (root / url[len("/static/"):]).resolve()
+        # "/static/../../etc/..." и симлинки наружу — не наши файлы
+        if not src.is_relative_to(root):
+            raise ValueError(f"Path escapes static dir: {url}")
+        if not src.exists():
+            raise FileNotFoundError(f"Local file not found: {src}")
+        return src
+    src = UPLOAD_DIR / uuid_name(prefix, ext_from_url(url, default_ext))
+    await download_cached(url, src)
+    return src
+
+
+def video_filter_vf(preset: str, k: float) -> str:
+    """Цепочка -vf для пресета (общая с video_pipeline)."""
+    if preset in ("bw", "b&w", "mono", "blackwhite", "black_white"):
+        return "hue=s=0"
+    # cinematic-ish: slight contrast/sat + tiny gamma tweak
+    # keep it simple and stable
+    contrast = 1.0 + 0.20 * k
+    saturation = 1.0 + 0.15 * k
+    gamma = 1.0 - 0.05 * k
+    return f"eq=contrast={contrast}:saturation={saturation}:gamma={gamma}"
+
+
+async def process_video_job(job_id: str) -> None:
+    job = await get_job(job_id, fields=("payload",))
+    if not job:
+        await update_job_status(job_id, ERROR, error="Job not found")
+        return
+
+    payload = job.get("payload") or {}
+    url = (payload.get("url") or "").strip()
+    params = video_filter_params(payload)
+    preset, intensity = params["preset"], params["intensity"]
+
+    if not url:
+        await update_job_status(job_id, ERROR, error="payload.url is required")
+        return
+
+    if not has_ffmpeg():
+        await update_job_status(job_id, ERROR, error="ffmpeg not available on server")
+        return
+
+    # 1) Resolve input file (local /static/... or download)
+    try:
+        src = await resolve_input(url)
+        tkey, hit = await lookup_by_files("video_filter", params, (url, src))
+    except FileNotFoundError as e:
+        await update_job_status(job_id, ERROR, error=str(e))
+        return
+    except Exception as e:
+        await update_job_status(job_id, ERROR, error=f"download/open failed: {e}")
+        return
+    if hit:
+        await update_job_status(job_id, DONE, result=hit)
+        return
+
+    # 2) Build very small filter set
+    vf = video_filter_vf(preset, intensity)
+
+    out = OUT_DIR / uuid_name("flt_vid_out", ".mp4")
+
+    cmd = [
+        FFMPEG, "-y",
+        "-i", str(src),
+        "-vf", vf,
+        "-c:v", "libx264",
+        "-preset", "veryfast",
+        "-crf", "21",
+        "-pix_fmt", "yuv420p",
+        "-movflags", "+faststart",
+        "-c:a", "aac",
+        "-b:a", "128k",
+        str(out),
+    ]
+
+    try:
+        p = await run_ffmpeg(cmd, timeout_sec=settings.FFMPEG_TIMEOUT_SEC, lane=LANE_JOBS)
+    except FFmpegTimeoutError as e:
+        out.unlink(missing_ok=True)
+        await update_job_status(job_id, ERROR, error=str(e))
+        return
+    if p.returncode != 0:
+        err = (p.stderr or "")[-1200:]
+        await update_job_status(job_id, ERROR, error=f"ffmpeg failed: {err}")
+        return
+
+    result = {"output_url": public_url(out, STATIC_DIR)}
+    await put_cached_transform(tkey, result)
+    await update_job_status(job_id, DONE, result=result)
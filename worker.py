@@ -0,0 +1,203 @@
+# worker.py
+"""
+Обработчик очереди задач (video_filter, video_pipeline, image_t2i, image_i2i, avatar_batch).
+
+Используется двумя способами:
+- внутри uvicorn-процесса (main._startup, если INPROCESS_WORKERS=true);
+- отдельным процессом: `python -m worker` — чтобы масштабировать
+  ffmpeg/AI-воркеры независимо от HTTP-реплик (тот же образ).
+
+Задачи разложены по lane (video / ai / batch) и приоритетам, см. jobs.py.
+Конкурентность задаётся на lane: WORKER_VIDEO_CONCURRENCY,
+WORKER_AI_CONCURRENCY, WORKER_BATCH_CONCURRENCY; цикл берёт задачи только
+из lane со свободным слотом, а среди них — по весам JOB_LANE_WEIGHTS.
+WORKER_LANES ограничивает набор lane процесса (напр. отдельный video-деплой).
+Задачи одного пользователя сверх JOB_USER_MAX_INFLIGHT уходят в конец очереди.
+SIGTERM/SIGINT → перестаём брать новые задачи,
+дожидаемся текущих (не дольше WORKER_DRAIN_TIMEOUT_SEC), затем выходим.
+Недоделанные задачи остаются в processing-списке и переотдаются reaper'ом.
+"""
+import asyncio
+import signal
+from typing import Any, Dict, Iterable, List, Optional
+
+from config import settings
+from ai_worker import process_ai_job
+from video_worker import process_video_job
+from video_pipeline import process_pipeline_job
+from jobs import (
+    dequeue_job,
+    ack_job,
+    requeue_job,
+    incr_job_attempts,
+    acquire_user_slot,
+    release_user_slot,
+    record_queue_wait,
+    reap_stale_jobs,
+    lane_for_kind,
+    LANES,
+    LANE_VIDEO,
+    LANE_BATCH,
+    get_job,
+    update_job_status,
+    RUNNING,
+    ERROR,
+    close_redis,
+)
+from ffmpeg_utils import probe_capabilities
+from http_client import close_clients
+from paths import ensure_dirs
+
+VIDEO_KINDS = {"video_filter", "video_pipeline"}
+AI_KINDS = {"image_t2i", "image_i2i", "avatar_batch"}
+
+_lane_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+def _lane_limit(lane: str) -> int:
+    if lane == LANE_VIDEO:
+        return settings.WORKER_VIDEO_CONCURRENCY
+    if lane == LANE_BATCH:
+        return settings.WORKER_BATCH_CONCURRENCY
+    return settings.WORKER_AI_CONCURRENCY
+
+
+def _lane_semaphore(lane: str) -> asyncio.Semaphore:
+    sem = _lane_semaphores.get(lane)
+    if sem is None:
+        sem = asyncio.Semaphore(max(1, _lane_limit(lane)))
+        _lane_semaphores[lane] = sem
+    return sem
+
+
+def configured_lanes() -> List[str]:
+    wanted = {part.strip() for part in (settings.WORKER_LANES or "").split(",")}
+    return [lane for lane in LANES if lane in wanted] or list(LANES)
+
+
+async def run_job(job_id: str, job: Dict[str, Any]) -> None:
+    try:
+        await incr_job_attempts(job_id)
+        await update_job_status(job_id, RUNNING)
+
+        kind = (job.get("kind") or "").lower()
+        if kind == "video_pipeline":
+            await process_pipeline_job(job_id)
+        elif kind in VIDEO_KINDS:
+            await process_video_job(job_id)
+        elif kind in AI_KINDS:
+            await process_ai_job(job_id, job)
+        else:
+            await update_job_status(
+                job_id, ERROR, error=f"Unknown job kind: {job.get('kind')}"
+            )
+
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        await update_job_status(job_id, ERROR, error=str(e))
+
+
+async def worker_loop(
+    worker_idx: int,
+    stop: Optional[asyncio.Event] = None,
+    lanes: Optional[Iterable[str]] = None,
+) -> None:
+    lanes = list(lanes or LANES)
+    while stop is None or not stop.is_set():
+        # берём только из lane, где есть свободный слот, — задача не ждёт
+        # чужого слота, держа очередь
+        free = [lane for lane in lanes if not _lane_semaphore(lane).locked()]
+        if not free:
+            await asyncio.sleep(0.5)
+            continue
+        try:
+            item = await dequeue_job(free, timeout=2)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[worker] loop={worker_idx} dequeue failed: {e}")
+            await asyncio.sleep(1)
+            continue
+        if not item:
+            continue
+
+        queue, job_id = item
+        try:
+            await _handle(queue, job_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[worker] loop={worker_idx} job_id={job_id} failed: {e}")
+
+
+async def _handle(queue: str, job_id: str) -> None:
+    job = await get_job(job_id)
+    if not job:
+        await ack_job(job_id)
+        return
+
+    user_id = job.get("user_id") or (job.get("payload") or {}).get("user_id")
+    if not await acquire_user_slot(user_id, job_id):
+        # у пользователя уже JOB_USER_MAX_INFLIGHT задач в работе —
+        # в конец очереди, чтобы его пачка не занимала все слоты
+        await requeue_job(job_id, queue)
+        await asyncio.sleep(0.5)
+        return
+
+    try:
+        await record_queue_wait(job)
+        async with _lane_semaphore(lane_for_kind(job.get("kind"))):
+            await run_job(job_id, job)
+    finally:
+        await release_user_slot(user_id, job_id)
+    await ack_job(job_id)
+
+
+async def reaper_loop(stop: Optional[asyncio.Event] = None) -> None:
+    while stop is None or not stop.is_set():
+        try:
+            reaped = await reap_stale_jobs()
+            if reaped:
+                print(f"[worker] reaper: redelivered/dead-lettered {reaped} job(s)")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[worker] reaper failed: {e}")
+        await asyncio.sleep(max(1, settings.JOB_REAPER_INTERVAL_SEC))
+
+
+async def run_worker() -> None:
+    ensure_dirs()
+    await probe_capabilities()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    lanes = configured_lanes()
+    slots = {lane: max(1, _lane_limit(lane)) for lane in lanes}
+    tasks = [asyncio.create_task(worker_loop(i, stop, lanes)) for i in range(sum(slots.values()))]
+    reaper = asyncio.create_task(reaper_loop(stop)) if settings.JOB_RELIABLE_QUEUE else None
+    print(f"[worker] started loops={len(tasks)} lanes={slots}")
+
+    await stop.wait()
+    print(f"[worker] stop requested, draining (timeout={settings.WORKER_DRAIN_TIMEOUT_SEC}s)")
+    if reaper is not None:
+        reaper.cancel()
+
+    _done, pending = await asyncio.wait(tasks, timeout=settings.WORKER_DRAIN_TIMEOUT_SEC)
+    for t in pending:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await close_redis()
+    await close_clients()
+    print(f"[worker] stopped (cancelled={len(pending)})")
+
+
+if __name__ == "__main__":
+    asyncio.run(run_worker())